@@ -1,3 +1,8 @@
-from . import mesh_renderer
-from . import camera_estimation
-from . import coefficient_estimation
+try:
+    from . import mesh_renderer
+    from . import camera_estimation
+    from . import coefficient_estimation
+except ImportError:
+    # face3d, vxl or pix2face are not available: only the pure python modules (e.g. backends, pipeline,
+    # geometry_utils) can be used
+    pass
@@ -0,0 +1,406 @@
+"""
+Pluggable dense estimator (images -> (PNCC, offsets)) and fitter ((PNCC, offsets) -> camera or coefficients)
+backends, normally the pix2face network and face3d, plus synthetic stand-ins that need neither.
+Native modules are only imported when the pix2face / face3d backends are used.
+"""
+import time
+import zlib
+import concurrent.futures
+import functools
+import numpy as np
+from . import pipeline
+from . import instrumentation
+from .camera_decomposition import decompose_camera_rotation, compose_camera_rotation
+
+
+# yaw, pitch, roll are reported relative to this pitch, as in camera_estimation
+PITCH_OFFSET = -7
+
+
+def head_pose(camera_params):
+    """ return (yaw, pitch, roll) in degrees of a camera (face3d or synthetic) """
+    return decompose_camera_rotation(camera_params.rotation.as_matrix(), pitch_offset=PITCH_OFFSET)
+
+
+class DenseEstimator(object):
+    """ base class of dense estimators: estimate(images) returns a list of (PNCC, offsets), one per image """
+    def estimate(self, images):
+        raise NotImplementedError()
+
+    def __call__(self, images):
+        return self.estimate(images)
+
+
+class Pix2FaceDenseEstimator(DenseEstimator):
+    """ the pix2face network """
+    def __init__(self, pix2face_net, cuda_device=0):
+        self.pix2face_net = pix2face_net
+        self.cuda_device = cuda_device
+
+    def estimate(self, images):
+        import pix2face.test
+        return pix2face.test.test(self.pix2face_net, images, cuda_device=self.cuda_device)
+
+
+class Fitter(object):
+    """
+    base class of fitters, which must be picklable.  init is the camera or coefficients of a similar image
+    (e.g. the previous video frame), which fitters may use as a starting point.
+    fit_expression fits the camera and expression of an image with the (S,) subject coefficients held fixed.
+    """
+    def fit_camera(self, PNCC, offsets, init=None):
+        raise NotImplementedError()
+
+    def fit_coefficients(self, img_label, PNCC, offsets, init=None):
+        raise NotImplementedError()
+
+    def fit_expression(self, img_label, PNCC, offsets, subject_coeffs, init=None):
+        raise NotImplementedError()
+
+    def pack(self, coeffs):
+        return coeffs
+
+    def unpack(self, value):
+        return value
+
+
+class Face3dFitter(Fitter):
+    """
+    face3d fitting (init is ignored).  pix2face_data is needed for fit_coefficients and fit_expression, which
+    fits the expression by linear least squares on the offsets (see subject_model), as face3d can not fix the subject.
+    """
+    def __init__(self, pix2face_data=None, cuda_device=None):
+        self._pix2face_data = pix2face_data
+        self._data_args = None
+        if pix2face_data is not None:
+            self._data_args = (pix2face_data.pvr_data_dir, pix2face_data.subject_components_array.shape[0],
+                               pix2face_data.expression_components_array.shape[0], pix2face_data.use_offsets)
+        self.cuda_device = cuda_device
+        self._cuda_device_set = False
+        self._subject_model = None
+
+    def __getstate__(self):
+        return dict(data_args=self._data_args, cuda_device=self.cuda_device)
+
+    def __setstate__(self, state):
+        self._pix2face_data = None
+        self._data_args = state['data_args']
+        self.cuda_device = state['cuda_device']
+        self._cuda_device_set = False
+        self._subject_model = None
+
+    def _setup(self):
+        import face3d
+        if self.cuda_device is not None and not self._cuda_device_set:
+            face3d.set_cuda_device(self.cuda_device)
+            self._cuda_device_set = True
+
+    @property
+    def pix2face_data(self):
+        if self._pix2face_data is None:
+            if self._data_args is None:
+                raise ValueError('Face3dFitter needs pix2face_data to fit coefficients')
+            from . import coefficient_estimation
+            self._pix2face_data = coefficient_estimation.load_pix2face_data(*self._data_args)
+        return self._pix2face_data
+
+    @property
+    def subject_model(self):
+        """ subject_model.IncrementalSubjectModel (without sightings) providing the linear expression fit """
+        if self._subject_model is None:
+            from .subject_model import IncrementalSubjectModel
+            self._subject_model = IncrementalSubjectModel.from_pix2face_data(self.pix2face_data)
+        return self._subject_model
+
+    def fit_camera(self, PNCC, offsets, init=None):
+        import face3d
+        with instrumentation.timer('fit_camera'):
+            return face3d.compute_camera_params_from_pncc_and_offsets_perspective(PNCC, offsets)
+
+    def fit_coefficients(self, img_label, PNCC, offsets, init=None):
+        from . import coefficient_estimation
+        self._setup()
+        return coefficient_estimation._fit_coefficients(self.pix2face_data, img_label, PNCC, offsets)
+
+    def fit_expression(self, img_label, PNCC, offsets, subject_coeffs, init=None):
+        from . import coefficient_archive
+        from .subject_model import camera_to_arrays
+        model = self.subject_model
+        subject_coeffs = np.asarray(subject_coeffs, dtype=np.float64).reshape(-1)
+        if len(subject_coeffs) != model.num_subject_coeffs:
+            raise ValueError('Expected %d subject coefficients, got %d' % (model.num_subject_coeffs, len(subject_coeffs)))
+        camera = camera_to_arrays(self.fit_camera(PNCC, offsets))
+        with instrumentation.timer('fit_expression'):
+            statistics = model.sighting_statistics(img_label, PNCC, offsets)
+            expression_coeffs = statistics.expression_offset - np.dot(statistics.expression_gain, subject_coeffs)
+            if model.expression_ranges is not None:
+                expression_coeffs = np.clip(expression_coeffs, model.expression_ranges[:,0],
+                                            model.expression_ranges[:,1])
+        return coefficient_archive.arrays_to_coefficients(
+            [img_label,], subject_coeffs[np.newaxis], [expression_coeffs,], camera['rotation'][np.newaxis],
+            camera['translation'][np.newaxis], [camera['focal_length'],], camera['principal_point'][np.newaxis],
+            camera['image_size'][np.newaxis])
+
+    def pack(self, coeffs):
+        from . import coefficient_archive
+        return coefficient_archive.coefficients_to_arrays(coeffs)
+
+    def unpack(self, value):
+        from . import coefficient_archive
+        return coefficient_archive.arrays_to_coefficients(**value)
+
+
+def _spin(seconds):
+    """ keep the CPU (and the GIL) busy for the given time, simulating native fitting """
+    end_time = time.perf_counter() + seconds
+    while time.perf_counter() < end_time:
+        pass
+
+
+def synthetic_pose(image):
+    """ deterministic (yaw, pitch) in degrees for an image, derived from a subsample of its pixels """
+    digest = zlib.crc32(np.ascontiguousarray(np.asarray(image)[::16, ::16]).tobytes())
+    rng = np.random.RandomState(digest)
+    return rng.uniform(-60, 60), rng.uniform(-20, 20)
+
+
+# the synthetic face is an ellipse whose center is displaced from the image center by this
+# fraction of the image size times the sine of the yaw (horizontally) and pitch (vertically)
+_SYNTHETIC_DISPLACEMENT = 0.2
+
+
+def synthetic_dense_output(height, width, yaw_deg=0.0, pitch_deg=0.0):
+    """
+    return float32 (PNCC, offsets) maps of an ellipsoid, displaced according to yaw and pitch
+    so that SyntheticFitter can recover them
+    """
+    v, u = np.mgrid[0:height, 0:width].astype(np.float32)
+    u = (u - width * (0.5 + _SYNTHETIC_DISPLACEMENT * np.sin(np.deg2rad(yaw_deg)))) / (0.25 * width)
+    v = (v - height * (0.5 - _SYNTHETIC_DISPLACEMENT * np.sin(np.deg2rad(pitch_deg)))) / (0.3 * height)
+    depth = np.sqrt(np.maximum(1.0 - (u * u + v * v), 0))
+    mask = depth > 0
+    PNCC = np.zeros((height, width, 3), np.float32)
+    PNCC[:, :, 0] = np.where(mask, 0.5 + 0.5 * u, 0)
+    PNCC[:, :, 1] = np.where(mask, 0.5 - 0.5 * v, 0)
+    PNCC[:, :, 2] = depth
+    offsets = np.zeros((height, width, 3), np.float32)
+    offsets[:, :, 2] = 0.05 * depth
+    return PNCC, offsets
+
+
+class SyntheticDenseEstimator(DenseEstimator):
+    """
+    deterministic stand-in for the network: synthetic_dense_output of each image's synthetic_pose, after
+    sleeping seconds_per_batch plus seconds_per_image per image (releasing the GIL, as a GPU would)
+    """
+    def __init__(self, output_shape=None, seconds_per_image=0.0, seconds_per_batch=0.0):
+        self.output_shape = output_shape
+        self.seconds_per_image = seconds_per_image
+        self.seconds_per_batch = seconds_per_batch
+
+    def estimate(self, images):
+        delay = self.seconds_per_batch + self.seconds_per_image * len(images)
+        if delay > 0:
+            time.sleep(delay)
+        outputs = []
+        for image in images:
+            height, width = self.output_shape if self.output_shape is not None else np.shape(image)[0:2]
+            outputs.append(synthetic_dense_output(height, width, *synthetic_pose(image)))
+        return outputs
+
+
+class SyntheticRotation(object):
+    """ mimics vxl.vgl.rotation_3d """
+    def __init__(self, matrix):
+        self._matrix = np.array(matrix, dtype=np.float64)
+
+    def as_matrix(self):
+        return self._matrix.copy()
+
+
+class SyntheticCamera(object):
+    """ mimics face3d.perspective_camera_parameters """
+    def __init__(self, focal_len, principal_point, rotation, translation, nx, ny):
+        self.focal_len = focal_len
+        self.principal_point = principal_point
+        self.rotation = rotation
+        self.translation = translation
+        self.nx = nx
+        self.ny = ny
+
+
+class SyntheticCoefficients(object):
+    """ mimics face3d.subject_perspective_sighting_coefficients """
+    def __init__(self, image_ids, subject_coeffs, expression_coeffs, cameras):
+        self._image_ids = list(image_ids)
+        self._subject_coeffs = np.array(subject_coeffs, dtype=np.float64)
+        self._expression_coeffs = [np.array(e, dtype=np.float64) for e in expression_coeffs]
+        self._cameras = list(cameras)
+
+    @property
+    def num_sightings(self):
+        return len(self._image_ids)
+
+    def image_filename(self, i):
+        return self._image_ids[i]
+
+    def subject_coeffs(self):
+        return self._subject_coeffs.copy()
+
+    def expression_coeffs(self, i):
+        return self._expression_coeffs[i].copy()
+
+    def camera(self, i):
+        return self._cameras[i]
+
+    def save(self, fname):
+        with open(fname, 'w') as fd:
+            fd.write('subject_coeffs ' + ' '.join('%g' % c for c in self._subject_coeffs) + '\n')
+            for i in range(self.num_sightings):
+                cam = self._cameras[i]
+                fd.write('sighting %s\n' % self._image_ids[i])
+                fd.write('expression_coeffs ' + ' '.join('%g' % c for c in self._expression_coeffs[i]) + '\n')
+                fd.write('focal_len %g\n' % cam.focal_len)
+                fd.write('principal_point %g %g\n' % tuple(cam.principal_point))
+                fd.write('rotation ' + ' '.join('%g' % r for r in cam.rotation.as_matrix().ravel()) + '\n')
+                fd.write('translation %g %g %g\n' % tuple(cam.translation))
+                fd.write('image_size %d %d\n' % (cam.nx, cam.ny))
+
+
+class SyntheticFitter(Fitter):
+    """
+    deterministic stand-in for face3d, recovering the poses of SyntheticDenseEstimator outputs.
+    Subject coefficients are those of one subject plus per-image noise; fitting keeps the CPU busy for
+    seconds_per_fit (or seconds_per_warm_fit, if given, when init is given).
+    """
+    def __init__(self, seconds_per_fit=0.0, num_subject_coeffs=30, num_expression_coeffs=20, seconds_per_warm_fit=None,
+                 subject_seed=0, subject_noise=0.1):
+        self.seconds_per_fit = seconds_per_fit
+        self.seconds_per_warm_fit = seconds_per_warm_fit
+        self.num_subject_coeffs = num_subject_coeffs
+        self.num_expression_coeffs = num_expression_coeffs
+        self.subject_coeffs = np.random.RandomState(subject_seed).uniform(-1, 1, num_subject_coeffs)
+        self.subject_noise = subject_noise
+
+    def _simulate_cost(self, init):
+        seconds = self.seconds_per_fit
+        if init is not None and self.seconds_per_warm_fit is not None:
+            seconds = self.seconds_per_warm_fit
+        if seconds > 0:
+            _spin(seconds)
+
+    def fit_camera(self, PNCC, offsets, init=None):
+        with instrumentation.timer('fit_camera'):
+            self._simulate_cost(init)
+            height, width = PNCC.shape[0:2]
+            rows, cols = np.nonzero(PNCC[:, :, 2] > 0)
+            if len(rows) == 0:
+                raise RuntimeError('No face pixels in dense output')
+            sin_yaw = (np.mean(cols) / width - 0.5) / _SYNTHETIC_DISPLACEMENT
+            sin_pitch = (0.5 - np.mean(rows) / height) / _SYNTHETIC_DISPLACEMENT
+            yaw, pitch = np.rad2deg(np.arcsin(np.clip((sin_yaw, sin_pitch), -1.0, 1.0)))
+            R = compose_camera_rotation(yaw, pitch, 0.0, pitch_offset=PITCH_OFFSET)
+            focal_len = 1.2 * max(width, height)
+            return SyntheticCamera(focal_len, (width / 2.0, height / 2.0), SyntheticRotation(R),
+                                   (0.0, 0.0, 2.5 * focal_len), width, height)
+
+    def fit_coefficients(self, img_label, PNCC, offsets, init=None):
+        camera_init = init.camera(0) if init is not None else None
+        camera = self.fit_camera(PNCC, offsets, camera_init)
+        with instrumentation.timer('fit_coefficients'):
+            self._simulate_cost(init)
+            subject_noise, expression_coeffs = self._random_coeffs(PNCC)
+            subject_coeffs = self.subject_coeffs + self.subject_noise * subject_noise
+            return SyntheticCoefficients([img_label,], subject_coeffs, [expression_coeffs,], [camera,])
+
+    def fit_expression(self, img_label, PNCC, offsets, subject_coeffs, init=None):
+        camera_init = init.camera(0) if init is not None else None
+        camera = self.fit_camera(PNCC, offsets, camera_init)
+        with instrumentation.timer('fit_expression'):
+            self._simulate_cost(init)
+            _, expression_coeffs = self._random_coeffs(PNCC)
+            return SyntheticCoefficients([img_label,], subject_coeffs, [expression_coeffs,], [camera,])
+
+    def _random_coeffs(self, PNCC):
+        """ return the (deterministic) subject noise and expression coefficients of a dense output """
+        rng = np.random.RandomState(zlib.crc32(np.ascontiguousarray(PNCC[::8, ::8]).tobytes()))
+        return rng.standard_normal(self.num_subject_coeffs), rng.uniform(-1, 1, self.num_expression_coeffs)
+
+
+def _fit_head_pose(fitter, dense_output):
+    """ module-level, so that it can run in a worker process """
+    PNCC, offsets = dense_output
+    return head_pose(fitter.fit_camera(PNCC, offsets))
+
+
+def _fit_coefficients(fitter, pack, dense_output):
+    """ module-level, so that it can run in a worker process.  Returns packed coefficients if pack is True """
+    img_label, PNCC, offsets = dense_output
+    coeffs = fitter.fit_coefficients(img_label, PNCC, offsets)
+    if pack:
+        return fitter.pack(coeffs)
+    return coeffs
+
+
+def _fit_executor(num_fit_workers):
+    if num_fit_workers == 0:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(num_fit_workers)
+
+
+def estimate_head_pose_stream(img_fnames, dense_estimator, fitter, batch_size=8, num_load_threads=4,
+                              num_fit_workers=None, max_in_flight=64, load_fn=pipeline.load_image):
+    """
+    Estimate head pose for a stream of image filenames, with num_fit_workers fitting processes (0: inline).
+    Yields a pipeline.PipelineResult per image, in input order, with value = (yaw, pitch, roll) in degrees.
+    """
+    def infer(images):
+        with instrumentation.timer('network'):
+            return dense_estimator(images)
+
+    fit_executor = _fit_executor(num_fit_workers)
+    try:
+        for result in pipeline.run_pipeline(img_fnames, infer, functools.partial(_fit_head_pose, fitter),
+                                            load_fn=load_fn, batch_size=batch_size, num_load_threads=num_load_threads,
+                                            fit_executor=fit_executor, max_in_flight=max_in_flight):
+            yield result
+    finally:
+        if fit_executor is not None:
+            fit_executor.shutdown()
+
+
+def estimate_coefficients_stream(img_fnames, dense_estimator, fitter, batch_size=8, num_load_threads=4,
+                                 num_fit_workers=None, max_in_flight=64, load_fn=pipeline.load_image,
+                                 img_label_fn=None):
+    """
+    Estimate coefficients for a stream of image filenames, as estimate_head_pose_stream.
+    img_label_fn maps a filename to the coefficients' label.  Yields a pipeline.PipelineResult per image, in order.
+    """
+    if img_label_fn is None:
+        img_label_fn = lambda img_fname: img_fname
+
+    def load(img_fname):
+        return img_label_fn(img_fname), load_fn(img_fname)
+
+    def infer(inputs):
+        img_labels, images = zip(*inputs)
+        with instrumentation.timer('network'):
+            results = dense_estimator(list(images))
+        return [(img_label, PNCC, offsets) for img_label, (PNCC, offsets) in zip(img_labels, results)]
+
+    fit_executor = _fit_executor(num_fit_workers)
+    # coefficients are only packed to be sent back from worker processes
+    pack = fit_executor is not None
+    try:
+        for result in pipeline.run_pipeline(img_fnames, infer, functools.partial(_fit_coefficients, fitter, pack),
+                                            load_fn=load, batch_size=batch_size, num_load_threads=num_load_threads,
+                                            fit_executor=fit_executor, max_in_flight=max_in_flight):
+            if pack and result.error is None:
+                try:
+                    result = result._replace(value=fitter.unpack(result.value))
+                except Exception as e:
+                    result = result._replace(value=None, error=e, stage='fit')
+            yield result
+    finally:
+        if fit_executor is not None:
+            fit_executor.shutdown()
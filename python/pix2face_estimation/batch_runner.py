@@ -0,0 +1,150 @@
+"""
+Chunked batch processing over a pool of long-lived workers.
+Each worker runs an expensive initialization (e.g. loading the pix2face network and 3DMM data) once,
+then pulls chunks of work from the pool's queue until none remain.
+"""
+import os
+import time
+import functools
+import multiprocessing
+from collections import namedtuple
+from . import instrumentation
+
+
+# metrics is a snapshot of the instrumentation recorded by the worker while processing the chunk (or None)
+ChunkStats = namedtuple('ChunkStats', ['worker_id', 'load_time', 'num_items', 'num_failed', 'elapsed', 'item_results',
+                                       'metrics'])
+# output is an optional (picklable) result to be handled by the parent process, e.g. in chunk_callback
+ItemResult = namedtuple('ItemResult', ['label', 'success', 'elapsed', 'error', 'output'])
+
+
+class RunSummary(object):
+    """ Aggregates per-chunk statistics across all workers of a run """
+    def __init__(self):
+        self.worker_load_times = {}
+        self.num_items = 0
+        self.num_failed = 0
+        self.processing_time = 0.0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def add(self, stats):
+        # worker metrics are merged into this process's instrumentation
+        instrumentation.merge(stats.metrics)
+        self.worker_load_times[stats.worker_id] = stats.load_time
+        self.num_items += stats.num_items
+        self.num_failed += stats.num_failed
+        self.processing_time += stats.elapsed
+
+    def finish(self):
+        self.end_time = time.time()
+
+    @property
+    def wall_time(self):
+        end_time = time.time() if self.end_time is None else self.end_time
+        return end_time - self.start_time
+
+    @property
+    def num_workers(self):
+        return len(self.worker_load_times)
+
+    @property
+    def mean_load_time(self):
+        if self.num_workers == 0:
+            return 0.0
+        return sum(self.worker_load_times.values()) / self.num_workers
+
+    @property
+    def time_per_item(self):
+        """ mean processing time per item within a worker, excluding worker initialization """
+        if self.num_items == 0:
+            return 0.0
+        return self.processing_time / self.num_items
+
+    @property
+    def throughput(self):
+        """ items per second over the whole run, all workers combined """
+        if self.wall_time <= 0:
+            return 0.0
+        return self.num_items / self.wall_time
+
+    def report(self):
+        lines = ['Processed %d items (%d failed) in %0.1f s using %d workers' %
+                 (self.num_items, self.num_failed, self.wall_time, self.num_workers),
+                 '  Worker load time: mean %0.1f s, max %0.1f s' %
+                 (self.mean_load_time, max(self.worker_load_times.values(), default=0.0)),
+                 '  Processing: %0.3f s / item per worker, %0.2f items / s overall' %
+                 (self.time_per_item, self.throughput)]
+        return '\n'.join(lines)
+
+
+# per-process worker state, set by _initialize_worker
+_worker_state = None
+_worker_load_time = 0.0
+
+
+def _initialize_worker(init_fn, init_args):
+    global _worker_state, _worker_load_time
+    t0 = time.time()
+    _worker_state = init_fn(*init_args)
+    _worker_load_time = time.time() - t0
+
+
+def _initialize_pool_worker(init_fn, init_args):
+    # discard any metrics inherited from the parent process, so they are not reported twice
+    instrumentation.get_registry().reset()
+    _initialize_worker(init_fn, init_args)
+
+
+def _run_chunk(process_fn, chunk):
+    t0 = time.time()
+    result = process_fn(_worker_state, chunk)
+    if isinstance(result, list):
+        item_results = result
+        num_failed = sum(1 for item_result in item_results if not item_result.success)
+    else:
+        item_results = None
+        num_failed = result or 0
+    metrics = None
+    if instrumentation.is_enabled():
+        metrics = instrumentation.get_registry().snapshot(reset=True)
+    return ChunkStats(worker_id=os.getpid(), load_time=_worker_load_time, num_items=len(chunk),
+                      num_failed=num_failed, elapsed=time.time() - t0, item_results=item_results,
+                      metrics=metrics)
+
+
+def make_chunks(items, chunk_size):
+    """ split a sequence of items into a list of chunks of (at most) chunk_size items """
+    items = list(items)
+    return [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def run_chunked(items, init_fn, process_fn, init_args=(), chunk_size=128, num_workers=1,
+                pool_factory=multiprocessing.Pool, chunk_callback=None):
+    """
+    Process items in chunks over num_workers long-lived worker processes, returning a RunSummary.
+    init_fn(*init_args) creates each worker's state, and process_fn(state, chunk) (both module-level) returns the
+    number of failed items or a list of ItemResult.  chunk_callback is called in the parent with each ChunkStats.
+    """
+    chunks = make_chunks(items, chunk_size)
+    summary = RunSummary()
+    run_chunk = functools.partial(_run_chunk, process_fn)
+    if num_workers > 1:
+        pool = pool_factory(num_workers, initializer=_initialize_pool_worker, initargs=(init_fn, init_args))
+        try:
+            for stats in pool.imap_unordered(run_chunk, chunks):
+                summary.add(stats)
+                if chunk_callback is not None:
+                    chunk_callback(stats)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _initialize_worker(init_fn, init_args)
+        for chunk in chunks:
+            stats = run_chunk(chunk)
+            summary.add(stats)
+            if chunk_callback is not None:
+                chunk_callback(stats)
+    summary.finish()
+    return summary
@@ -1,6 +1,8 @@
 """ camera decomposition methods """
+import warnings
 import numpy as np
 import scipy.linalg
+from collections import namedtuple
 from . import geometry_utils
 
 
@@ -102,6 +104,135 @@ def affine_to_orthographic(K,R,T, limit_H_diagonal=True):
     return Kortho, RTortho[0:3,0:3], RTortho[0:3,3], Hortho
 
 
+def _row_dot(a, b):
+    """ dot products of corresponding rows of two (...,k) arrays """
+    return np.einsum('...i,...i->...', a, b)
+
+
+def _homogeneous_extrinsics_batch(R, T):
+    """ (N,4,4) homogeneous transformations from (N,3,3) rotations and (N,3) translations """
+    RT = np.zeros((R.shape[0],4,4))
+    RT[:,0:3,0:3] = R
+    RT[:,0:3,3] = T
+    RT[:,3,3] = 1
+    return RT
+
+
+def decompose_affine_batch(Ps, tol=1e-6):
+    """
+    decompose an (N,3,4) stack of affine projection matrices as decompose_affine, returning K, R, T and a
+    boolean (N,) mask of the cameras that recompose to within tol (the values of the others are undefined)
+    """
+    Ps = np.asarray(Ps, dtype=np.float64).reshape(-1,3,4)
+    a1 = Ps[:,0,0:3]
+    a2 = Ps[:,1,0:3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # RQ decomposition of the 2x3 matrices A, by Gram-Schmidt from the last row.
+        # The diagonal of the triangular factor is positive, as in decompose_affine.
+        r22 = np.linalg.norm(a2, axis=1)
+        q2 = a2 / r22[:,np.newaxis]
+        r12 = _row_dot(a1, q2)
+        v1 = a1 - r12[:,np.newaxis] * q2
+        r11 = np.linalg.norm(v1, axis=1)
+        q1 = v1 / r11[:,np.newaxis]
+
+        # T2 = inv(AR) * P[0:2,3], with AR upper triangular
+        ty = Ps[:,1,3] / r22
+        tx = (Ps[:,0,3] - r12 * ty) / r11
+
+    N = Ps.shape[0]
+    K = np.zeros((N,3,3))
+    K[:,0,0] = r11
+    K[:,0,1] = r12
+    K[:,1,1] = r22
+    K[:,2,2] = 1
+    R = np.stack((q1, q2, np.cross(q1, q2)), axis=1)
+    T = np.stack((tx, ty, np.zeros(N)), axis=1)
+
+    # recompose P = K*DropZ*[R | T].  Degenerate cameras hold NaN or inf values, and are flagged by the mask.
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        P2 = np.zeros((N,3,4))
+        P2[:,0:2,0:3] = np.matmul(K[:,0:2,0:2], R[:,0:2,:])
+        P2[:,0:2,3] = np.matmul(K[:,0:2,0:2], T[:,0:2,np.newaxis])[:,:,0]
+        P2[:,2,3] = 1
+        residual = np.abs(Ps - P2).reshape(N,12)
+        valid = np.all(residual <= tol, axis=1)
+
+    return K, R, T, valid
+
+
+def affine_to_orthographic_batch(K, R, T, limit_H_diagonal=True, tol=1e-6):
+    """
+    affine_to_orthographic for stacks of K (N,3,3), R (N,3,3), T (N,3), returning Kortho, R, T, H (N,4,4)
+    and a boolean (N,) mask of the cameras that recompose to within tol
+    """
+    K = np.asarray(K, dtype=np.float64).reshape(-1,3,3)
+    R = np.asarray(R, dtype=np.float64).reshape(-1,3,3)
+    T = np.asarray(T, dtype=np.float64).reshape(-1,3)
+    N = K.shape[0]
+
+    Kortho = np.zeros((N,3,3))
+    Kortho[:,0,0] = K[:,0,0]
+    Kortho[:,1,1] = K[:,0,0]
+    Kortho[:,2,2] = 1
+
+    RT = _homogeneous_extrinsics_batch(R, T)
+    RTinv = _homogeneous_extrinsics_batch(np.transpose(R, (0,2,1)),
+                                          -np.matmul(np.transpose(R, (0,2,1)), T[:,:,np.newaxis])[:,:,0])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # A = inv(K)*Kortho, so inv(A) = inv(Kortho)*K
+        Ainv = np.zeros((N,4,4))
+        Ainv[:,0:3,0:3] = K / np.diagonal(Kortho, axis1=1, axis2=2)[:,:,np.newaxis]
+        Ainv[:,3,3] = 1
+        H = np.matmul(np.matmul(RTinv, Ainv), RT)
+
+    # QR decomposition of H[0:3,0:3] by Gram-Schmidt, giving a triangular factor with positive diagonal
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h1, h2, h3 = H[:,0:3,0], H[:,0:3,1], H[:,0:3,2]
+        r11 = np.linalg.norm(h1, axis=1)
+        q1 = h1 / r11[:,np.newaxis]
+        r12 = _row_dot(q1, h2)
+        v2 = h2 - r12[:,np.newaxis] * q1
+        r22 = np.linalg.norm(v2, axis=1)
+        q2 = v2 / r22[:,np.newaxis]
+        r13 = _row_dot(q1, h3)
+        r23 = _row_dot(q2, h3)
+        v3 = h3 - r13[:,np.newaxis] * q1 - r23[:,np.newaxis] * q2
+        r33 = np.linalg.norm(v3, axis=1)
+        q3 = v3 / r33[:,np.newaxis]
+
+    H3x3Q = np.stack((q1, q2, q3), axis=2)
+    H3x3R = np.zeros((N,3,3))
+    H3x3R[:,0,0] = r11
+    H3x3R[:,1,1] = r22
+    H3x3R[:,2,2] = r33
+    if not limit_H_diagonal:
+        H3x3R[:,0,1] = r12
+        H3x3R[:,0,2] = r13
+        H3x3R[:,1,2] = r23
+
+    HQ = np.zeros((N,4,4))
+    HQ[:,0:3,0:3] = H3x3Q
+    HQ[:,0:3,3] = H[:,0:3,3]
+    HQ[:,3,3] = 1
+    Hortho = np.zeros((N,4,4))
+    Hortho[:,0:3,0:3] = H3x3R
+    Hortho[:,3,3] = 1
+
+    # verify that the decomposition gives back the original projection matrices P = K*DropZ*RT.
+    # Degenerate cameras hold NaN or inf values, and are flagged by the mask.
+    DropZ = np.zeros((3,4))
+    DropZ[0:2,0:2] = np.eye(2)
+    DropZ[2,3] = 1
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        RTortho = np.matmul(RT, HQ)
+        P = np.matmul(np.matmul(K, DropZ), RT)
+        P3 = np.matmul(np.matmul(np.matmul(Kortho, DropZ), RT), H)
+        valid = np.all(np.abs(P - P3).reshape(N,12) <= tol, axis=1)
+
+    return Kortho, RTortho[:,0:3,0:3], RTortho[:,0:3,3], Hortho, valid
+
+
 def decompose_camera_rotation(camR, pitch_offset=0):
     """ decompose rotation matrix into yaw, pitch, roll (units of degrees)
     """
@@ -126,6 +257,27 @@ def compose_camera_rotation(yaw_deg, pitch_deg, roll_deg, pitch_offset=0):
     return Rcam
 
 
+def decompose_camera_rotation_batch(camRs, pitch_offset=0):
+    """ decompose (N,3,3) camera rotation matrices into an (N,3) array of yaw, pitch, roll (units of degrees)
+    """
+    R = np.matmul(np.diag((1,-1,-1)), np.asarray(camRs, dtype=np.float64).reshape(-1,3,3))
+    euler_angles = np.rad2deg(geometry_utils.matrix_to_Euler_angles_batch(R, order='YXZ'))
+    euler_angles[:,1] += pitch_offset
+
+    return euler_angles
+
+
+def compose_camera_rotation_batch(ypr_deg, pitch_offset=0):
+    """ compose (N,3,3) camera rotation matrices from an (N,3) array of yaw, pitch, roll (units of degrees)
+    """
+    angles = np.deg2rad(np.asarray(ypr_deg, dtype=np.float64).reshape(-1,3))
+    angles[:,1] -= np.deg2rad(pitch_offset)
+    R = geometry_utils.Euler_angles_to_matrix_batch(angles, order='YXZ')
+    Rcam = np.matmul(np.diag((1,-1,-1)), R)
+
+    return Rcam
+
+
 def projection_error(camera, points_2d, points_3d):
     """ return the mean projection error over all points """
     pts_projected = camera.project_points(points_3d)
@@ -135,3 +287,46 @@ def projection_error(camera, points_2d, points_3d):
     return mean_error
 
 
+ReprojectionErrors = namedtuple('ReprojectionErrors', ['mean', 'median', 'max'])
+
+
+def project_points_batch(focal_lengths, principal_points, rotations, translations, points_3d):
+    """
+    project points_3d, (N,P,3) or (P,3), through N perspective cameras to (N,P,2) image points.
+    Points behind a camera (z <= 0) are returned as NaN.
+    """
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1,3,3)
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1,1,3)
+    points_3d = np.asarray(points_3d, dtype=np.float64)
+    # camera coordinates X_cam = R*X + T of all points at once; (P,3) points broadcast over the cameras
+    X_cam = np.matmul(points_3d, np.transpose(rotations, (0,2,1))) + translations
+    f = np.asarray(focal_lengths, dtype=np.float64).reshape(-1,1,1)
+    pp = np.asarray(principal_points, dtype=np.float64).reshape(-1,1,2)
+    z = X_cam[:,:,2:3]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return np.where(z > 0, f * X_cam[:,:,0:2] / z + pp, np.nan)
+
+
+def projection_errors_batch(focal_lengths, principal_points, rotations, translations, points_3d, points_2d,
+                            valid=None):
+    """
+    per-camera ReprojectionErrors (mean, median, max in pixels) of points_2d (N,P,2), over the points
+    in valid (N,P) that project (see project_points_batch); NaN for cameras without such points
+    """
+    projected = project_points_batch(focal_lengths, principal_points, rotations, translations, points_3d)
+    diff = projected - np.asarray(points_2d, dtype=np.float64).reshape(projected.shape)
+    error_mags = np.sqrt(np.einsum('npi,npi->np', diff, diff))
+    projects = np.all(np.isfinite(projected), axis=2)
+    if valid is None:
+        if np.all(projects):
+            return ReprojectionErrors(mean=np.mean(error_mags, axis=1), median=np.median(error_mags, axis=1),
+                                      max=np.max(error_mags, axis=1))
+        valid = projects
+    else:
+        valid = np.asarray(valid, dtype=bool).reshape(error_mags.shape) & projects
+    error_mags = np.where(valid, error_mags, np.nan)
+    with warnings.catch_warnings():
+        # cameras without valid points give NaN, with a warning from the nan reductions
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return ReprojectionErrors(mean=np.nanmean(error_mags, axis=1), median=np.nanmedian(error_mags, axis=1),
+                                  max=np.nanmax(error_mags, axis=1))
@@ -1,12 +1,19 @@
+import numpy as np
 import face3d
 import pix2face.test
 import vxl.vgl.algo
-from .camera_decomposition import decompose_camera_rotation
+from . import pipeline
+from . import backends
+from . import instrumentation
+from . import pose_tracking
+from .camera_decomposition import decompose_camera_rotation, decompose_camera_rotation_batch
 
 
 def estimate_camera(image, pix2face_net, cuda_device=0):
-    PNCC, offsets = pix2face.test.test(pix2face_net, image, cuda_device=cuda_device)
-    camera_params = face3d.compute_camera_params_from_pncc_and_offsets_perspective(PNCC, offsets)
+    with instrumentation.timer('network'):
+        PNCC, offsets = pix2face.test.test(pix2face_net, image, cuda_device=cuda_device)
+    with instrumentation.timer('fit_camera'):
+        camera_params = face3d.compute_camera_params_from_pncc_and_offsets_perspective(PNCC, offsets)
     return camera_params
 
 
@@ -15,5 +22,48 @@ def extract_head_pose(camera_params):
     return yaw, pitch, roll
 
 
+def extract_head_pose_from_rotations(rotations):
+    """ return an (N,3) array of yaw, pitch, roll (degrees) for an (N,3,3) array of camera rotation matrices """
+    return decompose_camera_rotation_batch(rotations, pitch_offset=-7)
+
+
+def extract_head_pose_batch(camera_params_list):
+    """ return an (N,3) array of yaw, pitch, roll (degrees) for a sequence of camera parameters """
+    rotations = np.array([camera_params.rotation.as_matrix() for camera_params in camera_params_list]).reshape(-1,3,3)
+    return extract_head_pose_from_rotations(rotations)
+
+
 def estimate_head_pose(image, pix2face_net, cuda_device=0):
     return extract_head_pose(estimate_camera(image, pix2face_net, cuda_device=cuda_device))
+
+
+def estimate_head_pose_stream(img_fnames, pix2face_net, cuda_device=0, batch_size=8, num_load_threads=4,
+                              num_fit_workers=None, max_in_flight=64, load_fn=pipeline.load_image, dense_fn=None,
+                              fitter=None):
+    """
+    Estimate head pose for a stream of image filenames (see backends.estimate_head_pose_stream).
+    dense_fn and fitter, if given, replace the network and face3d camera fitting.
+    """
+    if dense_fn is None:
+        dense_fn = backends.Pix2FaceDenseEstimator(pix2face_net, cuda_device)
+    if fitter is None:
+        fitter = backends.Face3dFitter()
+    return backends.estimate_head_pose_stream(img_fnames, dense_fn, fitter, batch_size=batch_size,
+                                              num_load_threads=num_load_threads, num_fit_workers=num_fit_workers,
+                                              max_in_flight=max_in_flight, load_fn=load_fn)
+
+
+def track_head_pose(frames, pix2face_net, pix2face_data=None, cuda_device=0, keyframe_interval=1, interpolate=True,
+                    **kwargs):
+    """
+    Track the head pose over the frames (images) of a video.
+    pix2face_data is needed to fit coefficients, i.e. if track_subject is True.
+    Yields a pose_tracking.FramePose per frame, in order.  See pose_tracking.PoseTracker for the other arguments.
+    """
+    if kwargs.get('track_subject', False) and pix2face_data is None:
+        raise ValueError('track_subject requires pix2face_data')
+    tracker = pose_tracking.PoseTracker(backends.Pix2FaceDenseEstimator(pix2face_net, cuda_device),
+                                        backends.Face3dFitter(pix2face_data, cuda_device),
+                                        keyframe_interval=keyframe_interval,
+                                        interpolate=interpolate, **kwargs)
+    return tracker.track(frames)
@@ -0,0 +1,359 @@
+"""
+Packed, memory-mappable storage for large numbers of estimated coefficients: a directory with one
+fixed-width binary file per column (one row per sighting), an index of record and image ids, and a JSON header
+counting the committed rows, so that an archive interrupted mid-append stays readable.
+face3d and vxl are only imported to convert to and from face3d coefficient objects.
+"""
+import os
+import json
+import numpy as np
+from . import geometry_utils
+
+
+ARCHIVE_VERSION = 1
+_HEADER_FNAME = 'archive.json'
+_INDEX_FNAME = 'index.tsv'
+
+
+def _column_specs(num_subject_coeffs, num_expression_coeffs):
+    """ return an ordered list of (column name, dtype, per-row shape) """
+    return [('subject_coeffs', np.float64, (num_subject_coeffs,)),
+            ('expression_coeffs', np.float64, (num_expression_coeffs,)),
+            ('rotation', np.float64, (3,3)),
+            ('translation', np.float64, (3,)),
+            ('focal_length', np.float64, ()),
+            ('principal_point', np.float64, (2,)),
+            ('image_size', np.int32, (2,))]
+
+
+def coefficients_to_arrays(coeffs):
+    """
+    Convert a face3d subject_perspective_sighting_coefficients object to a dictionary of column arrays,
+    with one row per sighting, suitable for CoefficientArchive.append_arrays
+    """
+    num_sightings = coeffs.num_sightings
+    subject_coeffs = np.array(coeffs.subject_coeffs(), dtype=np.float64)
+    cameras = [coeffs.camera(i) for i in range(num_sightings)]
+    return dict(image_ids=[coeffs.image_filename(i) for i in range(num_sightings)],
+                subject_coeffs=np.tile(subject_coeffs, (num_sightings, 1)),
+                expression_coeffs=np.array([coeffs.expression_coeffs(i) for i in range(num_sightings)], dtype=np.float64),
+                rotation=np.array([cam.rotation.as_matrix() for cam in cameras], dtype=np.float64).reshape(-1,3,3),
+                translation=np.array([np.array(cam.translation, dtype=np.float64) for cam in cameras]).reshape(-1,3),
+                focal_length=np.array([cam.focal_len for cam in cameras], dtype=np.float64),
+                principal_point=np.array([np.array(cam.principal_point, dtype=np.float64) for cam in cameras]).reshape(-1,2),
+                image_size=np.array([(cam.nx, cam.ny) for cam in cameras], dtype=np.int32).reshape(-1,2))
+
+
+def arrays_to_coefficients(image_ids, subject_coeffs, expression_coeffs, rotation, translation,
+                           focal_length, principal_point, image_size):
+    """
+    Construct a face3d subject_perspective_sighting_coefficients object from column arrays
+    (one row per sighting, all sharing the subject coefficients of the first row)
+    """
+    import face3d
+    import vxl.vgl
+    cameras = []
+    for i in range(len(image_ids)):
+        R = vxl.vgl.rotation_3d(geometry_utils.matrix_to_quaternion(rotation[i]))
+        T = vxl.vgl.vector_3d(*translation[i])
+        pp = vxl.vgl.point_2d(*principal_point[i])
+        cameras.append(face3d.perspective_camera_parameters(float(focal_length[i]), pp, R, T,
+                                                            int(image_size[i][0]), int(image_size[i][1])))
+    return face3d.subject_perspective_sighting_coefficients(list(image_ids), np.array(subject_coeffs[0]),
+                                                           [np.array(e) for e in expression_coeffs], cameras)
+
+
+def is_archive(path):
+    """ return True if path is a coefficient archive directory """
+    return os.path.isfile(os.path.join(path, _HEADER_FNAME))
+
+
+class CoefficientArchive(object):
+    """
+    Columnar archive of coefficients. mode is one of 'r' (read only), 'a' (append, creating if needed)
+    or 'w' (create, truncating any existing archive).  The number of subject and expression coefficients
+    must be given when creating a new archive, or are taken from the first appended record if not.
+    """
+
+    def __init__(self, archive_dir, mode='r', num_subject_coeffs=None, num_expression_coeffs=None):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError('Invalid archive mode: ' + str(mode))
+        self.archive_dir = archive_dir
+        self.mode = mode
+        self.num_rows = 0
+        self.num_subject_coeffs = num_subject_coeffs
+        self.num_expression_coeffs = num_expression_coeffs
+        self.record_ids = []
+        self.image_ids = []
+        self._image_index = None
+        self._record_index = None
+        self._columns = {}
+
+        header_fname = os.path.join(archive_dir, _HEADER_FNAME)
+        if mode == 'w' or (mode == 'a' and not os.path.exists(header_fname)):
+            os.makedirs(archive_dir, exist_ok=True)
+            for fname in os.listdir(archive_dir):
+                if fname.endswith('.bin') or fname in (_HEADER_FNAME, _INDEX_FNAME):
+                    os.remove(os.path.join(archive_dir, fname))
+            open(os.path.join(archive_dir, _INDEX_FNAME), 'w').close()
+            self._write_header()
+        else:
+            self._read_header()
+            if num_subject_coeffs is not None and num_subject_coeffs != self.num_subject_coeffs or \
+                    num_expression_coeffs is not None and num_expression_coeffs != self.num_expression_coeffs:
+                raise ValueError('Number of coefficients does not match existing archive')
+            self._read_index()
+            if mode == 'a':
+                self._truncate_to_committed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.num_rows
+
+    def close(self):
+        self._columns = {}
+
+    # ---- header and index ----
+
+    def _write_header(self):
+        header = dict(version=ARCHIVE_VERSION, num_rows=self.num_rows,
+                      num_subject_coeffs=self.num_subject_coeffs, num_expression_coeffs=self.num_expression_coeffs)
+        tmp_fname = os.path.join(self.archive_dir, _HEADER_FNAME + '.tmp')
+        with open(tmp_fname, 'w') as fd:
+            json.dump(header, fd)
+        os.replace(tmp_fname, os.path.join(self.archive_dir, _HEADER_FNAME))
+
+    def _read_header(self):
+        with open(os.path.join(self.archive_dir, _HEADER_FNAME), 'r') as fd:
+            header = json.load(fd)
+        if header['version'] != ARCHIVE_VERSION:
+            raise ValueError('Unsupported coefficient archive version: ' + str(header['version']))
+        self.num_rows = header['num_rows']
+        self.num_subject_coeffs = header['num_subject_coeffs']
+        self.num_expression_coeffs = header['num_expression_coeffs']
+
+    def _read_index(self):
+        with open(os.path.join(self.archive_dir, _INDEX_FNAME), 'r') as fd:
+            for line in fd:
+                if len(self.record_ids) == self.num_rows:
+                    break
+                record_id, image_id = line.rstrip('\n').split('\t')
+                self.record_ids.append(record_id)
+                self.image_ids.append(image_id)
+        if len(self.record_ids) != self.num_rows:
+            raise ValueError('Coefficient archive index is shorter than header: %d vs %d rows' %
+                             (len(self.record_ids), self.num_rows))
+
+    def _truncate_to_committed(self):
+        """ discard any rows written after the last header update (i.e. from an interrupted append) """
+        if self.num_subject_coeffs is None:
+            # nothing was ever committed
+            for fname in os.listdir(self.archive_dir):
+                if fname.endswith('.bin'):
+                    os.remove(os.path.join(self.archive_dir, fname))
+            open(os.path.join(self.archive_dir, _INDEX_FNAME), 'w').close()
+            return
+        for name, dtype, shape in self._specs():
+            row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+            fname = self._column_fname(name)
+            if os.path.exists(fname):
+                with open(fname, 'r+b') as fd:
+                    fd.truncate(row_bytes * self.num_rows)
+        with open(os.path.join(self.archive_dir, _INDEX_FNAME), 'w') as fd:
+            for record_id, image_id in zip(self.record_ids, self.image_ids):
+                fd.write('%s\t%s\n' % (record_id, image_id))
+
+    def _specs(self):
+        return _column_specs(self.num_subject_coeffs, self.num_expression_coeffs)
+
+    def _column_fname(self, name):
+        return os.path.join(self.archive_dir, name + '.bin')
+
+    # ---- writing ----
+
+    def append_arrays(self, record_id, image_ids, **columns):
+        """
+        Append rows for one record (all sightings of one coefficients object).
+        columns are the arrays returned by coefficients_to_arrays (excluding image_ids).
+        """
+        self.append_many([(record_id, image_ids, columns)])
+
+    def append(self, record_id, coeffs):
+        """ append all sightings of a face3d coefficients object under record_id """
+        columns = coefficients_to_arrays(coeffs)
+        image_ids = columns.pop('image_ids')
+        self.append_arrays(record_id, image_ids, **columns)
+
+    def append_many(self, records):
+        """
+        Append a sequence of (record_id, image_ids, columns) tuples, committing them with a single header update
+        """
+        if self.mode == 'r':
+            raise IOError('Coefficient archive opened read-only')
+        records = list(records)
+        if len(records) == 0:
+            return
+        if self.num_subject_coeffs is None:
+            _, _, columns = records[0]
+            self.num_subject_coeffs = np.shape(columns['subject_coeffs'])[-1]
+            self.num_expression_coeffs = np.shape(columns['expression_coeffs'])[-1]
+
+        new_record_ids = []
+        new_image_ids = []
+        stacked = {}
+        for name, dtype, shape in self._specs():
+            arrays = []
+            for record_id, image_ids, columns in records:
+                arr = np.asarray(columns[name], dtype=dtype).reshape((len(image_ids),) + shape)
+                arrays.append(arr)
+            stacked[name] = np.concatenate(arrays, axis=0)
+        for record_id, image_ids, _ in records:
+            for image_id in image_ids:
+                if '\t' in record_id or '\n' in record_id or '\t' in image_id or '\n' in image_id:
+                    raise ValueError('Record and image ids may not contain tabs or newlines')
+                new_record_ids.append(record_id)
+                new_image_ids.append(image_id)
+
+        # the columns and index are written first; the rows are only committed by the header update
+        for name, _, _ in self._specs():
+            with open(self._column_fname(name), 'ab') as fd:
+                fd.write(np.ascontiguousarray(stacked[name]).tobytes())
+        with open(os.path.join(self.archive_dir, _INDEX_FNAME), 'a') as fd:
+            for record_id, image_id in zip(new_record_ids, new_image_ids):
+                fd.write('%s\t%s\n' % (record_id, image_id))
+
+        first_new_row = self.num_rows
+        self.num_rows += len(new_image_ids)
+        self.record_ids.extend(new_record_ids)
+        self.image_ids.extend(new_image_ids)
+        self._write_header()
+        # invalidate memory maps and update indices
+        self._columns = {}
+        if self._image_index is not None:
+            for row, image_id in enumerate(new_image_ids, first_new_row):
+                self._image_index.setdefault(image_id, row)
+        if self._record_index is not None:
+            for row, record_id in enumerate(new_record_ids, first_new_row):
+                self._record_index.setdefault(record_id, []).append(row)
+
+    # ---- reading ----
+
+    def column(self, name):
+        """ return the named column as a read-only memory-mapped array with one row per sighting """
+        if name not in self._columns:
+            specs = dict((spec[0], spec[1:]) for spec in self._specs())
+            if name not in specs:
+                raise KeyError('Unknown coefficient archive column: ' + str(name))
+            dtype, shape = specs[name]
+            if self.num_rows == 0:
+                self._columns[name] = np.zeros((0,) + shape, dtype)
+            else:
+                self._columns[name] = np.memmap(self._column_fname(name), dtype=dtype, mode='r',
+                                                shape=(self.num_rows,) + shape)
+        return self._columns[name]
+
+    @property
+    def subject_coeffs(self):
+        return self.column('subject_coeffs')
+
+    @property
+    def expression_coeffs(self):
+        return self.column('expression_coeffs')
+
+    @property
+    def rotations(self):
+        return self.column('rotation')
+
+    @property
+    def translations(self):
+        return self.column('translation')
+
+    @property
+    def focal_lengths(self):
+        return self.column('focal_length')
+
+    @property
+    def principal_points(self):
+        return self.column('principal_point')
+
+    @property
+    def image_sizes(self):
+        return self.column('image_size')
+
+    def row_of(self, image_id):
+        """ return the row index of image_id (the first, if it appears more than once) """
+        if self._image_index is None:
+            self._image_index = {}
+            for row, iid in enumerate(self.image_ids):
+                self._image_index.setdefault(iid, row)
+        return self._image_index[image_id]
+
+    def rows_of_record(self, record_id):
+        """ return the list of row indices belonging to record_id """
+        if self._record_index is None:
+            self._record_index = {}
+            for row, rid in enumerate(self.record_ids):
+                self._record_index.setdefault(rid, []).append(row)
+        return self._record_index[record_id]
+
+    def get(self, image_id):
+        """ return a dictionary of column values for the sighting of image_id """
+        row = self.row_of(image_id)
+        values = dict((name, np.array(self.column(name)[row])) for name, _, _ in self._specs())
+        values['record_id'] = self.record_ids[row]
+        values['image_id'] = image_id
+        return values
+
+    def record_ids_unique(self):
+        """ return the list of distinct record ids, in order of first appearance """
+        seen = set()
+        return [rid for rid in self.record_ids if not (rid in seen or seen.add(rid))]
+
+    def to_coefficients(self, record_id):
+        """ return the face3d coefficients object for record_id """
+        rows = self.rows_of_record(record_id)
+        columns = dict((name, self.column(name)[rows]) for name, _, _ in self._specs())
+        return arrays_to_coefficients([self.image_ids[row] for row in rows], **columns)
+
+
+def import_text_files(coeff_fnames, archive, record_id_fn=None, flush_every=1024):
+    """
+    Append the coefficients stored in the text files coeff_fnames to an open archive.
+    record_id_fn maps a filename to a record id (default: the file's basename without extension)
+    Returns the number of files imported.
+    """
+    import face3d
+    if record_id_fn is None:
+        def record_id_fn(fname):
+            return os.path.splitext(os.path.basename(fname))[0]
+    pending = []
+    num_imported = 0
+    for coeff_fname in coeff_fnames:
+        columns = coefficients_to_arrays(face3d.subject_perspective_sighting_coefficients(coeff_fname))
+        image_ids = columns.pop('image_ids')
+        pending.append((record_id_fn(coeff_fname), image_ids, columns))
+        if len(pending) >= flush_every:
+            archive.append_many(pending)
+            num_imported += len(pending)
+            pending = []
+    archive.append_many(pending)
+    num_imported += len(pending)
+    return num_imported
+
+
+def export_text_files(archive, output_dir, suffix='.txt'):
+    """
+    Write each record of the archive to output_dir as a text coefficients file named <record_id><suffix>.
+    Returns the list of filenames written.
+    """
+    output_fnames = []
+    for record_id in archive.record_ids_unique():
+        output_fname = os.path.join(output_dir, record_id + suffix)
+        archive.to_coefficients(record_id).save(output_fname)
+        output_fnames.append(output_fname)
+    return output_fnames
@@ -2,6 +2,7 @@
 3-D Morphable Model (3DMM) coefficient estimation using the pix2face network
 """
 import os
+import threading
 from collections import namedtuple
 import numpy as np
 import vxl
@@ -9,37 +10,86 @@ import vxl.vnl
 import face3d
 import pix2face.test
 from . import mesh_renderer
+from . import mesh_cache
+from . import pipeline
+from . import backends
+from . import instrumentation
 
 
-Pix2FaceData = namedtuple('Pix2FaceData',['head_mesh','subject_components','expression_components','subject_ranges','expression_ranges', 'coeff_estimator', 'use_offsets'])
+Pix2FaceData = namedtuple('Pix2FaceData',['head_mesh','subject_components','expression_components','subject_ranges','expression_ranges', 'coeff_estimator', 'use_offsets',
+                                           'pvr_data_dir', 'subject_components_array', 'expression_components_array'])
 
 
-def load_pix2face_data(pvr_data_dir=None, num_subject_coeffs=None, num_expression_coeffs=None, use_offsets_for_estimation=True):
+# process-wide cache of loaded Pix2FaceData, keyed by (pvr_data_dir, num_subject_coeffs, num_expression_coeffs, use_offsets)
+_pix2face_data_cache = {}
+_pix2face_data_cache_lock = threading.Lock()
+
+
+def default_pvr_data_dir():
+    """ return the default location of the 3DMM data files """
+    this_dir = os.path.dirname(__file__)
+    return os.path.abspath(os.path.join(this_dir, '../../face3d/data_3DMM'))
+
+
+def load_pca_arrays(pvr_data_dir, mmap=True):
+    """ load (subject_components, expression_components, subject_ranges, expression_ranges) as numpy arrays,
+    with the components memory-mapped read-only if mmap is True """
+    mmap_mode = 'r' if mmap else None
+    subject_components = np.load(os.path.join(pvr_data_dir, 'pca_components_subject.npy'), mmap_mode=mmap_mode)
+    expression_components = np.load(os.path.join(pvr_data_dir, 'pca_components_expression.npy'), mmap_mode=mmap_mode)
+    subject_ranges = np.load(os.path.join(pvr_data_dir,'pca_coeff_ranges_subject.npy'))
+    expression_ranges = np.load(os.path.join(pvr_data_dir,'pca_coeff_ranges_expression.npy'))
+    return subject_components, expression_components, subject_ranges, expression_ranges
+
+
+def load_pix2face_data(pvr_data_dir=None, num_subject_coeffs=None, num_expression_coeffs=None, use_offsets_for_estimation=True, use_cache=True):
     """
     Load PCA components and ranges.
     Returns a structure containing the following  matrices loaded as instances of vxl.vnl_matrix
+    The data is cached per process unless use_cache is False; this saves load time, not memory.
     """
     if pvr_data_dir is None:
         # guess the pvr_data_dir
-        this_dir = os.path.dirname(__file__)
-        pvr_data_dir = os.path.join(this_dir, '../../face3d/data_3DMM')
+        pvr_data_dir = default_pvr_data_dir()
+    pvr_data_dir = os.path.abspath(pvr_data_dir)
+
+    if not use_cache:
+        return _load_pix2face_data(pvr_data_dir, num_subject_coeffs, num_expression_coeffs, use_offsets_for_estimation)
+
+    cache_key = (pvr_data_dir, num_subject_coeffs, num_expression_coeffs, use_offsets_for_estimation)
+    with _pix2face_data_cache_lock:
+        data = _pix2face_data_cache.get(cache_key)
+        if data is None:
+            data = _load_pix2face_data(pvr_data_dir, num_subject_coeffs, num_expression_coeffs, use_offsets_for_estimation)
+            _pix2face_data_cache[cache_key] = data
+    return data
+
 
+def clear_pix2face_data_cache():
+    """ remove all cached Pix2FaceData instances """
+    with _pix2face_data_cache_lock:
+        _pix2face_data_cache.clear()
+
+
+def _load_pix2face_data(pvr_data_dir, num_subject_coeffs, num_expression_coeffs, use_offsets_for_estimation):
+    """ load the data files and construct the coefficient estimator (uncached) """
     # load data files as numpy arrays
     head_mesh = face3d.head_mesh(pvr_data_dir)
-    subject_components = np.load(os.path.join(pvr_data_dir, 'pca_components_subject.npy'))
-    expression_components = np.load(os.path.join(pvr_data_dir, 'pca_components_expression.npy'))
-    subject_ranges = np.load(os.path.join(pvr_data_dir,'pca_coeff_ranges_subject.npy'))
-    expression_ranges = np.load(os.path.join(pvr_data_dir,'pca_coeff_ranges_expression.npy'))
+    subject_components_array, expression_components_array, subject_ranges, expression_ranges = load_pca_arrays(pvr_data_dir)
 
     if num_subject_coeffs is None:
-        num_subject_coeffs = subject_components.shape[0]
+        num_subject_coeffs = subject_components_array.shape[0]
     if num_expression_coeffs is None:
-        num_expression_coeffs = expression_components.shape[0]
+        num_expression_coeffs = expression_components_array.shape[0]
+
+    # keep only needed rows of subject and expression matrices
+    subject_components_array = subject_components_array[0:num_subject_coeffs,:]
+    expression_components_array = expression_components_array[0:num_expression_coeffs,:]
 
-    # keep only needed rows of subject and expression matrices and convert to vnl matrices
-    subject_components = vxl.vnl.matrix(subject_components[0:num_subject_coeffs,:])
+    # convert to vnl matrices (copies, since vnl owns its storage)
+    subject_components = vxl.vnl.matrix(np.ascontiguousarray(subject_components_array))
     subject_ranges = vxl.vnl.matrix(subject_ranges[0:num_subject_coeffs,:])
-    expression_components = vxl.vnl.matrix(expression_components[0:num_expression_coeffs,:])
+    expression_components = vxl.vnl.matrix(np.ascontiguousarray(expression_components_array))
     expression_ranges = vxl.vnl.matrix(expression_ranges[0:num_expression_coeffs,:])
 
     debug_mode = False
@@ -63,7 +113,10 @@ def load_pix2face_data(pvr_data_dir=None, num_subject_coeffs=None, num_expressio
                         subject_components=subject_components, subject_ranges=subject_ranges,
                         expression_components=expression_components, expression_ranges=expression_ranges,
                         coeff_estimator=coeff_estimator,
-                        use_offsets=use_offsets_for_estimation)
+                        use_offsets=use_offsets_for_estimation,
+                        pvr_data_dir=pvr_data_dir,
+                        subject_components_array=subject_components_array,
+                        expression_components_array=expression_components_array)
 
 
 class CoefficientEstimationError(RuntimeError):
@@ -75,7 +128,8 @@ def estimate_coefficients(image, pix2face_net, pix2face_data, cuda_device=0, img
     """
     Estimate shape, expression, and camera parameters for a single image
     """
-    PNCC, offsets = pix2face.test.test(pix2face_net, image, cuda_device=cuda_device)
+    with instrumentation.timer('network'):
+        PNCC, offsets = pix2face.test.test(pix2face_net, image, cuda_device=cuda_device)
 
     if cuda_device is not None:
         print("Setting face3d cuda_device to", cuda_device)
@@ -86,7 +140,8 @@ def estimate_coefficients(image, pix2face_net, pix2face_data, cuda_device=0, img
     est_args = [[PNCC,],]
     if pix2face_data.use_offsets:
         est_args.append([offsets,])
-    coeffs, result = pix2face_data.coeff_estimator.estimate_coefficients_perspective([img_label], *est_args)
+    with instrumentation.timer('fit_coefficients'):
+        coeffs, result = pix2face_data.coeff_estimator.estimate_coefficients_perspective([img_label], *est_args)
     if not result.success:
         raise CoefficientEstimationError("Coefficient Estimation Failed")
     return coeffs
@@ -96,8 +151,10 @@ def estimate_coefficients_joint(images, pix2face_net, pix2face_data, cuda_device
     """
     Estimate coefficients for multiple images.  A single set of subject coefficients
     will be estimated, and results returned in a single object.
+    See add_to_subject_model to add images of a subject over time, without refitting previous images.
     """
-    results = pix2face.test.test(pix2face_net, images, cuda_device=cuda_device)
+    with instrumentation.timer('network'):
+        results = pix2face.test.test(pix2face_net, images, cuda_device=cuda_device)
     PNCCs, offsets = zip(*results)
     if img_labels is None:
         img_labels = ['img%d' % i for i in range(len(images))]
@@ -109,18 +166,44 @@ def estimate_coefficients_joint(images, pix2face_net, pix2face_data, cuda_device
     est_args = [PNCCs,]
     if pix2face_data.use_offsets:
         est_args.append(offsets,)
-    coeffs, result = pix2face_data.coeff_estimator.estimate_coefficients_perspective(img_labels, *est_args)
+    with instrumentation.timer('fit_coefficients_joint'):
+        coeffs, result = pix2face_data.coeff_estimator.estimate_coefficients_perspective(img_labels, *est_args)
     if not result.success:
         raise CoefficientEstimationError("Coefficient Estimation Failed")
     return coeffs
 
 
+def add_to_subject_model(subject_model, images, pix2face_net, cuda_device=0, img_labels=None):
+    """
+    Add images of a subject to a subject_model.IncrementalSubjectModel, updating the joint estimate of the
+    subject coefficients.  Only the new images are run through the network and fit.
+    Returns the indices of the new sightings in the model.
+    """
+    with instrumentation.timer('network'):
+        results = pix2face.test.test(pix2face_net, images, cuda_device=cuda_device)
+    if img_labels is None:
+        img_labels = ['img%d' % i for i in range(len(subject_model), len(subject_model) + len(images))]
+    assert len(img_labels) == len(images)
+
+    if cuda_device is not None:
+        face3d.set_cuda_device(cuda_device)
+
+    indices = []
+    for (PNCC, offsets), img_label in zip(results, img_labels):
+        with instrumentation.timer('fit_camera'):
+            camera = face3d.compute_camera_params_from_pncc_and_offsets_perspective(PNCC, offsets)
+        indices.append(subject_model.add_sighting(img_label, PNCC, offsets, camera))
+    return indices
+
+
 def estimate_coefficients_batch(images, pix2face_net, pix2face_data, cuda_device=0, img_labels=None):
     """
     Estimate coefficients for multiple images, independently.
     One coeffs object per image will be returned.  If coeff estimation fails, None will be inserted into the list of coefficients.
+    See estimate_coefficients_stream for a version overlapping the network with fitting.
     """
-    results = pix2face.test.test(pix2face_net, images, cuda_device=cuda_device)
+    with instrumentation.timer('network'):
+        results = pix2face.test.test(pix2face_net, images, cuda_device=cuda_device)
     coeffs_list = []
 
     if img_labels is None:
@@ -131,37 +214,58 @@ def estimate_coefficients_batch(images, pix2face_net, pix2face_data, cuda_device
         face3d.set_cuda_device(cuda_device)
 
     for (PNCC, offsets), img_label in zip(results, img_labels):
-
-        est_args = [[PNCC,],]
-        if pix2face_data.use_offsets:
-            est_args.append([offsets,])
-        coeffs, result = pix2face_data.coeff_estimator.estimate_coefficients_perspective([img_label,], *est_args)
-        if not result.success:
+        try:
+            coeffs_list.append(_fit_coefficients(pix2face_data, img_label, PNCC, offsets))
+        except CoefficientEstimationError:
             coeffs_list.append(None)
-        else:
-            coeffs_list.append(coeffs)
     return coeffs_list
 
 
-def render_coefficients(coeffs, pix2face_data, img_idx=0):
+def _fit_coefficients(pix2face_data, img_label, PNCC, offsets):
+    """ estimate the coefficients of a single image from the network output """
+    est_args = [[PNCC,],]
+    if pix2face_data.use_offsets:
+        est_args.append([offsets,])
+    with instrumentation.timer('fit_coefficients'):
+        coeffs, result = pix2face_data.coeff_estimator.estimate_coefficients_perspective([img_label,], *est_args)
+    if not result.success:
+        raise CoefficientEstimationError("Coefficient Estimation Failed")
+    return coeffs
+
+
+def estimate_coefficients_stream(img_fnames, pix2face_net, pix2face_data, cuda_device=0, batch_size=8,
+                                 num_load_threads=4, num_fit_workers=None, max_in_flight=64,
+                                 load_fn=pipeline.load_image, img_label_fn=None, dense_fn=None, fitter=None):
+    """
+    Estimate coefficients for a stream of image filenames, independently, with the network and
+    num_fit_workers fitting processes (0: inline) running concurrently.  dense_fn and fitter, if given, replace the
+    network and face3d.  Yields a pipeline.PipelineResult per image, in input order.
+    """
+    if dense_fn is None:
+        dense_fn = backends.Pix2FaceDenseEstimator(pix2face_net, cuda_device)
+    if fitter is None:
+        fitter = backends.Face3dFitter(pix2face_data, cuda_device)
+    return backends.estimate_coefficients_stream(img_fnames, dense_fn, fitter, batch_size=batch_size,
+                                                 num_load_threads=num_load_threads, num_fit_workers=num_fit_workers,
+                                                 max_in_flight=max_in_flight, load_fn=load_fn,
+                                                 img_label_fn=img_label_fn)
+
+
+def render_coefficients(coeffs, pix2face_data, img_idx=0, texture_res=64):
     """
     Returns an image of the face described by coeffs
     pix2face_data should be created by calling load_pix2face_data
+    texture_res is not important as this will be a solid color texture
     """
-    # lazily create renderer (of which there should only be one.)
-    renderer = mesh_renderer.get_mesh_renderer()
-
-    texture_res = 64  # resolution not important as this will be a solid color texture
     green_tex = np.zeros((texture_res,texture_res,3), np.uint8)
     green_tex[:,:,1] = 255
-    head_mesh_warped = face3d.head_mesh(pix2face_data.head_mesh)
-    head_mesh_warped.apply_coefficients(pix2face_data.subject_components,
-                                        pix2face_data.expression_components,
-                                        coeffs.subject_coeffs(),
-                                        coeffs.expression_coeffs(img_idx))
+    # the texture is set on a copy, since cached meshes are shared with other callers and threads
+    head_mesh_warped = mesh_cache.warped_head_mesh_copy(pix2face_data, coeffs.subject_coeffs(), coeffs.expression_coeffs(img_idx))
     meshes = head_mesh_warped.meshes()
     for mesh in meshes:
         mesh.set_texture(green_tex)
-    renderer.set_ambient_weight(0.5)
-    synth = renderer.render(meshes, coeffs.camera(img_idx))
+    # check out a renderer from the (lazily created) pool, so that multiple threads may render at once
+    with mesh_renderer.renderer() as renderer, instrumentation.timer('render'):
+        renderer.set_ambient_weight(0.5)
+        synth = renderer.render(meshes, coeffs.camera(img_idx))
     return synth
@@ -0,0 +1,296 @@
+"""
+Writers for the dense outputs of the pix2face network (PNCC, offsets, and the 3D image), as TIFFs or
+NPZ shards of float32, float16 or int16 quantized to [-max_abs_value, max_abs_value] (error <= max_abs_value / 65534),
+optionally on a background thread.  pop_completed() reports which images have reached the disk.
+"""
+import os
+import queue
+import warnings
+import threading
+import collections
+import numpy as np
+from . import instrumentation
+
+
+CHANNELS = ('PNCC', 'offsets', '3d')
+DTYPES = ('float32', 'float16', 'int16')
+
+_INT16_MAX = 32767
+
+
+def compute_channel(name, PNCC, offsets):
+    """ return the named channel computed from the network outputs """
+    if name == 'PNCC':
+        return PNCC
+    elif name == 'offsets':
+        return offsets
+    elif name == '3d':
+        return PNCC + offsets
+    raise ValueError('Unknown dense output channel: ' + str(name))
+
+
+def encode(values, dtype='float32', max_abs_value=1.0):
+    """ convert a float array to the storage dtype.  Values outside the quantization range are clipped. """
+    if dtype == 'float32':
+        return np.asarray(values, dtype=np.float32)
+    elif dtype == 'float16':
+        return np.asarray(values, dtype=np.float16)
+    elif dtype == 'int16':
+        scale = _INT16_MAX / float(max_abs_value)
+        return np.round(np.clip(values, -max_abs_value, max_abs_value) * scale).astype(np.int16)
+    raise ValueError('Unknown dense output dtype: ' + str(dtype))
+
+
+def decode(values, dtype='float32', max_abs_value=1.0):
+    """ convert stored values back to float32 """
+    if dtype == 'int16':
+        return values.astype(np.float32) * (float(max_abs_value) / _INT16_MAX)
+    return np.asarray(values, dtype=np.float32)
+
+
+def channel_max_abs_value(max_abs_value, channel):
+    """ return the quantization range of channel, given a single range or a dictionary of ranges per channel """
+    if isinstance(max_abs_value, dict):
+        if channel not in max_abs_value:
+            raise ValueError('No max_abs_value given for dense output channel: ' + str(channel))
+        return max_abs_value[channel]
+    return max_abs_value
+
+
+def max_error(dtype='float32', max_abs_value=1.0):
+    """ return the bound on the absolute storage error for values with magnitude up to max_abs_value """
+    if dtype == 'float32':
+        return max_abs_value * 2.0**-24
+    elif dtype == 'float16':
+        return max_abs_value * 2.0**-11
+    elif dtype == 'int16':
+        return 0.5 * max_abs_value / _INT16_MAX
+    raise ValueError('Unknown dense output dtype: ' + str(dtype))
+
+
+class DenseOutputWriter(object):
+    """
+    Base class for dense output writers.
+    Subclasses implement _write_arrays(basename, arrays), where arrays maps channel name to encoded array,
+    and call _record(basenames, error) once the outputs of images are on disk (error None) or have failed.
+    """
+    def __init__(self, output_dir, channels=('PNCC', 'offsets'), dtype='float32', max_abs_value=1.0):
+        for channel in channels:
+            if channel not in CHANNELS:
+                raise ValueError('Unknown dense output channel: ' + str(channel))
+            channel_max_abs_value(max_abs_value, channel)
+        if dtype not in DTYPES:
+            raise ValueError('Unknown dense output dtype: ' + str(dtype))
+        self.output_dir = output_dir
+        self.channels = tuple(channels)
+        self.dtype = dtype
+        self.max_abs_value = max_abs_value
+        self._completed = []
+        self._clipped_channels = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, basename, PNCC, offsets):
+        """ write the selected channels for the image identified by basename """
+        with instrumentation.timer('write_output'):
+            try:
+                arrays = dict((channel, self._encode(channel, compute_channel(channel, PNCC, offsets)))
+                              for channel in self.channels)
+            except Exception as e:
+                self._record([basename,], e)
+                raise
+            self._write_arrays(basename, arrays)
+
+    def _encode(self, channel, values):
+        max_abs_value = channel_max_abs_value(self.max_abs_value, channel)
+        if self.dtype == 'int16' and channel not in self._clipped_channels and np.max(np.abs(values)) > max_abs_value:
+            self._clipped_channels.add(channel)
+            warnings.warn('Values of dense output channel %s exceed max_abs_value %g and are clipped' %
+                          (channel, max_abs_value))
+        return encode(values, self.dtype, max_abs_value)
+
+    def _write_arrays(self, basename, arrays):
+        raise NotImplementedError()
+
+    def _record(self, basenames, error=None):
+        self._completed.extend((basename, error) for basename in basenames)
+
+    def pop_completed(self):
+        """
+        return a list of (basename, error) for the images whose outputs were written to disk (error None)
+        or failed since the last call
+        """
+        completed, self._completed = self._completed, []
+        return completed
+
+    def close(self):
+        pass
+
+
+class TiffWriter(DenseOutputWriter):
+    """ writes one (optionally compressed) TIFF per image and channel: <output_dir>/<basename>_<channel>.tiff """
+    def __init__(self, output_dir, channels=('PNCC', 'offsets'), dtype='float32', max_abs_value=1.0, compress=0):
+        super(TiffWriter, self).__init__(output_dir, channels, dtype, max_abs_value)
+        import tifffile
+        self.tifffile = tifffile
+        self.compress = compress
+
+    def _write_arrays(self, basename, arrays):
+        try:
+            for channel, arr in arrays.items():
+                output_fname = os.path.join(self.output_dir, '%s_%s.tiff' % (basename, channel))
+                # (H,W,3) maps are stored as contiguous RGB samples, as by earlier versions of tifffile
+                kwargs = dict(photometric='rgb') if arr.ndim == 3 and arr.shape[2] == 3 else {}
+                if self.compress:
+                    kwargs.update(compression='zlib', compressionargs={'level': self.compress})
+                self.tifffile.imwrite(output_fname, arr, **kwargs)
+        except Exception as e:
+            self._record([basename,], e)
+            raise
+        self._record([basename,])
+
+
+class NpzShardWriter(DenseOutputWriter):
+    """
+    Packs the outputs of shard_size images into each compressed <output_dir>/<prefix>_<shard index>.npz, with
+    arrays '<basename>/<channel>' and the 'dtype' and 'max_abs_value/<channel>' needed to decode them.
+    """
+    def __init__(self, output_dir, channels=('PNCC', 'offsets'), dtype='float32', max_abs_value=1.0,
+                 shard_size=256, prefix='dense', compress=True):
+        super(NpzShardWriter, self).__init__(output_dir, channels, dtype, max_abs_value)
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.compress = compress
+        self.shard_index = 0
+        self._shard = {}
+        self._shard_basenames = []
+
+    def _write_arrays(self, basename, arrays):
+        for channel, arr in arrays.items():
+            self._shard['%s/%s' % (basename, channel)] = arr
+        self._shard_basenames.append(basename)
+        if len(self._shard_basenames) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """ write the current (possibly partial) shard to disk """
+        if len(self._shard_basenames) == 0:
+            return
+        output_fname = os.path.join(self.output_dir, '%s_%05d.npz' % (self.prefix, self.shard_index))
+        save = np.savez_compressed if self.compress else np.savez
+        ranges = dict(('max_abs_value/%s' % channel, np.array(channel_max_abs_value(self.max_abs_value, channel)))
+                      for channel in self.channels)
+        shard, basenames = self._shard, self._shard_basenames
+        self._shard = {}
+        self._shard_basenames = []
+        try:
+            save(output_fname, dtype=np.array(self.dtype), **dict(ranges, **shard))
+        except Exception as e:
+            self._record(basenames, e)
+            raise
+        self.shard_index += 1
+        self._record(basenames)
+
+    def close(self):
+        self.flush()
+
+
+def read_npz_shard(shard_fname):
+    """ return a dictionary mapping basename to a dictionary of decoded (float32) channels """
+    outputs = {}
+    with np.load(shard_fname) as shard:
+        dtype = str(shard['dtype'])
+        for key in shard.files:
+            if '/' not in key or key.startswith('max_abs_value/'):
+                continue
+            basename, channel = key.rsplit('/', 1)
+            range_key = 'max_abs_value/' + channel
+            # shards written before ranges were stored per channel hold a single max_abs_value
+            max_abs_value = float(shard[range_key] if range_key in shard.files else shard['max_abs_value'])
+            outputs.setdefault(basename, {})[channel] = decode(shard[key], dtype, max_abs_value)
+    return outputs
+
+
+class BackgroundWriter(object):
+    """
+    Wraps a DenseOutputWriter so that encoding and writing happen on a background thread, with at most
+    max_pending images queued.  If raise_errors is True, the first error is re-raised by write() or close().
+    """
+    def __init__(self, writer, max_pending=16, raise_errors=True):
+        self.writer = writer
+        self.raise_errors = raise_errors
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._completed = collections.deque()
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self.writer.write(*item)
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            self._completed.extend(self.writer.pop_completed())
+
+    def _check_error(self):
+        if self.raise_errors and self._error is not None:
+            raise self._error
+
+    def write(self, basename, PNCC, offsets):
+        self._check_error()
+        self._queue.put((basename, PNCC, offsets))
+
+    def pop_completed(self):
+        """ return a list of (basename, error) for the images written (error None) or failed since the last call """
+        completed = []
+        while len(self._completed) > 0:
+            completed.append(self._completed.popleft())
+        return completed
+
+    def close(self):
+        """ write all queued images (see pop_completed for their outcomes) """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            try:
+                self.writer.close()
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            self._completed.extend(self.writer.pop_completed())
+        self._check_error()
+
+
+def create_writer(output_dir, output_format='tiff', channels=('PNCC', 'offsets'), dtype='float32',
+                  max_abs_value=1.0, background=True, raise_errors=True, **kwargs):
+    """
+    Create a dense output writer. output_format is 'tiff' or 'npz'.
+    Extra keyword arguments are passed to the writer class.
+    If background is True, the writer is wrapped in a BackgroundWriter (with raise_errors).
+    """
+    if output_format == 'tiff':
+        writer = TiffWriter(output_dir, channels, dtype, max_abs_value, **kwargs)
+    elif output_format == 'npz':
+        writer = NpzShardWriter(output_dir, channels, dtype, max_abs_value, **kwargs)
+    else:
+        raise ValueError('Unknown dense output format: ' + str(output_format))
+    if background:
+        return BackgroundWriter(writer, raise_errors=raise_errors)
+    return writer
@@ -206,3 +206,189 @@ def matrix_to_Euler_angles(M, order='XYZ'):
     """ Convert a rotation matrix to Euler angles. Angles are returned in the order of application.
     """
     return quaternion_to_Euler_angles(matrix_to_quaternion(M),order=order)
+
+
+# Batch variants of the conversions above.  These operate on stacks of rotations
+# in a single numpy pass: quaternions are (N,4) arrays in (x,y,z,w) order,
+# rotation matrices are (N,3,3) arrays, and Euler angles are (N,3) arrays
+# in order of application.
+
+def _axis_index(axis_string):
+    """ return the column index (0,1,2) of axis 'X','Y', or 'Z' """
+    if axis_string not in ('X', 'Y', 'Z'):
+        raise Exception('Expecting one of [X,Y,Z], got ' + axis_string)
+    return 'XYZ'.index(axis_string)
+
+
+def axis_angle_to_quaternion_batch(axes, thetas):
+    """ Convert (N,3) rotation axes and (N,) angles to (N,4) quaternions """
+    axes = np.asarray(axes, dtype=np.float64)
+    thetas = np.asarray(thetas, dtype=np.float64)
+    axes_u = axes / np.linalg.norm(axes, axis=1, keepdims=True)
+    q = np.empty((axes.shape[0], 4))
+    q[:,0:3] = axes_u * np.sin(thetas/2.0)[:,np.newaxis]
+    q[:,3] = np.cos(thetas/2.0)
+    return q
+
+
+def compose_quaternions_batch(quaternion_list):
+    """ return the element-wise composition of a list of (N,4) quaternion arrays (the (1,4) identity if empty)
+    """
+    qtotal = None
+    for q in quaternion_list:
+        q2 = np.asarray(q, dtype=np.float64)
+        if qtotal is None:
+            qtotal = q2.copy()
+            continue
+        q1 = qtotal
+        qtotal = np.empty(np.broadcast(q1, q2).shape)
+        qtotal[...,3] = q1[...,3]*q2[...,3] - np.sum(q1[...,0:3]*q2[...,0:3], axis=-1)
+        qtotal[...,0:3] = np.cross(q1[...,0:3], q2[...,0:3]) + \
+            q2[...,0:3]*q1[...,3:4] + q1[...,0:3]*q2[...,3:4]
+    if qtotal is None:
+        return np.array(((0.0, 0.0, 0.0, 1.0),))
+    return qtotal
+
+
+def Euler_angles_to_quaternion_batch(angles, order='XYZ'):
+    """ Convert (N,3) Euler angles to (N,4) quaternions.
+        Angles are specified in the order of application.
+    """
+    if not axis_order_is_valid(order):
+        raise Exception('Invalid order string: ' + str(order))
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1, 3)
+    quats = []
+    for i in range(3):
+        q = np.zeros((angles.shape[0], 4))
+        q[:,_axis_index(order[i])] = np.sin(angles[:,i]/2.0)
+        q[:,3] = np.cos(angles[:,i]/2.0)
+        quats.append(q)
+    return compose_quaternions_batch(quats)
+
+
+def quaternion_to_Euler_angles_batch(q, order='XYZ'):
+    """ convert (N,4) quaternions to (N,3) Euler angles
+        angles are returned in the order of application, specified by order
+    """
+    if not axis_order_is_valid(order):
+        raise Exception('Invalid order string: ' + str(order))
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    p0 = q[:,3]  # real component
+    p1 = q[:,_axis_index(order[0])]
+    p2 = q[:,_axis_index(order[1])]
+    p3 = q[:,_axis_index(order[2])]
+
+    e1 = axis_from_string(order[0])
+    e2 = axis_from_string(order[1])
+    e3 = axis_from_string(order[2])
+
+    e = np.sign(np.dot(np.cross(e3,e2),e1))
+
+    angles = np.empty((q.shape[0], 3))
+    angles[:,0] = np.arctan2(e*2*(p2*p3 + e*p0*p1), p0*p0 - p1*p1 - p2*p2 + p3*p3)
+    # clip to guard against round-off pushing the argument just outside [-1,1]
+    angles[:,1] = np.arcsin(np.clip(-e*2*(p1*p3 - e*p0*p2), -1.0, 1.0))
+    angles[:,2] = np.arctan2(e*2*(p1*p2 + e*p0*p3), p0*p0 + p1*p1 - p2*p2 - p3*p3)
+
+    return angles
+
+
+def quaternion_to_matrix_batch(q):
+    """ Convert (N,4) quaternions to (N,3,3) orthogonal rotation matrices """
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    # normalize quaternions (without modifying the input)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    x = q[:,0]
+    y = q[:,1]
+    z = q[:,2]
+    w = q[:,3]
+
+    R = np.empty((q.shape[0], 3, 3))
+
+    R[:,0,0] = 1 - 2*y*y - 2*z*z
+    R[:,0,1] = 2*x*y - 2*z*w
+    R[:,0,2] = 2*x*z + 2*y*w
+
+    R[:,1,0] = 2*x*y + 2*z*w
+    R[:,1,1] = 1 - 2*x*x - 2*z*z
+    R[:,1,2] = 2*y*z - 2*x*w
+
+    R[:,2,0] = 2*x*z - 2*y*w
+    R[:,2,1] = 2*y*z + 2*x*w
+    R[:,2,2] = 1 - 2*x*x - 2*y*y
+
+    return R
+
+
+def matrix_to_quaternion_batch(rot):
+    """ convert (N,3,3) rotation matrices to (N,4) quaternions
+        Uses the same branch selection as matrix_to_quaternion, evaluated for all rows at once
+    """
+    rot = np.asarray(rot, dtype=np.float64).reshape(-1, 3, 3)
+    d0 = rot[:,0,0]
+    d1 = rot[:,1,1]
+    d2 = rot[:,2,2]
+    vals = np.stack((1.0 + d0 - d1 - d2,
+                     1.0 - d0 + d1 - d2,
+                     1.0 - d0 - d1 + d2,
+                     1.0 + d0 + d1 + d2), axis=1)
+    imax = np.argmax(np.abs(vals), axis=1)
+    rows = np.arange(rot.shape[0])
+
+    # the largest term is the one used as the pivot, so it is always positive
+    s4 = np.sqrt(np.maximum(vals[rows, imax], 0.0)) * 2
+    is4 = 1.0 / s4
+
+    # off-diagonal sums and differences used by the four branches
+    sum01 = (rot[:,1,0] + rot[:,0,1]) * is4
+    sum02 = (rot[:,2,0] + rot[:,0,2]) * is4
+    sum12 = (rot[:,2,1] + rot[:,1,2]) * is4
+    dif21 = (rot[:,2,1] - rot[:,1,2]) * is4
+    dif02 = (rot[:,0,2] - rot[:,2,0]) * is4
+    dif10 = (rot[:,1,0] - rot[:,0,1]) * is4
+    quarter = s4 / 4
+
+    # candidate quaternions for each branch, (4 branches, N, 4 components)
+    candidates = np.stack((
+        np.stack((quarter, sum01, sum02, dif21), axis=1),
+        np.stack((sum01, quarter, sum12, dif02), axis=1),
+        np.stack((sum02, sum12, quarter, dif10), axis=1),
+        np.stack((dif21, dif02, dif10, quarter), axis=1)))
+
+    return candidates[imax, rows]
+
+
+def Euler_angles_to_matrix_batch(angles, order='XYZ'):
+    """ Convert (N,3) Euler angles to (N,3,3) rotation matrices. Angles are specified in the order of application.
+    """
+    return quaternion_to_matrix_batch(Euler_angles_to_quaternion_batch(angles, order=order))
+
+
+def matrix_to_Euler_angles_batch(M, order='XYZ'):
+    """ Convert (N,3,3) rotation matrices to (N,3) Euler angles. Angles are returned in the order of application.
+    """
+    return quaternion_to_Euler_angles_batch(matrix_to_quaternion_batch(M), order=order)
+
+
+def slerp_quaternions_batch(q0, q1, t):
+    """ spherical linear interpolation between quaternions q0 and q1 (each (4,) or (N,4)) at fractions t (N,)
+        Returns (N,4) unit quaternions, taking the shorter path between q0 and q1
+    """
+    t = np.asarray(t, dtype=np.float64).reshape(-1, 1)
+    q0 = np.asarray(q0, dtype=np.float64).reshape(-1, 4)
+    q1 = np.asarray(q1, dtype=np.float64).reshape(-1, 4)
+    q0 = q0 / np.linalg.norm(q0, axis=1, keepdims=True)
+    q1 = q1 / np.linalg.norm(q1, axis=1, keepdims=True)
+    dot = np.sum(q0 * q1, axis=1, keepdims=True)
+    # q and -q represent the same rotation
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    # fall back to linear interpolation for nearly identical rotations
+    small = sin_theta < 1e-6
+    safe_sin = np.where(small, 1.0, sin_theta)
+    w0 = np.where(small, 1.0 - t, np.sin((1.0 - t) * theta) / safe_sin)
+    w1 = np.where(small, t, np.sin(t * theta) / safe_sin)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
@@ -0,0 +1,274 @@
+"""
+Lightweight per-stage timers and counters, disabled (no-op) unless enable() is called or PIX2FACE_PROFILE
+is set.  Timings recorded in worker processes are merged into the parent's registry by batch_runner and pipeline.
+"""
+import os
+import json
+import time
+import random
+import threading
+import functools
+import numpy as np
+
+
+PERCENTILES = (50, 95, 99)
+
+_enabled = os.environ.get('PIX2FACE_PROFILE', '0') not in ('', '0')
+
+
+def enable(enabled=True):
+    """ turn instrumentation on or off for this process and any worker processes started afterwards """
+    global _enabled
+    _enabled = enabled
+    os.environ['PIX2FACE_PROFILE'] = '1' if enabled else '0'
+
+
+def is_enabled():
+    return _enabled
+
+
+class Histogram(object):
+    """
+    Count, sum, min and max of all recorded values, and percentiles estimated from a uniform
+    reservoir sample of at most max_samples values
+    """
+    def __init__(self, max_samples=4096):
+        self.max_samples = max_samples
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.samples = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = value
+
+    def merge(self, other):
+        """ add the values recorded by another Histogram """
+        if other.count == 0:
+            return
+        # weight the other's samples by the number of values they represent
+        samples = self.samples + other.samples
+        if len(samples) > self.max_samples:
+            weights = np.concatenate((np.full(len(self.samples), self.count / len(self.samples)),
+                                      np.full(len(other.samples), other.count / len(other.samples))))
+            keep = np.random.choice(len(samples), self.max_samples, replace=False, p=weights / weights.sum())
+            samples = [samples[i] for i in keep]
+        self.samples = samples
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        if len(self.samples) == 0:
+            return {p: 0.0 for p in percentiles}
+        return dict(zip(percentiles, np.percentile(self.samples, percentiles)))
+
+    def summary(self):
+        summary = dict(count=self.count, sum=self.total,
+                       mean=self.total / self.count if self.count > 0 else 0.0,
+                       min=self.min if self.count > 0 else 0.0,
+                       max=self.max if self.count > 0 else 0.0)
+        for p, value in self.percentiles().items():
+            summary['p%d' % p] = float(value)
+        return summary
+
+
+class MetricsRegistry(object):
+    """ thread-safe collection of named timers (histograms of seconds) and counters """
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record_time(self, name, seconds):
+        with self._lock:
+            histogram = self.timers.get(name)
+            if histogram is None:
+                histogram = self.timers[name] = Histogram()
+            histogram.add(seconds)
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def snapshot(self, reset=False):
+        """ return a picklable copy of the recorded metrics, optionally resetting them """
+        with self._lock:
+            snapshot = (self.timers, self.counters)
+            if reset:
+                self.timers = {}
+                self.counters = {}
+            else:
+                snapshot = ({name: _copy_histogram(h) for name, h in self.timers.items()}, dict(self.counters))
+        return snapshot
+
+    def merge(self, snapshot):
+        """ add the metrics of a snapshot (e.g. taken in a worker process) """
+        timers, counters = snapshot
+        with self._lock:
+            for name, histogram in timers.items():
+                if name not in self.timers:
+                    self.timers[name] = Histogram(histogram.max_samples)
+                self.timers[name].merge(histogram)
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        with self._lock:
+            return dict(timers={name: h.summary() for name, h in sorted(self.timers.items())},
+                        counters=dict(sorted(self.counters.items())))
+
+
+def _copy_histogram(histogram):
+    copy = Histogram(histogram.max_samples)
+    copy.merge(histogram)
+    return copy
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    """ return the process-wide metrics registry """
+    return _registry
+
+
+class _Timer(object):
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _registry.record_time(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """ context manager recording the duration of its block under name, if instrumentation is enabled """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def count(name, n=1):
+    """ increment the counter name by n, if instrumentation is enabled """
+    if _enabled:
+        _registry.increment(name, n)
+
+
+def timed(name):
+    """ decorator recording the duration of each call under name """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def call_and_collect(fn, *args):
+    """
+    Call fn(*args) in a worker process, returning (result, metrics snapshot) so that the parent can
+    merge the metrics recorded during the call.  The snapshot is None if instrumentation is disabled.
+    Must not be used from threads sharing the registry, since the registry is reset.
+    """
+    if not _enabled:
+        return fn(*args), None
+    _registry.reset()
+    result = fn(*args)
+    return result, _registry.snapshot(reset=True)
+
+
+def merge(snapshot):
+    """ merge a snapshot returned by a worker process into the process-wide registry """
+    if snapshot is not None:
+        _registry.merge(snapshot)
+
+
+def summary(registry=None):
+    """ return a dictionary of the timer statistics (seconds) and counter values (default: of the process-wide registry) """
+    return (registry if registry is not None else _registry).summary()
+
+
+def format_summary():
+    """ return a human-readable table of the recorded timers and counters """
+    metrics = summary()
+    lines = ['%-24s %8s %10s %10s %10s %10s' % ('stage', 'count', 'total s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for name, t in metrics['timers'].items():
+        lines.append('%-24s %8d %10.2f %10.2f %10.2f %10.2f' % (name, t['count'], t['sum'],
+                                                               1e3 * t['p50'], 1e3 * t['p95'], 1e3 * t['p99']))
+    for name, n in metrics['counters'].items():
+        lines.append('%-24s %8d' % (name, n))
+    return '\n'.join(lines)
+
+
+def _prometheus_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def prometheus_text(prefix='pix2face', registry=None):
+    """ return the recorded metrics (default: of the process-wide registry) in the Prometheus text exposition format """
+    metrics = summary(registry)
+    lines = []
+    if metrics['timers']:
+        metric = prefix + '_stage_seconds'
+        lines.append('# TYPE %s summary' % metric)
+        for name, t in metrics['timers'].items():
+            for p in PERCENTILES:
+                lines.append('%s{stage="%s",quantile="%g"} %.9g' % (metric, name, p / 100.0, t['p%d' % p]))
+            lines.append('%s_sum{stage="%s"} %.9g' % (metric, name, t['sum']))
+            lines.append('%s_count{stage="%s"} %d' % (metric, name, t['count']))
+    for name, n in metrics['counters'].items():
+        metric = '%s_%s_total' % (prefix, _prometheus_name(name))
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %d' % (metric, n))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(fname):
+    """ write the recorded metrics to fname: Prometheus text format if it ends with .prom, JSON otherwise """
+    if fname.endswith('.prom'):
+        text = prometheus_text()
+    else:
+        text = json.dumps(summary(), indent=2, sort_keys=True)
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as fd:
+        fd.write(text)
+    os.replace(tmp_fname, fname)
@@ -0,0 +1,238 @@
+"""
+3D pose jittering of face chips, listed as "<chip path>,<coefficients path>" lines, with previously estimated
+coefficients.  Jitters are written to <output_dir>/<subject id>/<chip id>_jitter_<i>.jpg by a pool of processes.
+"""
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from collections import namedtuple
+import numpy as np
+from PIL import Image
+import face3d
+from . import batch_runner
+from .output_index import OutputIndex
+from . import instrumentation
+
+
+JitterSettings = namedtuple('JitterSettings', ['pvr_data_dir', 'output_dir', 'min_yaw', 'max_yaw', 'num_jitters',
+                                               'force_rewrite', 'egl_devices', 'num_subject_coeffs',
+                                               'num_expression_coeffs', 'jpeg_quality'])
+
+
+def make_settings(pvr_data_dir, output_dir, min_yaw=30, max_yaw=90, num_jitters=1, force_rewrite=False,
+                  egl_devices=(0,), num_subject_coeffs=199, num_expression_coeffs=29, jpeg_quality=95):
+    """ construct JitterSettings, with defaults """
+    return JitterSettings(pvr_data_dir=pvr_data_dir, output_dir=output_dir, min_yaw=min_yaw, max_yaw=max_yaw,
+                          num_jitters=num_jitters, force_rewrite=force_rewrite, egl_devices=tuple(egl_devices),
+                          num_subject_coeffs=num_subject_coeffs, num_expression_coeffs=num_expression_coeffs,
+                          jpeg_quality=jpeg_quality)
+
+
+def category_index(path):
+    return os.path.basename(os.path.dirname(path))
+
+
+def chip_id(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def parse_line(line):
+    """ return (chip path, coefficients path) from a line of the input list """
+    # expects the chip path and the corresponding coefficient file path separated by comma
+    parts = line.strip().split(',')
+    return parts[0], parts[1]
+
+
+def jitter_output_dir(settings, coeff_path):
+    return os.path.join(settings.output_dir, category_index(coeff_path))
+
+
+def jitter_output_fname(settings, chip_path, coeff_path, jitter_index):
+    return os.path.join(jitter_output_dir(settings, coeff_path), "%s_jitter_%s.jpg" % (chip_id(chip_path), jitter_index))
+
+
+class AsyncImageWriter(object):
+    """ Encodes and writes images on a background thread, with at most max_pending images queued """
+    def __init__(self, jpeg_quality=95, max_pending=64):
+        self.jpeg_quality = jpeg_quality
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                label, img, output_fname = item
+                try:
+                    with instrumentation.timer('write_output'):
+                        Image.fromarray(img).save(output_fname, quality=self.jpeg_quality)
+                except Exception as e:
+                    with self._lock:
+                        self._failed[label] = e
+            finally:
+                self._queue.task_done()
+
+    def write(self, label, img, output_fname):
+        self._queue.put((label, img, output_fname))
+
+    def flush(self):
+        """ wait for all queued images to be written, and return a dictionary of failed labels to exceptions """
+        self._queue.join()
+        with self._lock:
+            failed = self._failed
+            self._failed = {}
+        return failed
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+WorkerState = namedtuple('WorkerState', ['settings', 'jitterer', 'writer'])
+
+
+def init_worker(settings, worker_counter=None):
+    """ create the per-worker jitterer (on the worker's EGL device) and image writer """
+    worker_index = 0
+    if worker_counter is not None:
+        with worker_counter.get_lock():
+            worker_index = worker_counter.value
+            worker_counter.value += 1
+    egl_device = settings.egl_devices[worker_index % len(settings.egl_devices)]
+    jitterer = face3d.pose_jitterer_profile(settings.pvr_data_dir, settings.num_subject_coeffs,
+                                            settings.num_expression_coeffs, "",
+                                            settings.min_yaw, settings.max_yaw, egl_device)
+    return WorkerState(settings=settings, jitterer=jitterer, writer=AsyncImageWriter(settings.jpeg_quality))
+
+
+def filter_work(lines, settings, output_index=None):
+    """
+    Split lines into work to do and skip, listing each coefficients directory once and looking up existing outputs
+    in output_index (built from the output tree if None).  Returns (lines to process, skip counts, output_index)
+    """
+    parsed = [(line, parse_line(line)) for line in lines]
+    coeffs_index = OutputIndex().scan_parent_dirs(coeff_path for _, (_, coeff_path) in parsed)
+    if output_index is None:
+        output_index = OutputIndex().scan_tree(settings.output_dir, max_depth=1)
+    todo = []
+    skip_counts = {'missing_coeffs': 0, 'skipped': 0}
+    for line, (chip_path, coeff_path) in parsed:
+        if coeff_path not in coeffs_index:
+            skip_counts['missing_coeffs'] += 1
+        elif not settings.force_rewrite and jitter_output_fname(settings, chip_path, coeff_path, 0) in output_index:
+            skip_counts['skipped'] += 1
+        else:
+            todo.append(line)
+    output_index.make_dirs(jitter_output_dir(settings, parse_line(line)[1]) for line in todo)
+    return todo, skip_counts, output_index
+
+
+def process_line(line, state):
+    """
+    jitter the chip described by line.  The output directory must exist (see filter_work).
+    Returns 'jittered'
+    """
+    settings = state.settings
+    chip_path, coeff_path = parse_line(line)
+    with instrumentation.timer('decode'):
+        image = np.array(Image.open(chip_path))
+    coeffs = face3d.subject_perspective_sighting_coefficients(coeff_path)
+    with instrumentation.timer('render'):
+        ims = state.jitterer.multiple_random_jitters([image], coeffs, settings.num_jitters)
+    for i, im in enumerate(ims):
+        state.writer.write(line, im, jitter_output_fname(settings, chip_path, coeff_path, i))
+    return 'jittered'
+
+
+def process_chunk(state, lines):
+    """ jitter a chunk of lines, returning a list of batch_runner.ItemResult """
+    item_results = []
+    for line in lines:
+        t0 = time.time()
+        try:
+            outcome = process_line(line, state)
+            item_results.append(batch_runner.ItemResult(line, True, time.time() - t0, None, outcome))
+        except Exception as e:
+            # errors are passed back to the parent process as strings, since they may not be picklable
+            item_results.append(batch_runner.ItemResult(line, False, time.time() - t0, str(e), None))
+    # make sure the chunk's outputs are on disk before reporting it done
+    failed = state.writer.flush()
+    if len(failed) > 0:
+        item_results = [r if r.label not in failed else r._replace(success=False, error=str(failed[r.label]))
+                        for r in item_results]
+    return item_results
+
+
+class ProgressReporter(object):
+    """ chunk callback passing the throughput aggregated over all workers to report_fn every report_every items """
+    def __init__(self, total_items, report_every=1000, report_fn=None):
+        self.total_items = total_items
+        self.report_every = report_every
+        self.report_fn = report_fn
+        self.counts = {}
+        self.num_done = 0
+        self._next_report = report_every
+        self._start_time = time.time()
+
+    def __call__(self, stats):
+        self.num_done += stats.num_items
+        for r in stats.item_results:
+            outcome = r.output if r.success else 'failed'
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        if self.num_done >= self._next_report or self.num_done == self.total_items:
+            if self.report_fn is not None:
+                self.report_fn(self.message())
+            while self._next_report <= self.num_done:
+                self._next_report += self.report_every
+
+    def message(self):
+        elapsed = time.time() - self._start_time
+        return "[%d/%d] %0.2f chips/s overall, %s" % (self.num_done, self.total_items,
+                                                     self.num_done / max(elapsed, 1e-6), self.counts)
+
+
+def run_jitter(lines, settings, num_workers=4, chunk_size=32, report_every=1000, chunk_callback=None,
+               output_index_fname=None, progress_fn=None):
+    """
+    Jitter all chips of lines using num_workers processes, returning a batch_runner.RunSummary.
+    output_index_fname caches the index of existing outputs between runs, and progress_fn (e.g. print), if given,
+    is called with progress messages.
+    """
+    lines = [line for line in lines if line.strip()]
+    output_index = None
+    if output_index_fname is not None and os.path.exists(output_index_fname):
+        output_index = OutputIndex.load(output_index_fname)
+    t0 = time.time()
+    todo, skip_counts, output_index = filter_work(lines, settings, output_index)
+    if progress_fn is not None:
+        progress_fn("%d of %d chips to jitter (%s), filtered in %0.1f s" %
+                    (len(todo), len(lines), skip_counts, time.time() - t0))
+    progress = ProgressReporter(len(todo), report_every, progress_fn)
+
+    def on_chunk(stats):
+        progress(stats)
+        for r in stats.item_results:
+            if r.success:
+                chip_path, coeff_path = parse_line(r.label)
+                for i in range(settings.num_jitters):
+                    output_index.add(jitter_output_fname(settings, chip_path, coeff_path, i))
+        if chunk_callback is not None:
+            chunk_callback(stats)
+
+    # the counter is inherited by the workers, and used to assign each one an EGL device
+    worker_counter = multiprocessing.Value('i', 0)
+    try:
+        summary = batch_runner.run_chunked(todo, init_worker, process_chunk, init_args=(settings, worker_counter),
+                                           chunk_size=chunk_size, num_workers=num_workers, chunk_callback=on_chunk)
+    finally:
+        if output_index_fname is not None:
+            output_index.save(output_index_fname)
+    return summary
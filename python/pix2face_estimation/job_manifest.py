@@ -0,0 +1,94 @@
+"""
+On-disk job manifest for resumable batch processing.
+Records the status (pending, done, failed) of every item of a batch job along with per-item timings,
+so that an interrupted job can skip completed work without checking its outputs, or retry only failures.
+"""
+import time
+import sqlite3
+
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobManifest(object):
+    """ SQLite-backed ledger of item labels (e.g. image filenames) and their processing status """
+
+    def __init__(self, db_fname):
+        self.db_fname = db_fname
+        self.conn = sqlite3.connect(db_fname, timeout=60.0)
+        # write-ahead logging keeps readers from blocking the writer
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                          'label TEXT PRIMARY KEY, '
+                          'status TEXT NOT NULL, '
+                          'attempts INTEGER NOT NULL DEFAULT 0, '
+                          'elapsed REAL, '
+                          'error TEXT, '
+                          'updated REAL)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def add_items(self, labels):
+        """ add labels as pending.  Labels already in the manifest keep their current status. """
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO items (label, status) VALUES (?, ?)',
+                                  ((label, PENDING) for label in labels))
+
+    def labels_with_status(self, status):
+        """ return the set of labels with the given status """
+        return set(row[0] for row in self.conn.execute('SELECT label FROM items WHERE status = ?', (status,)))
+
+    def remaining(self, labels, retry_failed=False):
+        """
+        Add labels to the manifest and return those still needing work, in their original order.
+        Completed items are skipped, as are failed items unless retry_failed is True.
+        """
+        labels = list(labels)
+        self.add_items(labels)
+        skip = self.labels_with_status(DONE)
+        if not retry_failed:
+            skip |= self.labels_with_status(FAILED)
+        return [label for label in labels if label not in skip]
+
+    def mark_done(self, label, elapsed=None):
+        self.record([(label, True, elapsed, None)])
+
+    def mark_failed(self, label, elapsed=None, error=None):
+        self.record([(label, False, elapsed, error)])
+
+    def record(self, item_results):
+        """ record an iterable of (label, success, elapsed, error, ...) tuples in a single transaction """
+        now = time.time()
+        rows = [(DONE if item[1] else FAILED, item[2], None if item[3] is None else str(item[3]), now, item[0])
+                for item in item_results]
+        with self.conn:
+            # make sure labels not registered through add_items are tracked as well
+            self.conn.executemany('INSERT OR IGNORE INTO items (label, status) VALUES (?, ?)',
+                                  ((row[-1], PENDING) for row in rows))
+            self.conn.executemany('UPDATE items SET status = ?, elapsed = ?, error = ?, updated = ?, '
+                                  'attempts = attempts + 1 WHERE label = ?', rows)
+
+    def counts(self):
+        """ return a dictionary mapping status to number of items """
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        for status, count in self.conn.execute('SELECT status, COUNT(*) FROM items GROUP BY status'):
+            counts[status] = count
+        return counts
+
+    def failures(self):
+        """ return a list of (label, error) for all failed items """
+        return list(self.conn.execute('SELECT label, error FROM items WHERE status = ? ORDER BY rowid', (FAILED,)))
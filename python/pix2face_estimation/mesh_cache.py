@@ -0,0 +1,126 @@
+"""
+LRU cache of head meshes warped by subject and expression coefficients.
+Repeated renders and texture extractions of the same coefficients skip the PCA reconstruction.
+"""
+import hashlib
+import threading
+import collections
+import numpy as np
+from . import instrumentation
+
+
+def coefficients_key(pix2face_data, subject_coeffs, expression_coeffs):
+    """ return a hashable key identifying the warped mesh for the given coefficients and PCA bases """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(subject_coeffs, dtype=np.float64).tobytes())
+    digest.update(b'|')
+    digest.update(np.ascontiguousarray(expression_coeffs, dtype=np.float64).tobytes())
+    basis_id = (pix2face_data.pvr_data_dir,
+                pix2face_data.subject_components_array.shape,
+                pix2face_data.expression_components_array.shape)
+    return basis_id, digest.hexdigest()
+
+
+def estimate_mesh_bytes(pix2face_data):
+    """ rough estimate of the memory held by one warped mesh: double precision vertices and normals, plus overhead """
+    num_vertex_values = pix2face_data.subject_components_array.shape[1]
+    return 3 * num_vertex_values * 8
+
+
+def warp_head_mesh(pix2face_data, subject_coeffs, expression_coeffs):
+    """ return a new face3d head mesh warped by the given coefficients """
+    import face3d
+    head_mesh_warped = face3d.head_mesh(pix2face_data.head_mesh)
+    head_mesh_warped.apply_coefficients(pix2face_data.subject_components, pix2face_data.expression_components,
+                                        subject_coeffs, expression_coeffs)
+    return head_mesh_warped
+
+
+class WarpedMeshCache(object):
+    """
+    Thread-safe LRU cache of warped face3d.head_mesh objects, bounded by max_bytes and max_entries.
+    Cached meshes are shared, so they must not be modified (see warped_head_mesh_copy).
+    warp_fn(pix2face_data, subject_coeffs, expression_coeffs) creates a mesh (default: warp_head_mesh).
+    """
+    def __init__(self, max_bytes=512*1024*1024, max_entries=None, warp_fn=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.warp_fn = warp_fn if warp_fn is not None else warp_head_mesh
+        self.hits = 0
+        self.misses = 0
+        self._meshes = collections.OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._meshes)
+
+    @property
+    def num_bytes(self):
+        return self._num_bytes
+
+    def get(self, pix2face_data, subject_coeffs, expression_coeffs):
+        """ return the head mesh warped by the given coefficients, reconstructing it on a cache miss """
+        key = coefficients_key(pix2face_data, subject_coeffs, expression_coeffs)
+        with self._lock:
+            entry = self._meshes.get(key)
+            if entry is not None:
+                self._meshes.move_to_end(key)
+                self.hits += 1
+                instrumentation.count('mesh_cache_hits')
+                return entry[0]
+            self.misses += 1
+        instrumentation.count('mesh_cache_misses')
+
+        # reconstruct outside the lock so that other threads are not blocked
+        with instrumentation.timer('warp_mesh'):
+            head_mesh_warped = self.warp_fn(pix2face_data, subject_coeffs, expression_coeffs)
+        mesh_bytes = estimate_mesh_bytes(pix2face_data)
+
+        with self._lock:
+            if key not in self._meshes:
+                self._meshes[key] = (head_mesh_warped, mesh_bytes)
+                self._num_bytes += mesh_bytes
+                self._evict()
+        return head_mesh_warped
+
+    def _evict(self):
+        # always keep the most recently added mesh
+        while len(self._meshes) > 1 and (self._num_bytes > self.max_bytes or
+                                         (self.max_entries is not None and len(self._meshes) > self.max_entries)):
+            _, (_, mesh_bytes) = self._meshes.popitem(last=False)
+            self._num_bytes -= mesh_bytes
+
+    def clear(self):
+        with self._lock:
+            self._meshes.clear()
+            self._num_bytes = 0
+
+
+_warped_mesh_cache = None
+_warped_mesh_cache_lock = threading.Lock()
+
+
+def get_warped_mesh_cache():
+    """ return the process-wide warped mesh cache, created lazily """
+    global _warped_mesh_cache
+    with _warped_mesh_cache_lock:
+        if _warped_mesh_cache is None:
+            _warped_mesh_cache = WarpedMeshCache()
+    return _warped_mesh_cache
+
+
+def warped_head_mesh(pix2face_data, subject_coeffs, expression_coeffs):
+    """ return the (possibly cached) head mesh warped by the given coefficients """
+    return get_warped_mesh_cache().get(pix2face_data, subject_coeffs, expression_coeffs)
+
+
+def warped_head_mesh_copy(pix2face_data, subject_coeffs, expression_coeffs):
+    """
+    return a private copy of the (possibly cached) warped head mesh, which the caller may modify,
+    e.g. by setting textures
+    """
+    import face3d
+    head_mesh_warped = warped_head_mesh(pix2face_data, subject_coeffs, expression_coeffs)
+    with instrumentation.timer('copy_mesh'):
+        return face3d.head_mesh(head_mesh_warped)
@@ -1,11 +1,131 @@
+import os
+import weakref
+import threading
+import contextlib
+import concurrent.futures
 import face3d
 
 _mesh_renderer = None
+_mesh_renderer_lock = threading.Lock()
+
+
+def _create_renderer(egl_device=None):
+    if egl_device is None:
+        return face3d.mesh_renderer()
+    return face3d.mesh_renderer(egl_device)
 
 
 def get_mesh_renderer():
     global _mesh_renderer
     # get the mesh renderer, which is created only once, lazily
-    if _mesh_renderer is None:
-        _mesh_renderer = face3d.mesh_renderer()
+    # Note that the returned renderer is shared: use renderer() to render from multiple threads.
+    with _mesh_renderer_lock:
+        if _mesh_renderer is None:
+            _mesh_renderer = _create_renderer()
     return _mesh_renderer
+
+
+class _ThreadRenderer(object):
+    """ holds the renderer of one thread, and updates the pool's count when the thread exits """
+    def __init__(self, pool, renderer):
+        self.renderer = renderer
+        weakref.finalize(self, pool._renderer_destroyed)
+
+
+class MeshRendererPool(object):
+    """
+    At most max_size mesh renderers, each bound to the thread that created it until the thread exits (an EGL
+    context is current in one thread); acquire() blocks while max_size are alive.  executor provides max_size
+    long-lived rendering threads.  Renderers are assigned to egl_devices, if given, in round-robin order.
+    """
+    def __init__(self, max_size=None, egl_devices=None):
+        if max_size is None:
+            max_size = os.cpu_count() or 1
+        if max_size < 1:
+            raise ValueError('MeshRendererPool max_size must be at least 1')
+        self.max_size = max_size
+        self.egl_devices = list(egl_devices) if egl_devices is not None else None
+        self._local = threading.local()
+        self._num_created = 0
+        self._num_alive = 0
+        self._lock = threading.Lock()
+        self._renderer_available = threading.Condition(self._lock)
+        self._executor = None
+
+    @property
+    def num_created(self):
+        """ the number of renderers created so far """
+        return self._num_created
+
+    @property
+    def num_alive(self):
+        """ the number of renderers currently bound to (live) threads """
+        return self._num_alive
+
+    def _renderer_destroyed(self):
+        with self._lock:
+            self._num_alive -= 1
+            self._renderer_available.notify()
+
+    def acquire(self, timeout=None):
+        """
+        return the calling thread's renderer, creating it if needed.  Blocks while max_size renderers are alive,
+        raising RuntimeError if none becomes available within timeout seconds (default: wait indefinitely).
+        """
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None:
+            return holder.renderer
+        with self._lock:
+            if not self._renderer_available.wait_for(lambda: self._num_alive < self.max_size, timeout):
+                raise RuntimeError('No mesh renderer available after %g seconds (max_size %d)' %
+                                   (timeout, self.max_size))
+            renderer_index = self._num_created
+            self._num_created += 1
+            self._num_alive += 1
+        egl_device = None
+        if self.egl_devices:
+            egl_device = self.egl_devices[renderer_index % len(self.egl_devices)]
+        try:
+            renderer = _create_renderer(egl_device)
+        except Exception:
+            self._renderer_destroyed()
+            raise
+        self._local.holder = _ThreadRenderer(self, renderer)
+        return renderer
+
+    @contextlib.contextmanager
+    def renderer(self, timeout=None):
+        """ context manager providing the calling thread's renderer for the duration of the block """
+        yield self.acquire(timeout)
+
+    @property
+    def executor(self):
+        """ a (lazily created) pool of max_size threads to render on """
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.max_size)
+            return self._executor
+
+
+_renderer_pool = None
+
+
+def get_renderer_pool():
+    """ return the process-wide renderer pool, created lazily with one rendering thread per core """
+    global _renderer_pool
+    with _mesh_renderer_lock:
+        if _renderer_pool is None:
+            _renderer_pool = MeshRendererPool()
+    return _renderer_pool
+
+
+def set_renderer_pool(pool):
+    """ replace the process-wide renderer pool, e.g. to bound its size or select EGL devices """
+    global _renderer_pool
+    with _mesh_renderer_lock:
+        _renderer_pool = pool
+
+
+def renderer():
+    """ context manager providing the calling thread's renderer from the process-wide pool """
+    return get_renderer_pool().renderer()
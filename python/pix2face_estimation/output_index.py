@@ -0,0 +1,100 @@
+"""
+In-memory index of the files in an output tree, used to filter a work list up front
+instead of stat'ing every expected output (which is slow on network filesystems).
+Each directory is listed once with os.scandir; the index can also be saved and reloaded.
+"""
+import os
+
+
+def list_dir(dir_path):
+    """ return (set of file names, set of subdirectory names) in dir_path, or None if it does not exist """
+    files = set()
+    subdirs = set()
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.add(entry.name)
+                else:
+                    files.add(entry.name)
+    except FileNotFoundError:
+        return None
+    return files, subdirs
+
+
+class OutputIndex(object):
+    """ set of the (normalized) paths of existing files and directories under some output tree """
+    def __init__(self):
+        self.files = set()
+        self.dirs = set()
+
+    @staticmethod
+    def _norm(path):
+        return os.path.normpath(path)
+
+    def scan_dir(self, dir_path):
+        """ add the files of a single directory (not recursively).  Returns the names of its subdirectories. """
+        listing = list_dir(dir_path)
+        if listing is None:
+            return set()
+        files, subdirs = listing
+        dir_path = self._norm(dir_path)
+        self.dirs.add(dir_path)
+        self.files.update(os.path.join(dir_path, f) for f in files)
+        self.dirs.update(os.path.join(dir_path, d) for d in subdirs)
+        return subdirs
+
+    def scan_tree(self, root_dir, max_depth=None):
+        """ add all files under root_dir, descending at most max_depth levels (None: unlimited) """
+        pending = [(self._norm(root_dir), 0)]
+        while pending:
+            dir_path, depth = pending.pop()
+            subdirs = self.scan_dir(dir_path)
+            if max_depth is None or depth < max_depth:
+                pending.extend((os.path.join(dir_path, d), depth + 1) for d in subdirs)
+        return self
+
+    def scan_parent_dirs(self, paths):
+        """ add the files of each distinct parent directory of paths, listing each directory once """
+        for dir_path in set(os.path.dirname(self._norm(p)) for p in paths):
+            self.scan_dir(dir_path)
+        return self
+
+    def contains(self, path):
+        return self._norm(path) in self.files
+
+    def __contains__(self, path):
+        return self.contains(path)
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, path):
+        path = self._norm(path)
+        self.files.add(path)
+        self.dirs.add(os.path.dirname(path))
+
+    def make_dirs(self, dir_paths):
+        """ create each distinct directory of dir_paths not already known to exist """
+        for dir_path in sorted(set(self._norm(d) for d in dir_paths)):
+            if dir_path not in self.dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                self.dirs.add(dir_path)
+
+    def save(self, index_fname):
+        """ write the indexed file paths, one per line """
+        tmp_fname = index_fname + '.tmp'
+        with open(tmp_fname, 'w') as fd:
+            fd.writelines(path + '\n' for path in sorted(self.files))
+        os.replace(tmp_fname, index_fname)
+
+    @classmethod
+    def load(cls, index_fname):
+        """ read an index written by save() """
+        index = cls()
+        with open(index_fname, 'r') as fd:
+            for line in fd:
+                path = line.rstrip('\n')
+                if path:
+                    index.add(path)
+        return index
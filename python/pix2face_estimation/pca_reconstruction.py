@@ -0,0 +1,138 @@
+"""
+Batched numpy reconstruction of 3DMM vertices, mean + subject_coeffs * subject_components +
+expression_coeffs * expression_components, with components stored one per row as interleaved (x0,y0,z0,x1,...).
+"""
+import os
+import numpy as np
+
+
+def read_ply_vertices(ply_fname):
+    """ return the (V,3) vertex positions of an ASCII PLY file """
+    with open(ply_fname, 'r') as fd:
+        if fd.readline().strip() != 'ply':
+            raise ValueError('Not a PLY file: ' + ply_fname)
+        num_vertices = None
+        for line in fd:
+            tokens = line.split()
+            if len(tokens) == 0:
+                continue
+            if tokens[0] == 'format' and tokens[1] != 'ascii':
+                raise ValueError('Only ASCII PLY files are supported: ' + ply_fname)
+            if tokens[0] == 'element' and tokens[1] == 'vertex':
+                num_vertices = int(tokens[2])
+            if tokens[0] == 'end_header':
+                break
+        if num_vertices is None:
+            raise ValueError('No vertex element in PLY file: ' + ply_fname)
+        vertices = np.loadtxt(fd, max_rows=num_vertices, usecols=(0,1,2), ndmin=2)
+    return vertices
+
+
+def _batch_size(subject_coeffs, expression_coeffs):
+    """ return the batch size implied by (B,S) or (S,) subject and (B,E), (E,) or None expression coefficients """
+    for coeffs in (subject_coeffs, expression_coeffs):
+        if coeffs is not None and np.ndim(coeffs) == 2:
+            return np.shape(coeffs)[0]
+    return 1
+
+
+class ShapeReconstructor(object):
+    """
+    Reconstructs (B,V,3) vertex arrays from batches of coefficient vectors with one matrix multiply per basis.
+    The mean and bases are held as contiguous arrays of the given dtype (float32 by default).
+    """
+    def __init__(self, mean_vertices, subject_components, expression_components=None, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self.mean = np.ascontiguousarray(np.asarray(mean_vertices).reshape(-1), dtype=self.dtype)
+        self.subject_components = np.ascontiguousarray(subject_components, dtype=self.dtype)
+        if expression_components is None:
+            expression_components = np.zeros((0, self.mean.shape[0]))
+        self.expression_components = np.ascontiguousarray(expression_components, dtype=self.dtype)
+        if self.subject_components.shape[1] != self.mean.shape[0] or \
+                self.expression_components.shape[1] != self.mean.shape[0]:
+            raise ValueError('PCA components do not match the number of mean shape vertices')
+
+    @classmethod
+    def from_data_dir(cls, pvr_data_dir, num_subject_coeffs=None, num_expression_coeffs=None,
+                      mean_fname='mean_face_head.ply', dtype=np.float32):
+        """ load the mean shape and PCA components from a 3DMM data directory """
+        subject_components = np.load(os.path.join(pvr_data_dir, 'pca_components_subject.npy'), mmap_mode='r')
+        expression_components = np.load(os.path.join(pvr_data_dir, 'pca_components_expression.npy'), mmap_mode='r')
+        mean_vertices = read_ply_vertices(os.path.join(pvr_data_dir, mean_fname))
+        return cls(mean_vertices, subject_components[0:num_subject_coeffs],
+                   expression_components[0:num_expression_coeffs], dtype=dtype)
+
+    @classmethod
+    def from_pix2face_data(cls, pix2face_data, mean_fname='mean_face_head.ply', dtype=np.float32):
+        """ construct using the (truncated) PCA components of a Pix2FaceData instance """
+        mean_vertices = read_ply_vertices(os.path.join(pix2face_data.pvr_data_dir, mean_fname))
+        return cls(mean_vertices, pix2face_data.subject_components_array,
+                   pix2face_data.expression_components_array, dtype=dtype)
+
+    @property
+    def num_vertices(self):
+        return self.mean.shape[0] // 3
+
+    def mean_vertices(self):
+        return self.mean.reshape(-1, 3)
+
+    def _coeff_matrix(self, coeffs, components, num_components, batch_size):
+        """ return (coeffs, basis) truncated to num_components (default: the number of coefficients given) """
+        if coeffs is None:
+            return None, None
+        coeffs = np.asarray(coeffs, dtype=self.dtype)
+        if coeffs.ndim == 1:
+            coeffs = np.broadcast_to(coeffs, (batch_size, coeffs.shape[0]))
+        if num_components is None:
+            num_components = coeffs.shape[1]
+        if num_components > components.shape[0] or num_components > coeffs.shape[1]:
+            raise ValueError('Requested %d components, but only %d coefficients and %d components available' %
+                             (num_components, coeffs.shape[1], components.shape[0]))
+        return coeffs[:, 0:num_components], components[0:num_components]
+
+    def default_chunk_size(self, max_bytes=256*1024*1024):
+        """ number of shapes per chunk such that the output of one chunk fits in max_bytes """
+        return max(1, int(max_bytes // (self.mean.shape[0] * self.dtype.itemsize)))
+
+    def iter_reconstruct(self, subject_coeffs, expression_coeffs=None, num_subject_components=None,
+                         num_expression_components=None, chunk_size=None):
+        """
+        Generator yielding (start_index, (chunk_size,V,3) vertices) for successive chunks of the batch.
+        Coefficients are as for reconstruct.
+        """
+        batch_size = _batch_size(subject_coeffs, expression_coeffs)
+        S_coeffs, S = self._coeff_matrix(subject_coeffs, self.subject_components, num_subject_components, batch_size)
+        E_coeffs, E = self._coeff_matrix(expression_coeffs, self.expression_components, num_expression_components, batch_size)
+        if chunk_size is None:
+            chunk_size = self.default_chunk_size()
+
+        for start in range(0, batch_size, chunk_size):
+            stop = min(start + chunk_size, batch_size)
+            flat = np.matmul(S_coeffs[start:stop], S)
+            if E_coeffs is not None and E.shape[0] > 0:
+                flat += np.matmul(E_coeffs[start:stop], E)
+            flat += self.mean
+            yield start, flat.reshape(stop - start, -1, 3)
+
+    def reconstruct(self, subject_coeffs, expression_coeffs=None, num_subject_components=None,
+                    num_expression_components=None, chunk_size=None):
+        """
+        Return the (B,V,3) vertex positions for a batch of coefficients (see iter_reconstruct).
+        chunk_size bounds the size of the temporaries; the full output is still allocated.
+        """
+        batch_size = _batch_size(subject_coeffs, expression_coeffs)
+        vertices = np.empty((batch_size, self.num_vertices, 3), dtype=self.dtype)
+        for start, chunk in self.iter_reconstruct(subject_coeffs, expression_coeffs, num_subject_components,
+                                                  num_expression_components, chunk_size):
+            vertices[start:start + chunk.shape[0]] = chunk
+        return vertices
+
+    def mean_shape(self, subject_coeffs, expression_coeffs=None, num_subject_components=None,
+                   num_expression_components=None):
+        """ return the (V,3) mean of the shapes of a batch; by linearity, the shape of the mean coefficients """
+        subject_mean = np.mean(np.atleast_2d(subject_coeffs), axis=0)
+        expression_mean = None
+        if expression_coeffs is not None:
+            expression_mean = np.mean(np.atleast_2d(expression_coeffs), axis=0)
+        return self.reconstruct(subject_mean, expression_mean, num_subject_components,
+                                num_expression_components)[0]
@@ -0,0 +1,151 @@
+"""
+Streaming batch pipeline: threaded image loading, mini-batched network inference, and pooled fitting.
+Results are yielded in input order while the three stages run concurrently.
+"""
+import queue
+import threading
+import collections
+import concurrent.futures
+from collections import namedtuple
+import numpy as np
+from PIL import Image
+from . import instrumentation
+
+
+# stage is None on success, or the stage at which the item failed: 'load', 'infer' or 'fit'
+PipelineResult = namedtuple('PipelineResult', ['label', 'value', 'error', 'stage'])
+
+# marks the end of the stream on the output queue
+_END = object()
+
+
+class _PipelineFailure(object):
+    """ wraps an exception that aborts the whole pipeline (as opposed to a single item) """
+    def __init__(self, error):
+        self.error = error
+
+
+def load_image(img_fname):
+    """ default image loader: returns the image at img_fname as a numpy array """
+    with instrumentation.timer('decode'):
+        return np.array(Image.open(img_fname))
+
+
+def _completed_future(fn, *args):
+    """ run fn immediately and return the outcome wrapped in a completed Future """
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _producer(labels, load_fn, infer_fn, fit_fn, batch_size, max_prefetch,
+              load_executor, fit_executor, collect_metrics, out_queue, stop_event):
+    """ load and run inference on mini-batches, handing fit futures to out_queue in input order """
+
+    def put(entry):
+        # block on the bounded queue, but give up if the consumer has gone away
+        while not stop_event.is_set():
+            try:
+                out_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        pending_loads = collections.deque()
+        label_iter = iter(labels)
+        labels_exhausted = False
+        while not stop_event.is_set():
+            # keep the loaders busy ahead of the network
+            while not labels_exhausted and len(pending_loads) < max_prefetch:
+                try:
+                    label = next(label_iter)
+                except StopIteration:
+                    labels_exhausted = True
+                    break
+                pending_loads.append((label, load_executor.submit(load_fn, label)))
+            if len(pending_loads) == 0:
+                break
+
+            batch = [pending_loads.popleft() for _ in range(min(batch_size, len(pending_loads)))]
+            entries = [None,] * len(batch)
+            inputs = []
+            input_idx = []
+            for i, (label, load_future) in enumerate(batch):
+                try:
+                    inputs.append(load_future.result())
+                    input_idx.append(i)
+                except Exception as e:
+                    entries[i] = (label, None, e, 'load')
+
+            if len(inputs) > 0:
+                try:
+                    outputs = infer_fn(inputs)
+                    assert len(outputs) == len(inputs)
+                    for i, output in zip(input_idx, outputs):
+                        if fit_executor is None:
+                            fit_future = _completed_future(fit_fn, output)
+                        elif collect_metrics:
+                            fit_future = fit_executor.submit(instrumentation.call_and_collect, fit_fn, output)
+                        else:
+                            fit_future = fit_executor.submit(fit_fn, output)
+                        entries[i] = (batch[i][0], fit_future, None, None)
+                except Exception as e:
+                    for i in input_idx:
+                        entries[i] = (batch[i][0], None, e, 'infer')
+
+            for entry in entries:
+                if not put(entry):
+                    return
+    except Exception as e:
+        put(_PipelineFailure(e))
+        return
+    put(_END)
+
+
+def run_pipeline(labels, infer_fn, fit_fn, load_fn=load_image, batch_size=8, num_load_threads=4,
+                 fit_executor=None, max_in_flight=64):
+    """
+    Stream each label through load_fn -> infer_fn (on batches) -> fit_fn (on fit_executor, if given), yielding
+    a PipelineResult per label in input order, with error and stage set if a stage failed.
+    At most max_in_flight items are held between inference and the consumer.
+    """
+    out_queue = queue.Queue(maxsize=max_in_flight)
+    # metrics recorded while fitting in worker processes are sent back with each result
+    collect_metrics = instrumentation.is_enabled() and isinstance(fit_executor, concurrent.futures.ProcessPoolExecutor)
+    stop_event = threading.Event()
+    max_prefetch = max(2 * batch_size, num_load_threads)
+    with concurrent.futures.ThreadPoolExecutor(num_load_threads) as load_executor:
+        producer = threading.Thread(target=_producer,
+                                    args=(labels, load_fn, infer_fn, fit_fn, batch_size, max_prefetch,
+                                          load_executor, fit_executor, collect_metrics, out_queue, stop_event))
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                entry = out_queue.get()
+                if entry is _END:
+                    break
+                if isinstance(entry, _PipelineFailure):
+                    raise entry.error
+                label, fit_future, error, stage = entry
+                if fit_future is not None:
+                    try:
+                        value = fit_future.result()
+                        if collect_metrics:
+                            value, metrics = value
+                            instrumentation.merge(metrics)
+                    except Exception as e:
+                        error, stage = e, 'fit'
+                if error is None:
+                    yield PipelineResult(label=label, value=value, error=None, stage=None)
+                else:
+                    instrumentation.count('failed_' + stage)
+                    yield PipelineResult(label=label, value=None, error=error, stage=stage)
+        finally:
+            stop_event.set()
+            producer.join()
@@ -0,0 +1,174 @@
+"""
+Head pose tracking over the frames of a video: the network only runs on keyframes, cameras in between
+are interpolated (or held), and the subject coefficients, if tracked, are averaged until they converge.
+"""
+from collections import namedtuple
+import numpy as np
+from . import pipeline
+from . import geometry_utils
+from .backends import PITCH_OFFSET
+from .camera_decomposition import decompose_camera_rotation
+
+
+# camera_rotation (3,3) and camera_translation (3,) are those of the fitted or interpolated camera.
+# coefficients are set on keyframes when the subject is tracked, and error if the keyframe failed.
+FramePose = namedtuple('FramePose', ['index', 'yaw', 'pitch', 'roll', 'camera_rotation', 'camera_translation',
+                                     'keyframe', 'coefficients', 'error'])
+
+
+def interpolate_cameras(R0, T0, R1, T1, fractions):
+    """
+    interpolate between cameras (R0, T0) and (R1, T1) at the given fractions (0: first camera, 1: second):
+    rotations by spherical linear interpolation, and translations linearly.
+    Returns (N,3,3) rotations and (N,3) translations.
+    """
+    fractions = np.asarray(fractions, dtype=np.float64).reshape(-1)
+    q0 = geometry_utils.matrix_to_quaternion_batch(R0)
+    q1 = geometry_utils.matrix_to_quaternion_batch(R1)
+    R = geometry_utils.quaternion_to_matrix_batch(geometry_utils.slerp_quaternions_batch(q0, q1, fractions))
+    T0 = np.asarray(T0, dtype=np.float64).reshape(1,3)
+    T1 = np.asarray(T1, dtype=np.float64).reshape(1,3)
+    T = (1.0 - fractions[:,np.newaxis]) * T0 + fractions[:,np.newaxis] * T1
+    return R, T
+
+
+class PoseTracker(object):
+    """
+    Tracks the head pose over a sequence of frames using a dense estimator and fitter (see backends).
+    If track_subject, keyframes are fit with fit_coefficients until the subject converges (see _update_subject),
+    and with fit_expression afterwards.  init is passed to the fitter, which may ignore it (face3d does).
+    """
+    def __init__(self, dense_estimator, fitter, keyframe_interval=1, interpolate=True, track_subject=False,
+                 subject_tol=0.01, subject_patience=3, min_subject_keyframes=5, batch_size=1):
+        if keyframe_interval < 1:
+            raise ValueError('keyframe_interval must be at least 1')
+        self.dense_estimator = dense_estimator
+        self.fitter = fitter
+        self.keyframe_interval = keyframe_interval
+        self.interpolate = interpolate
+        self.track_subject = track_subject
+        self.subject_tol = subject_tol
+        self.subject_patience = subject_patience
+        self.min_subject_keyframes = min_subject_keyframes
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        """ forget the previous fits and subject estimate, e.g. at a shot change """
+        self.subject_coeffs = None
+        self.subject_converged = False
+        self.num_subject_keyframes = 0
+        self._num_stable = 0
+        self._last_camera = None
+        self._last_coeffs = None
+
+    def _update_subject(self, subject_coeffs):
+        """ add the subject coefficients of a keyframe to the running mean, and check for convergence """
+        subject_coeffs = np.asarray(subject_coeffs, dtype=np.float64)
+        self.num_subject_keyframes += 1
+        if self.subject_coeffs is None:
+            self.subject_coeffs = subject_coeffs.copy()
+            return
+        previous = self.subject_coeffs
+        self.subject_coeffs = previous + (subject_coeffs - previous) / self.num_subject_keyframes
+        change = np.linalg.norm(self.subject_coeffs - previous) / max(np.linalg.norm(self.subject_coeffs), 1e-12)
+        self._num_stable = self._num_stable + 1 if change < self.subject_tol else 0
+        if self._num_stable >= self.subject_patience and self.num_subject_keyframes >= self.min_subject_keyframes:
+            self.subject_converged = True
+
+    def _fit_keyframe(self, index, dense_output):
+        """ fit a keyframe, returning (camera, coefficients or None) """
+        PNCC, offsets = dense_output
+        if self.track_subject and not self.subject_converged:
+            coeffs = self.fitter.fit_coefficients('frame%d' % index, PNCC, offsets, init=self._last_coeffs)
+            self._last_coeffs = coeffs
+            self._update_subject(coeffs.subject_coeffs())
+            camera = coeffs.camera(0)
+        elif self.track_subject:
+            coeffs = self.fitter.fit_expression('frame%d' % index, PNCC, offsets, self.subject_coeffs,
+                                                init=self._last_coeffs)
+            self._last_coeffs = coeffs
+            camera = coeffs.camera(0)
+        else:
+            coeffs = None
+            camera = self.fitter.fit_camera(PNCC, offsets, init=self._last_camera)
+        self._last_camera = camera
+        return camera, coeffs
+
+    def _frame_pose(self, index, R, T, keyframe, coeffs=None, error=None):
+        yaw, pitch, roll = None, None, None
+        if R is not None:
+            yaw, pitch, roll = decompose_camera_rotation(R, pitch_offset=PITCH_OFFSET)
+        return FramePose(index=index, yaw=yaw, pitch=pitch, roll=roll, camera_rotation=R, camera_translation=T,
+                         keyframe=keyframe, coefficients=coeffs, error=error)
+
+    def track(self, frames, num_load_threads=1, max_in_flight=16):
+        """
+        Generator yielding a FramePose per frame of frames (an iterable of images), in order.
+        The network runs ahead of fitting by at most max_in_flight frames.
+        """
+        interval = self.keyframe_interval
+
+        def load(label):
+            index, frame = label
+            return frame if index % interval == 0 else None
+
+        def infer(frames_or_none):
+            keyframes = [f for f in frames_or_none if f is not None]
+            outputs = iter(self.dense_estimator(keyframes) if len(keyframes) > 0 else [])
+            return [next(outputs) if f is not None else None for f in frames_or_none]
+
+        # the pipeline's batches include the skipped frames, so scale the batch size to hold batch_size keyframes
+        labels = enumerate(frames)
+        results = pipeline.run_pipeline(labels, infer, lambda dense_output: dense_output, load_fn=load,
+                                        batch_size=self.batch_size * interval, num_load_threads=num_load_threads,
+                                        max_in_flight=max_in_flight)
+        last_key = None  # (index, R, T) of the last successfully fit keyframe
+        pending = []  # indices of frames waiting for the next keyframe to be interpolated
+        for result in results:
+            index = result.label[0]
+            if index % interval != 0:
+                if self.interpolate or last_key is None:
+                    pending.append(index)
+                else:
+                    yield self._frame_pose(index, last_key[1], last_key[2], False)
+                continue
+
+            error = result.error
+            if error is None:
+                try:
+                    camera, coeffs = self._fit_keyframe(index, result.value)
+                    R = np.asarray(camera.rotation.as_matrix(), dtype=np.float64)
+                    T = np.asarray(camera.translation, dtype=np.float64).reshape(3)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                # frames since the last keyframe are held at its camera
+                for pending_index in pending:
+                    yield self._held_or_failed(pending_index, last_key, error)
+                pending = []
+                yield self._frame_pose(index, None, None, True, error=error)
+                continue
+
+            if len(pending) > 0:
+                if last_key is not None:
+                    fractions = [(i - last_key[0]) / float(index - last_key[0]) for i in pending]
+                    Rs, Ts = interpolate_cameras(last_key[1], last_key[2], R, T, fractions)
+                    for i, pending_index in enumerate(pending):
+                        yield self._frame_pose(pending_index, Rs[i], Ts[i], False)
+                else:
+                    for pending_index in pending:
+                        yield self._frame_pose(pending_index, R, T, False)
+                pending = []
+            last_key = (index, R, T)
+            yield self._frame_pose(index, R, T, True, coeffs)
+
+        # frames after the last keyframe hold its camera
+        for pending_index in pending:
+            yield self._held_or_failed(pending_index, last_key, None)
+
+    def _held_or_failed(self, index, last_key, error):
+        if last_key is None:
+            return self._frame_pose(index, None, None, False,
+                                    error=error if error is not None else RuntimeError('No keyframe fit'))
+        return self._frame_pose(index, last_key[1], last_key[2], False)
@@ -0,0 +1,491 @@
+"""
+Long-running HTTP inference service (pose, coefficients, render, blend, metrics and health endpoints),
+micro-batching the network over concurrent requests.  Fitting, rendering and blending run on a single thread
+unless the backend is thread safe (face3d is not).
+"""
+import io
+import json
+import time
+import base64
+import signal
+import asyncio
+import threading
+import concurrent.futures
+import numpy as np
+from PIL import Image
+from . import backends
+from . import instrumentation
+from .subject_model import camera_to_arrays
+
+
+class ServiceBackend(object):
+    """
+    base class of service backends: a dense_estimator and fitter (see backends), plus render(coeffs) and
+    blend(images, coeffs_list, weights).  If not thread_safe, the service calls them from a single thread.
+    """
+    dense_estimator = None
+    fitter = None
+    thread_safe = False
+
+    def render(self, coeffs):
+        raise NotImplementedError()
+
+    def blend(self, images, coeffs_list, weights):
+        raise NotImplementedError()
+
+
+class Face3dServiceBackend(ServiceBackend):
+    """ the pix2face network, face3d fitting and rendering, and subject_blend.face_blender """
+    def __init__(self, pix2face_net=None, cuda_device=0, pix2face_data=None):
+        import pix2face.test
+        from . import coefficient_estimation
+        if pix2face_net is None:
+            pix2face_net = pix2face.test.load_pretrained_model(cuda_device=cuda_device)
+        if pix2face_data is None:
+            pix2face_data = coefficient_estimation.load_pix2face_data()
+        self.pix2face_data = pix2face_data
+        self.dense_estimator = backends.Pix2FaceDenseEstimator(pix2face_net, cuda_device)
+        self.fitter = backends.Face3dFitter(pix2face_data, cuda_device)
+        self.cuda_device = cuda_device
+        self._blender = None
+        self._blender_lock = threading.Lock()
+
+    def render(self, coeffs):
+        from . import coefficient_estimation
+        return coefficient_estimation.render_coefficients(coeffs, self.pix2face_data)
+
+    def blend(self, images, coeffs_list, weights):
+        from . import subject_blend
+        with self._blender_lock:
+            if self._blender is None:
+                self._blender = subject_blend.face_blender(self.cuda_device, load_pix2face_model=False)
+        # textures are extracted in the calling thread, since face3d is not thread safe
+        return self._blender.blend_faces(images, coeffs_list, weights, num_threads=0)
+
+
+class SyntheticServiceBackend(ServiceBackend):
+    """
+    synthetic dense estimator and fitter (with simulated costs, see backends).  Renderings are the
+    synthetic PNCC of the fitted pose, and blends are weighted averages of the images.
+    """
+    thread_safe = True
+
+    def __init__(self, seconds_per_image=0.0, seconds_per_batch=0.0, seconds_per_fit=0.0, output_shape=None):
+        self.dense_estimator = backends.SyntheticDenseEstimator(output_shape, seconds_per_image, seconds_per_batch)
+        self.fitter = backends.SyntheticFitter(seconds_per_fit)
+
+    def render(self, coeffs):
+        camera = coeffs.camera(0)
+        yaw, pitch, _ = backends.head_pose(camera)
+        PNCC, _ = backends.synthetic_dense_output(camera.ny, camera.nx, yaw, pitch)
+        return PNCC
+
+    def blend(self, images, coeffs_list, weights):
+        height, width = images[0].shape[0:2]
+        blended = np.zeros((height, width, 3), np.float64)
+        for image, weight in zip(images, weights):
+            resized = np.array(Image.fromarray(_to_rgb(image)).resize((width, height), Image.BILINEAR))
+            blended += weight * resized
+        return np.clip(blended / sum(weights), 0, 255).astype(np.uint8)
+
+
+class ServiceError(Exception):
+    """ an error returned to the client with the given HTTP status """
+    def __init__(self, status, message):
+        super(ServiceError, self).__init__(message)
+        self.status = status
+
+
+_STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   411: 'Length Required', 413: 'Payload Too Large', 422: 'Unprocessable Entity',
+                   500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def _to_rgb(image):
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = np.stack((image,) * 3, axis=2)
+    return image[:, :, 0:3]
+
+
+def _to_uint8(image):
+    """ convert a float image in [0,1] (or a uint8 image) to uint8 """
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = (255 * np.clip(image, 0, 1) + 0.5).astype(np.uint8)
+    return image
+
+
+def decode_image(data):
+    """ decode an encoded image file to an RGB numpy array """
+    try:
+        with instrumentation.timer('decode'):
+            return np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+    except Exception as e:
+        raise ServiceError(400, 'Could not decode image: %s' % e)
+
+
+def encode_png(image):
+    fd = io.BytesIO()
+    Image.fromarray(_to_uint8(image)).save(fd, format='PNG')
+    return fd.getvalue()
+
+
+class MicroBatcher(object):
+    """
+    Collects items submitted from the event loop into batches of at most max_batch_size, waiting at most
+    max_wait seconds after the first item of a batch for more to arrive, and calls fn(list of items) once per
+    batch on executor (fn must return one result per item).  While a batch runs, the next one accumulates.
+    """
+    def __init__(self, fn, executor, max_batch_size=8, max_wait=0.005, metrics=None, name='batch'):
+        self.fn = fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.name = name
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item):
+        """ return the result of fn for item, once its batch has run """
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            # requests may have been abandoned (e.g. the client disconnected) while queued
+            batch = [b for b in batch if not b[1].done()]
+            if len(batch) == 0:
+                continue
+            items, futures, submit_times = zip(*batch)
+            t0 = time.perf_counter()
+            if self.metrics is not None:
+                for submit_time in submit_times:
+                    self.metrics.record_time(self.name + '_queue_wait', t0 - submit_time)
+                # the number of batches is the count of the batch timer
+                self.metrics.increment(self.name + '_items', len(items))
+            try:
+                results = await loop.run_in_executor(self.executor, self.fn, list(items))
+                if len(results) != len(items):
+                    raise RuntimeError('%s returned %d results for %d items' % (self.name, len(results), len(items)))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                if self.metrics is not None:
+                    self.metrics.record_time(self.name, time.perf_counter() - t0)
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class InferenceService(object):
+    """
+    HTTP inference service (see the module documentation).  At most max_pending requests are processed
+    at once (others get 503); num_threads serve decoding and encoding, and num_fit_workers > 0 fit in processes.
+    """
+    def __init__(self, backend, max_batch_size=8, max_batch_wait=0.005, max_pending=64, num_threads=4,
+                 num_fit_workers=0, max_body_size=32*1024*1024):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.max_body_size = max_body_size
+        self.metrics = instrumentation.MetricsRegistry()
+        self.num_pending = 0
+        self._thread_pool = concurrent.futures.ThreadPoolExecutor(num_threads)
+        # the dense estimator runs one batch at a time on its own thread, as the network would on a GPU
+        self._network_executor = concurrent.futures.ThreadPoolExecutor(1)
+        # fitting, rendering and blending of backends that are not thread safe run on a single thread
+        self._backend_executor = self._thread_pool
+        if not backend.thread_safe:
+            self._backend_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._fit_executor = self._backend_executor
+        self._pack = num_fit_workers > 0
+        if num_fit_workers > 0:
+            self._fit_executor = concurrent.futures.ProcessPoolExecutor(num_fit_workers)
+        self.batcher = MicroBatcher(backend.dense_estimator, self._network_executor, max_batch_size, max_batch_wait,
+                                    metrics=self.metrics, name='network_batch')
+        self.routes = {('POST', '/pose'): self.pose,
+                       ('POST', '/coefficients'): self.coefficients,
+                       ('POST', '/render'): self.render,
+                       ('POST', '/blend'): self.blend,
+                       ('GET', '/metrics'): self.metrics_text,
+                       ('GET', '/health'): self.health}
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """ start accepting connections, returning the asyncio server """
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        await self.batcher.stop()
+        self._thread_pool.shutdown()
+        self._network_executor.shutdown()
+        if self._backend_executor is not self._thread_pool:
+            self._backend_executor.shutdown()
+        if self._fit_executor is not self._backend_executor:
+            self._fit_executor.shutdown()
+
+    def serve_forever(self, host='127.0.0.1', port=8080):
+        """ run the service until interrupted """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(self.start(host, port))
+        print('Serving on %s' % ', '.join(str(s.getsockname()) for s in server.sockets))
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, loop.stop)
+            except NotImplementedError:
+                # e.g. Windows: KeyboardInterrupt is caught below
+                pass
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+    async def _run_in_threads(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._thread_pool, fn, *args)
+
+    async def _run_in_backend(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._backend_executor, fn, *args)
+
+    async def _dense_output(self, image_data):
+        image = await self._run_in_threads(decode_image, image_data)
+        PNCC, offsets = await self.batcher.submit(image)
+        return image, PNCC, offsets
+
+    async def _fit_coefficients(self, image_data, img_label='img0'):
+        image, PNCC, offsets = await self._dense_output(image_data)
+        loop = asyncio.get_event_loop()
+        t0 = time.perf_counter()
+        try:
+            coeffs = await loop.run_in_executor(self._fit_executor, backends._fit_coefficients,
+                                                self.backend.fitter, self._pack, (img_label, PNCC, offsets))
+            if self._pack:
+                coeffs = self.backend.fitter.unpack(coeffs)
+        except Exception as e:
+            raise ServiceError(422, 'Coefficient estimation failed: %s' % e)
+        finally:
+            self.metrics.record_time('fit_coefficients', time.perf_counter() - t0)
+        return image, coeffs
+
+    async def pose(self, body, content_type):
+        _, PNCC, offsets = await self._dense_output(_image_data(body, content_type))
+        t0 = time.perf_counter()
+        try:
+            yaw, pitch, roll = await asyncio.get_event_loop().run_in_executor(
+                self._fit_executor, backends._fit_head_pose, self.backend.fitter, (PNCC, offsets))
+        except Exception as e:
+            raise ServiceError(422, 'Camera estimation failed: %s' % e)
+        finally:
+            self.metrics.record_time('fit_camera', time.perf_counter() - t0)
+        return _json_response(dict(yaw=float(yaw), pitch=float(pitch), roll=float(roll)))
+
+    async def coefficients(self, body, content_type):
+        _, coeffs = await self._fit_coefficients(_image_data(body, content_type))
+        camera = dict((name, np.asarray(value).tolist()) for name, value in camera_to_arrays(coeffs.camera(0)).items())
+        return _json_response(dict(subject_coeffs=np.asarray(coeffs.subject_coeffs()).tolist(),
+                                   expression_coeffs=np.asarray(coeffs.expression_coeffs(0)).tolist(),
+                                   camera=camera))
+
+    async def render(self, body, content_type):
+        _, coeffs = await self._fit_coefficients(_image_data(body, content_type))
+        rendering = await self._run_in_backend(self.backend.render, coeffs)
+        png = await self._run_in_threads(encode_png, rendering)
+        return 200, 'image/png', png
+
+    async def blend(self, body, content_type):
+        request = _json_body(body)
+        try:
+            images_data = [base64.b64decode(data) for data in request['images']]
+        except Exception:
+            raise ServiceError(400, 'Expected JSON {"images": [<base64>, ..], "weights": [..]}')
+        if len(images_data) == 0:
+            raise ServiceError(400, 'No images to blend')
+        weights = request.get('weights')
+        if weights is None:
+            weights = [1.0 / len(images_data)] * len(images_data)
+        if len(weights) != len(images_data):
+            raise ServiceError(400, 'Number of weights does not match the number of images')
+        fits = await asyncio.gather(*[self._fit_coefficients(data, 'img%d' % i) for i, data in enumerate(images_data)])
+        images, coeffs_list = zip(*fits)
+        blended = await self._run_in_backend(self.backend.blend, list(images), list(coeffs_list),
+                                             [float(w) for w in weights])
+        png = await self._run_in_threads(encode_png, blended)
+        return 200, 'image/png', png
+
+    async def metrics_text(self, body, content_type):
+        text = instrumentation.prometheus_text(prefix='pix2face_service', registry=self.metrics)
+        text += 'pix2face_service_pending_requests %d\n' % self.num_pending
+        if instrumentation.is_enabled():
+            text += instrumentation.prometheus_text()
+        return 200, 'text/plain; version=0.0.4', text.encode('utf-8')
+
+    async def health(self, body, content_type):
+        return _json_response(dict(status='ok', pending=self.num_pending))
+
+    async def _dispatch(self, method, path, body, content_type):
+        """ return (status, content type, body bytes) """
+        handler = self.routes.get((method, path))
+        if handler is None:
+            if any(p == path for _, p in self.routes):
+                raise ServiceError(405, 'Method %s not allowed for %s' % (method, path))
+            raise ServiceError(404, 'No such endpoint: %s' % path)
+        if method != 'POST':
+            return await handler(body, content_type)
+        if self.num_pending >= self.max_pending:
+            self.metrics.increment('rejected')
+            raise ServiceError(503, 'Too many pending requests')
+        endpoint = path.lstrip('/')
+        self.num_pending += 1
+        t0 = time.perf_counter()
+        try:
+            self.metrics.increment('requests_' + endpoint)
+            return await handler(body, content_type)
+        except Exception:
+            self.metrics.increment('errors_' + endpoint)
+            raise
+        finally:
+            self.num_pending -= 1
+            self.metrics.record_time('request_' + endpoint, time.perf_counter() - t0)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader, self.max_body_size)
+                if request is None:
+                    break
+                method, path, headers, body, keep_alive = request
+                try:
+                    status, content_type, response = await self._dispatch(method, path, body,
+                                                                          headers.get('content-type', ''))
+                except ServiceError as e:
+                    status, content_type, response = _error_response(e.status, str(e))
+                except Exception as e:
+                    status, content_type, response = _error_response(500, '%s: %s' % (type(e).__name__, e))
+                _write_response(writer, status, content_type, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ServiceError as e:
+            # malformed request: respond and close the connection
+            status, content_type, response = _error_response(e.status, str(e))
+            _write_response(writer, status, content_type, response, keep_alive=False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def _image_data(body, content_type):
+    """ return the encoded image of a request: the body itself, or the base64 "image" of a JSON body """
+    if content_type.startswith('application/json'):
+        try:
+            return base64.b64decode(_json_body(body)['image'])
+        except (KeyError, TypeError, ValueError):
+            raise ServiceError(400, 'Expected JSON {"image": <base64>}')
+    if len(body) == 0:
+        raise ServiceError(400, 'Empty request body')
+    return body
+
+
+def _json_body(body):
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise ServiceError(400, 'Invalid JSON')
+
+
+def _json_response(value, status=200):
+    return status, 'application/json', json.dumps(value).encode('utf-8')
+
+
+def _error_response(status, message):
+    return _json_response(dict(error=message), status)
+
+
+async def _read_request(reader, max_body_size):
+    """ read an HTTP/1.x request, returning (method, path, headers, body, keep_alive), or None at end of stream """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise ServiceError(400, 'Malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', 'identity').lower() != 'identity':
+        raise ServiceError(411, 'Chunked requests are not supported; send Content-Length')
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise ServiceError(400, 'Invalid Content-Length')
+    if length > max_body_size:
+        raise ServiceError(413, 'Request body larger than %d bytes' % max_body_size)
+    body = await reader.readexactly(length) if length > 0 else b''
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+    return method.upper(), target.split('?')[0], headers, body, keep_alive
+
+
+def _write_response(writer, status, content_type, body, keep_alive):
+    header = ('HTTP/1.1 %d %s\r\n'
+              'Content-Type: %s\r\n'
+              'Content-Length: %d\r\n'
+              'Connection: %s\r\n' % (status, _STATUS_REASONS.get(status, ''), content_type, len(body),
+                                      'keep-alive' if keep_alive else 'close'))
+    if status == 503:
+        header += 'Retry-After: 1\r\n'
+    writer.write(header.encode('latin-1') + b'\r\n' + body)
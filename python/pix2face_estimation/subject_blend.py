@@ -1,70 +1,261 @@
+import collections
+import concurrent.futures
 import numpy as np
 import pix2face.test
 from . import mesh_renderer
 from . import coefficient_estimation
+from . import mesh_cache
+from . import instrumentation
 import face3d
 import cv2
 
 
+def texture_res_for_image(img_shape, max_res=512, min_res=64):
+    """
+    Return the texture resolution needed for rendering into an image of shape img_shape:
+    the smallest power-of-two multiple of min_res with at least as many texels per side as the image has pixels,
+    limited to max_res.
+    """
+    needed = max(img_shape[0:2])
+    texture_res = min_res
+    while texture_res < needed and texture_res < max_res:
+        texture_res *= 2
+    return min(texture_res, max_res)
+
+
+def resize_texture(tex, texture_res):
+    """ resample a square texture to texture_res x texture_res """
+    if tex.shape[0] == texture_res and tex.shape[1] == texture_res:
+        return tex
+    interpolation = cv2.INTER_AREA if texture_res < tex.shape[0] else cv2.INTER_LINEAR
+    return cv2.resize(tex, (texture_res, texture_res), interpolation=interpolation)
+
+
+COMPOSITE_MODES = ('seamless', 'seamless_roi', 'feather')
+
+
+def _seamless_clone_mask(render_alpha):
+    """ binary uint8 mask of the rendered face """
+    render_mask = (render_alpha * 255).astype(np.uint8)
+    render_mask[render_mask < 10] = 0
+    render_mask[render_mask > 0] = 255
+    return render_mask
+
+
+def composite_seamless(img, render_rgb, render_mask):
+    """ Poisson blend the rendered face into the full image """
+    render_mask = render_mask.copy()
+    # setting the corners makes the mask bounding box the full image, so the rendering is not shifted
+    render_mask[0,0] = 255
+    render_mask[-1,-1] = 255
+    return cv2.seamlessClone(render_rgb, img, render_mask, (img.shape[1]//2, img.shape[0]//2), cv2.NORMAL_CLONE)
+
+
+def composite_seamless_roi(img, render_rgb, render_mask, margin=8):
+    """
+    Poisson blend the rendered face into img, solving only within the bounding box of the mask
+    (plus margin pixels).  The solution is the same as composite_seamless up to the effect of the
+    more distant image border, at a cost proportional to the face area rather than the image area.
+    """
+    rows = np.flatnonzero(render_mask.any(axis=1))
+    cols = np.flatnonzero(render_mask.any(axis=0))
+    if len(rows) == 0:
+        return img.copy()
+    r0 = max(rows[0] - margin, 0)
+    r1 = min(rows[-1] + margin + 1, img.shape[0])
+    c0 = max(cols[0] - margin, 0)
+    c1 = min(cols[-1] + margin + 1, img.shape[1])
+    img_out = img.copy()
+    img_out[r0:r1, c0:c1] = composite_seamless(np.ascontiguousarray(img[r0:r1, c0:c1]),
+                                               np.ascontiguousarray(render_rgb[r0:r1, c0:c1]),
+                                               np.ascontiguousarray(render_mask[r0:r1, c0:c1]))
+    return img_out
+
+
+def composite_feather(img, render_rgb, render_mask, feather_radius=3):
+    """ alpha blend the rendered face into img, with the mask edge smoothed over about feather_radius pixels """
+    alpha = cv2.erode(render_mask, np.ones((3,3), np.uint8), iterations=feather_radius).astype(np.float32) / 255
+    ksize = 2 * feather_radius + 1
+    alpha = cv2.GaussianBlur(alpha, (ksize, ksize), 0)[:,:,np.newaxis]
+    img_out = alpha * render_rgb + (1.0 - alpha) * img
+    return np.clip(img_out + 0.5, 0, 255).astype(np.uint8)
+
+
+def composite_rendering(img, render_walpha, mode='seamless'):
+    """ composite a rendered RGBA float image (as returned by face3d.texture_to_image_float) into img """
+    render_rgb = (render_walpha[:,:,0:3]*255).astype(np.uint8)
+    render_mask = _seamless_clone_mask(render_walpha[:,:,3])
+    if mode == 'seamless':
+        return composite_seamless(img, render_rgb, render_mask)
+    elif mode == 'seamless_roi':
+        return composite_seamless_roi(img, render_rgb, render_mask)
+    elif mode == 'feather':
+        return composite_feather(img, render_rgb, render_mask)
+    raise ValueError('Unknown composite mode: ' + str(mode))
+
+
+class TextureAccumulator(object):
+    """
+    Accumulates the weighted average of RGBA textures in place, in float32.
+    RGB values are averaged over the observed (alpha-weighted) pixels; the output alpha is the probability
+    that a texel was observed in at least one texture.
+    """
+    def __init__(self, texture_res):
+        self.texture_res = texture_res
+        self.num_textures = 0
+        # planar RGB so that each channel update is a contiguous in-place operation
+        self.weighted_rgb = np.zeros((3, texture_res, texture_res), np.float32)
+        self.weight_sum = np.zeros((texture_res, texture_res), np.float32)
+        self.unobserved_prob = np.ones((texture_res, texture_res), np.float32)
+        self._scratch = np.empty((texture_res, texture_res), np.float32)
+        self._scratch_rgb = np.empty((texture_res, texture_res), np.float32)
+
+    def add(self, tex, weight=1.0):
+        """ add an RGBA texture with RGB in the range [0,255] and alpha in [0,1] """
+        assert tex.shape[0:2] == (self.texture_res, self.texture_res)
+        tex_alpha = tex[:,:,3]
+        # RGB is scaled to [0,1] and weighted by alpha
+        np.multiply(tex_alpha, weight/255.0, out=self._scratch)
+        for c in range(3):
+            np.multiply(tex[:,:,c], self._scratch, out=self._scratch_rgb)
+            self.weighted_rgb[c] += self._scratch_rgb
+        np.multiply(tex_alpha, weight, out=self._scratch)
+        self.weight_sum += self._scratch
+        np.subtract(1.0, tex_alpha, out=self._scratch)
+        self.unobserved_prob *= self._scratch
+        self.num_textures += 1
+
+    def result(self):
+        """ return the blended (texture_res, texture_res, 4) float32 RGBA texture """
+        weight_sum = self.weight_sum.copy()
+        weight_sum[weight_sum < 1e-6] = 1.0
+        tex_rgba = np.empty((self.texture_res, self.texture_res, 4), np.float32)
+        for c in range(3):
+            np.divide(self.weighted_rgb[c], weight_sum, out=tex_rgba[:,:,c])
+        np.subtract(1.0, self.unobserved_prob, out=tex_rgba[:,:,3])
+        return tex_rgba
+
+
 class face_blender(object):
-    def __init__(self, cuda_device=None, load_pix2face_model=True):
+    def __init__(self, cuda_device=None, load_pix2face_model=True, texture_res=512, level_of_detail=False, min_texture_res=64,
+                 composite_mode='seamless'):
+        """
+        texture_res is the full texture resolution; with level_of_detail, textures are resampled to the coarsest
+        resolution (not below min_texture_res) sufficient for the target image.  composite_mode is one of COMPOSITE_MODES.
+        """
+        if composite_mode not in COMPOSITE_MODES:
+            raise ValueError('Unknown composite mode: ' + str(composite_mode))
         if load_pix2face_model:
             self.pix2face_net = pix2face.test.load_pretrained_model(cuda_device)
         else:
             self.pix2face_net = None
         self.pix2face_data = coefficient_estimation.load_pix2face_data()
         self.cuda_device = cuda_device
-        self.texture_res = 512
-
-    def img2tex(self, img, coeffs):
-        renderer = mesh_renderer.get_mesh_renderer()
-        head_mesh_warped = face3d.head_mesh(self.pix2face_data.head_mesh)
-        head_mesh_warped.apply_coefficients(self.pix2face_data.subject_components,
-                                            self.pix2face_data.expression_components,
-                                            coeffs.subject_coeffs(), coeffs.expression_coeffs(0))
-        tex = face3d.image_to_texture_float(img, head_mesh_warped, coeffs.camera(0), renderer)
-        return tex
+        self.texture_res = texture_res
+        self.level_of_detail = level_of_detail
+        self.min_texture_res = min_texture_res
+        self.composite_mode = composite_mode
 
-    def composite_texture(self, img, subj_coeffs, expr_coeffs, camera, tex):
-        renderer = mesh_renderer.get_mesh_renderer()
-        head_mesh_warped = face3d.head_mesh(self.pix2face_data.head_mesh)
-        head_mesh_warped.apply_coefficients(self.pix2face_data.subject_components,
-                                            self.pix2face_data.expression_components,
-                                            subj_coeffs, expr_coeffs)
-        render_walpha = face3d.texture_to_image_float(tex, head_mesh_warped, camera, renderer)
-        render_rgb = (render_walpha[:,:,0:3]*255).astype(np.uint8)
-        render_mask = (render_walpha[:,:,3] * 255).astype(np.uint8)
-        render_mask[render_mask < 10] = 0
-        render_mask[render_mask > 0] = 255
-        render_mask[0,0] = 255
-        render_mask[-1,-1] = 255
-        img_out = cv2.seamlessClone(render_rgb, img, render_mask, (img.shape[1]//2, img.shape[0]//2), cv2.NORMAL_CLONE)
+    def texture_res_for_image(self, img):
+        """ return the texture resolution used for blending into img """
+        if not self.level_of_detail:
+            return self.texture_res
+        return texture_res_for_image(img.shape, self.texture_res, self.min_texture_res)
+
+    def img2tex(self, img, coeffs, texture_res=None):
+        """
+        extract the texture of img (at face3d's native resolution), resampled to texture_res
+        (default: the full texture resolution)
+        """
+        head_mesh_warped = mesh_cache.warped_head_mesh(self.pix2face_data, coeffs.subject_coeffs(), coeffs.expression_coeffs(0))
+        with mesh_renderer.renderer() as renderer, instrumentation.timer('texture_extraction'):
+            tex = face3d.image_to_texture_float(img, head_mesh_warped, coeffs.camera(0), renderer)
+        if texture_res is None:
+            texture_res = self.texture_res
+        return resize_texture(tex, texture_res)
+
+    def composite_texture(self, img, subj_coeffs, expr_coeffs, camera, tex, mode=None):
+        """
+        render the RGBA texture tex onto img
+        mode is one of COMPOSITE_MODES (default: the blender's composite_mode)
+        """
+        head_mesh_warped = mesh_cache.warped_head_mesh(self.pix2face_data, subj_coeffs, expr_coeffs)
+        with mesh_renderer.renderer() as renderer, instrumentation.timer('render'):
+            render_walpha = face3d.texture_to_image_float(tex, head_mesh_warped, camera, renderer)
+        if mode is None:
+            mode = self.composite_mode
+        with instrumentation.timer('composite_' + mode):
+            img_out = composite_rendering(img, render_walpha, mode)
         return img_out
 
-    def blend_faces(self, image_list, coeff_list, weights=None):
-        weighted_tex_rgb = np.zeros((self.texture_res, self.texture_res, 3), np.float32)
-        weight_sum_img = np.zeros((self.texture_res, self.texture_res))
-        obs_prob = np.ones((self.texture_res, self.texture_res))
+    def blend_faces(self, image_list, coeff_list, weights=None, num_threads=None):
         if weights is None:
             weights = [1.0/len(image_list),] * len(image_list)
         assert len(image_list) == len(coeff_list) == len(weights)
-        for img, img_coeffs, weight in zip(image_list, coeff_list, weights):
-            tex = self.img2tex(img, img_coeffs)
-            tex_rgb = tex[:,:,0:3]/255
-            tex_alpha = tex[:,:,3]
-            #tex_rgba = np.concatenate((tex_rgb, np.expand_dims(tex_alpha,axis=2)),axis=2)
-            weighted_tex_rgb += weight * tex_rgb * np.expand_dims(tex_alpha,2)
-            weight_sum_img += weight*tex_alpha
-            obs_prob *= (1.0 - tex_alpha)
-
-        obs_prob = 1.0 - obs_prob
-        weight_sum_img[weight_sum_img < 1e-6] = 1.0
-        weighted_tex_rgb /= np.expand_dims(weight_sum_img,2)
-        weighted_tex_rgba = np.concatenate((weighted_tex_rgb, np.expand_dims(obs_prob,2)),axis=2)
-        subj_coeffs = np.mean([coeffs.subject_coeffs() for coeffs in coeff_list], axis=0)
-        expr_coeffs = np.mean([coeffs.expression_coeffs(0) for coeffs in coeff_list], axis=0)
-        final_img = self.composite_texture(image_list[0], subj_coeffs, expr_coeffs, coeff_list[0].camera(0), weighted_tex_rgba)
-        return final_img
+        return self.blend_face_stream(zip(image_list, coeff_list, weights), num_threads)
+
+    def blend_face_stream(self, sightings, num_threads=None):
+        """
+        Blend a lazily consumed stream of (image, coeffs[, weight]) sightings into the first image.
+        Textures are extracted by num_threads threads (default: the renderer pool's executor, 0: the calling thread).
+        """
+        pool = mesh_renderer.get_renderer_pool()
+        if num_threads is None:
+            num_threads = pool.max_size
+            executor = pool.executor
+        elif num_threads == 0:
+            executor = None
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+        accumulator = None
+        first_sighting = None
+        subj_coeffs_sum = None
+        expr_coeffs_sum = None
+        pending = collections.deque()
+
+        def accumulate_next():
+            tex_future, weight = pending.popleft()
+            accumulator.add(tex_future.result(), weight)
+
+        try:
+            for sighting in sightings:
+                img, img_coeffs = sighting[0:2]
+                weight = sighting[2] if len(sighting) > 2 else 1.0
+                subj_coeffs = np.array(img_coeffs.subject_coeffs())
+                expr_coeffs = np.array(img_coeffs.expression_coeffs(0))
+                if first_sighting is None:
+                    # the first image is the compositing target, and determines the texture resolution
+                    first_sighting = (img, img_coeffs)
+                    texture_res = self.texture_res_for_image(img)
+                    accumulator = TextureAccumulator(texture_res)
+                    subj_coeffs_sum = subj_coeffs
+                    expr_coeffs_sum = expr_coeffs
+                else:
+                    subj_coeffs_sum += subj_coeffs
+                    expr_coeffs_sum += expr_coeffs
+                if executor is None:
+                    accumulator.add(self.img2tex(img, img_coeffs, texture_res), weight)
+                    continue
+                pending.append((executor.submit(self.img2tex, img, img_coeffs, texture_res), weight))
+                # bound the number of textures in flight
+                while len(pending) > 2 * num_threads:
+                    accumulate_next()
+            while len(pending) > 0:
+                accumulate_next()
+        finally:
+            if executor is not None and executor is not pool.executor:
+                executor.shutdown()
+
+        if first_sighting is None:
+            raise ValueError('No sightings to blend')
+        first_img, first_coeffs = first_sighting
+        subj_coeffs = subj_coeffs_sum / accumulator.num_textures
+        expr_coeffs = expr_coeffs_sum / accumulator.num_textures
+        composite_args = (first_img, subj_coeffs, expr_coeffs, first_coeffs.camera(0), accumulator.result())
+        if executor is pool.executor:
+            # the pool's threads may hold all of its renderers, so composite on one of them
+            return executor.submit(self.composite_texture, *composite_args).result()
+        return self.composite_texture(*composite_args)
 
     def blend_face_images(self, img1, img2, weight1=0.5):
         """
@@ -0,0 +1,233 @@
+"""
+Incremental joint estimation of the subject coefficients of an identity from sightings arriving over time.
+The offsets are linear in the coefficients, so eliminating each sighting's expression coefficients leaves a fixed
+(S,S) matrix and (S,) vector per sighting, which is all that is kept.
+"""
+from collections import namedtuple
+import numpy as np
+import scipy.spatial
+from . import instrumentation
+from .pca_reconstruction import ShapeReconstructor
+
+
+# statistics kept per sighting:
+#   H (S,S), g (S,): contribution to the reduced normal equations of the subject coefficients
+#   expression_gain (E,S), expression_offset (E,): expression_coeffs = expression_offset - expression_gain . subject_coeffs
+#   num_samples: number of offset samples used
+#   camera: dictionary of camera arrays (see camera_to_arrays), or None
+SightingStatistics = namedtuple('SightingStatistics', ['label', 'H', 'g', 'expression_gain', 'expression_offset',
+                                                       'num_samples', 'camera'])
+
+
+def camera_to_arrays(camera):
+    """ convert camera parameters (e.g. face3d.perspective_camera_parameters) to a dictionary of arrays """
+    return dict(rotation=np.array(camera.rotation.as_matrix(), dtype=np.float64).reshape(3,3),
+                translation=np.array(camera.translation, dtype=np.float64).reshape(3),
+                focal_length=float(camera.focal_len),
+                principal_point=np.array(camera.principal_point, dtype=np.float64).reshape(2),
+                image_size=np.array((camera.nx, camera.ny), dtype=np.int32))
+
+
+class IncrementalSubjectModel(object):
+    """
+    Subject coefficients jointly estimated from all sightings added so far, plus expression coefficients (and,
+    optionally, a camera) per sighting.  Regularization weights are relative to the sum of squared offset residuals;
+    fitter, if given, fits the camera of sightings added without one.
+    """
+    def __init__(self, reconstructor, subject_regularization=1.0, expression_regularization=1.0,
+                 subject_ranges=None, expression_ranges=None, max_samples_per_sighting=4096,
+                 max_vertex_distance=None, fitter=None):
+        self.reconstructor = reconstructor
+        self.subject_regularization = subject_regularization
+        self.expression_regularization = expression_regularization
+        self.subject_ranges = None if subject_ranges is None else np.asarray(subject_ranges, dtype=np.float64)
+        self.expression_ranges = None if expression_ranges is None else np.asarray(expression_ranges, dtype=np.float64)
+        self.max_samples_per_sighting = max_samples_per_sighting
+        self.max_vertex_distance = max_vertex_distance
+        self.fitter = fitter
+        self.num_subject_coeffs = reconstructor.subject_components.shape[0]
+        self.num_expression_coeffs = reconstructor.expression_components.shape[0]
+        self._vertex_tree = scipy.spatial.cKDTree(reconstructor.mean_vertices())
+        self.clear()
+
+    @classmethod
+    def from_pix2face_data(cls, pix2face_data, mean_fname='mean_face_head.ply', **kwargs):
+        """ construct using the (truncated) PCA components and coefficient ranges of a Pix2FaceData instance """
+        reconstructor = ShapeReconstructor.from_pix2face_data(pix2face_data, mean_fname=mean_fname, dtype=np.float64)
+        num_subject_coeffs = reconstructor.subject_components.shape[0]
+        num_expression_coeffs = reconstructor.expression_components.shape[0]
+        kwargs.setdefault('subject_ranges', np.array(pix2face_data.subject_ranges)[0:num_subject_coeffs])
+        kwargs.setdefault('expression_ranges', np.array(pix2face_data.expression_ranges)[0:num_expression_coeffs])
+        return cls(reconstructor, **kwargs)
+
+    def clear(self):
+        """ remove all sightings """
+        self.sightings = []
+        self._H = np.zeros((self.num_subject_coeffs, self.num_subject_coeffs))
+        self._g = np.zeros(self.num_subject_coeffs)
+        self._subject_coeffs = None
+
+    def __len__(self):
+        return len(self.sightings)
+
+    @property
+    def labels(self):
+        return [s.label for s in self.sightings]
+
+    def _samples(self, PNCC, offsets):
+        """ return the (N,) mean face vertex indices and (N,3) offsets of the sampled foreground pixels """
+        PNCC = np.asarray(PNCC, dtype=np.float64).reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.float64).reshape(-1, 3)
+        foreground = np.nonzero(np.any(PNCC != 0, axis=1) & np.all(np.isfinite(PNCC), axis=1) &
+                                np.all(np.isfinite(offsets), axis=1))[0]
+        if len(foreground) > self.max_samples_per_sighting:
+            foreground = foreground[np.linspace(0, len(foreground) - 1, self.max_samples_per_sighting).astype(np.int64)]
+        distance_bound = np.inf if self.max_vertex_distance is None else self.max_vertex_distance
+        distances, vertex_indices = self._vertex_tree.query(PNCC[foreground], distance_upper_bound=distance_bound)
+        found = np.isfinite(distances)
+        return vertex_indices[found], offsets[foreground[found]]
+
+    def _components(self, components, vertex_indices):
+        """ return the (3N,K) columns of components (K,3V) of the given vertices """
+        columns = (3 * vertex_indices[:, np.newaxis] + np.arange(3)).reshape(-1)
+        return np.asarray(components[:, columns], dtype=np.float64).T
+
+    def sighting_statistics(self, label, PNCC, offsets, camera=None):
+        """
+        Compute the statistics of a sighting from the network output, without adding it to the model.
+        Raises ValueError if no foreground pixels correspond to the mean face.
+        """
+        with instrumentation.timer('subject_model_statistics'):
+            vertex_indices, sample_offsets = self._samples(PNCC, offsets)
+            if len(vertex_indices) == 0:
+                raise ValueError('No foreground pixels in sighting ' + str(label))
+            # residual: offsets - S s - E e
+            S = self._components(self.reconstructor.subject_components, vertex_indices)
+            E = self._components(self.reconstructor.expression_components, vertex_indices)
+            o = sample_offsets.reshape(-1)
+            A = np.dot(S.T, S)
+            B = np.dot(S.T, E)
+            C = np.dot(E.T, E) + self.expression_regularization * np.eye(E.shape[1])
+            a = np.dot(S.T, o)
+            b = np.dot(E.T, o)
+            # minimizing over e for fixed s gives e = C^-1 (b - B^T s)
+            expression_gain = np.linalg.solve(C, B.T)
+            expression_offset = np.linalg.solve(C, b)
+            H = A - np.dot(B, expression_gain)
+            g = a - np.dot(B, expression_offset)
+        if camera is not None and not isinstance(camera, dict):
+            camera = camera_to_arrays(camera)
+        return SightingStatistics(label=label, H=0.5 * (H + H.T), g=g, expression_gain=expression_gain,
+                                  expression_offset=expression_offset, num_samples=len(vertex_indices),
+                                  camera=camera)
+
+    def add_statistics(self, statistics):
+        """ add a sighting's statistics (see sighting_statistics), returning the sighting's index """
+        self.sightings.append(statistics)
+        self._H += statistics.H
+        self._g += statistics.g
+        self._subject_coeffs = None
+        return len(self.sightings) - 1
+
+    def add_sighting(self, label, PNCC, offsets, camera=None):
+        """
+        Add a sighting given the network's PNCC and offsets images, returning its index.
+        If camera is None and the model has a fitter, the camera is fit to the sighting.
+        """
+        if camera is None and self.fitter is not None:
+            camera = self.fitter.fit_camera(PNCC, offsets)
+        return self.add_statistics(self.sighting_statistics(label, PNCC, offsets, camera))
+
+    def remove_sighting(self, index):
+        """ remove a sighting (e.g. one found to be of a different identity), returning its statistics """
+        statistics = self.sightings.pop(index)
+        self._H -= statistics.H
+        self._g -= statistics.g
+        self._subject_coeffs = None
+        return statistics
+
+    def subject_coeffs(self):
+        """ the (S,) subject coefficients minimizing the residuals over all sightings """
+        if self._subject_coeffs is None:
+            H = self._H + self.subject_regularization * np.eye(self.num_subject_coeffs)
+            subject_coeffs = np.linalg.solve(H, self._g)
+            if self.subject_ranges is not None:
+                subject_coeffs = np.clip(subject_coeffs, self.subject_ranges[:,0], self.subject_ranges[:,1])
+            self._subject_coeffs = subject_coeffs
+        return self._subject_coeffs
+
+    def expression_coeffs(self, index):
+        """ the (E,) expression coefficients of a sighting, given the current subject coefficients """
+        statistics = self.sightings[index]
+        expression_coeffs = statistics.expression_offset - np.dot(statistics.expression_gain, self.subject_coeffs())
+        if self.expression_ranges is not None:
+            expression_coeffs = np.clip(expression_coeffs, self.expression_ranges[:,0], self.expression_ranges[:,1])
+        return expression_coeffs
+
+    def to_arrays(self):
+        """
+        Return the coefficients of all sightings with a camera as a dictionary of column arrays, as used by
+        coefficient_archive (see coefficient_archive.arrays_to_coefficients)
+        """
+        indices = [i for i, s in enumerate(self.sightings) if s.camera is not None]
+        cameras = [self.sightings[i].camera for i in indices]
+        subject_coeffs = self.subject_coeffs()
+        return dict(image_ids=[self.sightings[i].label for i in indices],
+                    subject_coeffs=np.tile(subject_coeffs, (len(indices), 1)),
+                    expression_coeffs=np.array([self.expression_coeffs(i) for i in indices]).reshape(len(indices), -1),
+                    rotation=np.array([c['rotation'] for c in cameras]).reshape(-1,3,3),
+                    translation=np.array([c['translation'] for c in cameras]).reshape(-1,3),
+                    focal_length=np.array([c['focal_length'] for c in cameras], dtype=np.float64),
+                    principal_point=np.array([c['principal_point'] for c in cameras]).reshape(-1,2),
+                    image_size=np.array([c['image_size'] for c in cameras], dtype=np.int32).reshape(-1,2))
+
+    def to_coefficients(self):
+        """ return a face3d subject_perspective_sighting_coefficients object (requires a camera per sighting) """
+        from . import coefficient_archive
+        if any(s.camera is None for s in self.sightings):
+            raise ValueError('All sightings must have a camera')
+        return coefficient_archive.arrays_to_coefficients(**self.to_arrays())
+
+    def save(self, fname):
+        """ save the sighting statistics to fname (.npz), so that sightings may be added in a later session """
+        n = len(self.sightings)
+        has_camera = np.array([s.camera is not None for s in self.sightings], dtype=bool)
+        cameras = [s.camera for s in self.sightings if s.camera is not None]
+        with open(fname, 'wb') as fd:
+            np.savez(fd,
+                     labels=np.array([str(s.label) for s in self.sightings]),
+                     H=np.array([s.H for s in self.sightings]).reshape(n, self.num_subject_coeffs, self.num_subject_coeffs),
+                     g=np.array([s.g for s in self.sightings]).reshape(n, self.num_subject_coeffs),
+                     expression_gain=np.array([s.expression_gain for s in self.sightings]).reshape(
+                         n, self.num_expression_coeffs, self.num_subject_coeffs),
+                     expression_offset=np.array([s.expression_offset for s in self.sightings]).reshape(
+                         n, self.num_expression_coeffs),
+                     num_samples=np.array([s.num_samples for s in self.sightings], dtype=np.int64),
+                     has_camera=has_camera,
+                     rotation=np.array([c['rotation'] for c in cameras]).reshape(-1,3,3),
+                     translation=np.array([c['translation'] for c in cameras]).reshape(-1,3),
+                     focal_length=np.array([c['focal_length'] for c in cameras], dtype=np.float64),
+                     principal_point=np.array([c['principal_point'] for c in cameras]).reshape(-1,2),
+                     image_size=np.array([c['image_size'] for c in cameras], dtype=np.int32).reshape(-1,2))
+
+    def load(self, fname):
+        """ replace the sightings with those saved to fname by save() """
+        with np.load(fname) as data:
+            if data['H'].shape[1:] != (self.num_subject_coeffs, self.num_subject_coeffs) or \
+                    data['expression_gain'].shape[1:] != (self.num_expression_coeffs, self.num_subject_coeffs):
+                raise ValueError('Number of coefficients does not match saved subject model')
+            self.clear()
+            camera_index = 0
+            for i, label in enumerate(data['labels']):
+                camera = None
+                if data['has_camera'][i]:
+                    camera = dict(rotation=data['rotation'][camera_index], translation=data['translation'][camera_index],
+                                  focal_length=float(data['focal_length'][camera_index]),
+                                  principal_point=data['principal_point'][camera_index],
+                                  image_size=data['image_size'][camera_index])
+                    camera_index += 1
+                self.add_statistics(SightingStatistics(label=str(label), H=data['H'][i], g=data['g'][i],
+                                                       expression_gain=data['expression_gain'][i],
+                                                       expression_offset=data['expression_offset'][i],
+                                                       num_samples=int(data['num_samples'][i]), camera=camera))
+        return self
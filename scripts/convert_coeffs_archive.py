@@ -0,0 +1,34 @@
+""" Convert between per-image coefficient text files and a packed coefficient archive
+"""
+import os
+import sys
+import glob
+from pix2face_estimation import coefficient_archive
+
+
+def import_dir(coeffs_dir, archive_dir):
+    """ append all coefficient files in coeffs_dir to the archive at archive_dir """
+    coeff_fnames = sorted(glob.glob(os.path.join(coeffs_dir, '*.txt')))
+    with coefficient_archive.CoefficientArchive(archive_dir, 'a') as archive:
+        num_imported = coefficient_archive.import_text_files(coeff_fnames, archive)
+        print("imported {} files, archive contains {} sightings".format(num_imported, len(archive)))
+
+
+def export_dir(archive_dir, coeffs_dir):
+    """ write one coefficient text file per record of the archive at archive_dir """
+    if not os.path.isdir(coeffs_dir):
+        os.makedirs(coeffs_dir)
+    with coefficient_archive.CoefficientArchive(archive_dir, 'r') as archive:
+        output_fnames = coefficient_archive.export_text_files(archive, coeffs_dir)
+    print("exported {} files".format(len(output_fnames)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export'):
+        print("USAGE: {} import <coeffs_dir> <archive_dir>".format(sys.argv[0]))
+        print("       {} export <archive_dir> <coeffs_dir>".format(sys.argv[0]))
+        sys.exit(-1)
+    if sys.argv[1] == 'import':
+        import_dir(sys.argv[2], sys.argv[3])
+    else:
+        export_dir(sys.argv[2], sys.argv[3])
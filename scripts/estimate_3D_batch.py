@@ -2,19 +2,32 @@
 
 import numpy as np
 import os
+import time
 from PIL import Image, ImageFile
-import face3d
-import vxl
 import pix2face
+import pix2face_estimation.coefficient_estimation
+from pix2face_estimation.job_manifest import JobManifest
+from pix2face_estimation import dense_output
+from pix2face_estimation import instrumentation
 import glob
-import skimage.external.tifffile as tifffile
 import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument('input_dir')
 parser.add_argument('output_dir')
+parser.add_argument('--manifest', default=None, help='job manifest file (default: <output_dir>/3D_manifest.sqlite)')
+parser.add_argument('--retry_failed', action='store_true', help='retry images that failed in a previous run')
+parser.add_argument('--output_format', default='tiff', choices=('tiff', 'npz'), help='one TIFF per image and channel, or compressed NPZ shards')
+parser.add_argument('--channels', default='PNCC,offsets,3d', help='comma-separated list of dense outputs to write (3d = PNCC + offsets)')
+parser.add_argument('--dtype', default='float32', choices=dense_output.DTYPES, help='storage type of the dense outputs')
+parser.add_argument('--max_abs_value', type=float, default=1.0, help='quantization range of int16 storage of PNCC and offsets')
+parser.add_argument('--max_abs_value_3d', type=float, default=2.0, help='quantization range of int16 storage of the 3d channel')
+parser.add_argument('--profile', default=None, help='write per-stage timings to this file (.json, or .prom for Prometheus text format)')
 args = parser.parse_args()
 
+if args.profile is not None:
+    instrumentation.enable()
+
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -22,7 +35,15 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 data_dir = args.input_dir
 output_dir = args.output_dir
-img_filenames = glob.glob(data_dir + '/*.jpg')
+img_filenames = sorted(glob.glob(data_dir + '/*.jpg'))
+
+# skip images completed (or failed) in a previous run
+manifest_fname = args.manifest
+if manifest_fname is None:
+    manifest_fname = os.path.join(output_dir, '3D_manifest.sqlite')
+manifest = JobManifest(manifest_fname)
+img_filenames = manifest.remaining(img_filenames, retry_failed=args.retry_failed)
+print('%d images remaining to process' % len(img_filenames))
 
 this_dir = os.path.dirname(__file__)
 pix2face_data_dir = os.path.join(this_dir, '../pix2face/data/')
@@ -30,52 +51,76 @@ pix2face_data_dir = os.path.join(this_dir, '../pix2face/data/')
 model_fname = os.path.join(pix2face_data_dir, 'models/pix2face_unet_v10.pt')
 model = pix2face.test.load_model(model_fname)
 
+pvr_data_dir = os.path.join(this_dir, '../face3d/data_3DMM/')
+
+num_subject_coeffs = 199  # max 199
+num_expression_coeffs = 29  # max 29
+
+# load needed data files and create coefficient estimator (once, not per image)
+mm_data = pix2face_estimation.coefficient_estimation.load_pix2face_data(pvr_data_dir, num_subject_coeffs, num_expression_coeffs)
+coeff_estimator = mm_data.coeff_estimator
+
+# dense outputs are written on a background thread.  Images are marked done once their outputs are on disk.
+max_abs_values = {'PNCC': args.max_abs_value, 'offsets': args.max_abs_value, '3d': args.max_abs_value_3d}
+channels = args.channels.split(',')
+writer = dense_output.create_writer(output_dir, args.output_format, channels, args.dtype, max_abs_values, raise_errors=False)
+for channel in channels:
+    print('Dense output %s max storage error: %g' % (channel, dense_output.max_error(args.dtype, max_abs_values[channel])))
+
+# image filename and start time of each image whose outputs are queued for writing
+pending_writes = {}
+
+
+def record_writes(completed):
+    """ mark images done (or failed) once the writer has written (or failed to write) their outputs """
+    for basename, error in completed:
+        img_fname, t0 = pending_writes.pop(basename)
+        if error is None:
+            manifest.mark_done(img_fname, time.time() - t0)
+        else:
+            print('ERROR writing outputs of %s: %s' % (img_fname, error))
+            manifest.mark_failed(img_fname, time.time() - t0, '%s: %s' % (type(error).__name__, error))
+
 
 for img_fname in img_filenames:
-    img = np.array(Image.open(img_fname))
-    print('Estimating PNCC + Offsets..')
-    outputs = pix2face.test.test(model, [img,])
-    pncc = outputs[0][0]
-    offsets = outputs[0][1]
-    print('..Done')
-
-    pvr_data_dir = os.path.join(this_dir, '../face3d/data_3DMM/')
-    debug_dir = ''
-    debug_mode = False
-
-    num_subject_coeffs = 199  # max 199
-    num_expression_coeffs = 29  # max 29
-
-    # load needed data files
-    head_mesh = face3d.head_mesh(pvr_data_dir)
-    subject_components = np.load(os.path.join(pvr_data_dir, 'pca_components_subject.npy'))
-    expression_components = np.load(os.path.join(pvr_data_dir, 'pca_components_expression.npy'))
-    subject_ranges = np.load(os.path.join(pvr_data_dir,'pca_coeff_ranges_subject.npy'))
-    expression_ranges = np.load(os.path.join(pvr_data_dir,'pca_coeff_ranges_expression.npy'))
-
-    # keep only the PCA components that we will be estimating
-    subject_components = vxl.vnl.matrix(subject_components[0:num_subject_coeffs,:])
-    expression_components = vxl.vnl.matrix(expression_components[0:num_expression_coeffs,:])
-    subject_ranges = vxl.vnl.matrix(subject_ranges[0:num_subject_coeffs,:])
-    expression_ranges = vxl.vnl.matrix(expression_ranges[0:num_expression_coeffs,:])
-
-    # create coefficient estimator
-    coeff_estimator = face3d.media_coefficient_from_PNCC_and_offset_estimator(head_mesh, subject_components, expression_components, subject_ranges, expression_ranges, debug_mode, debug_dir)
-
-    basename = os.path.basename(os.path.splitext(img_fname)[0])
-    output_basename = os.path.join(output_dir, basename)
-
-    # Estimate Coefficients from PNCC and Offsets
-    print('Estimating Coefficients..')
-    img_ids = [basename,]
-    coeffs, result = coeff_estimator.estimate_coefficients_perspective(img_ids, [pncc,], [offsets,])
-    if not result.success:
-        print('ERROR estimating coefficients for ' + img_fname)
-        continue
-    print('..Done.')
-
-    coeffs.save(output_basename + '_coeffs.txt')
-    tifffile.imsave(output_basename + '_PNCC.tiff', pncc)
-    tifffile.imsave(output_basename + '_offsets.tiff', offsets)
-    img3d = pncc + offsets
-    tifffile.imsave(output_basename + '_3d.tiff', img3d)
+    t0 = time.time()
+    try:
+        with instrumentation.timer('decode'):
+            img = np.array(Image.open(img_fname))
+        print('Estimating PNCC + Offsets..')
+        with instrumentation.timer('network'):
+            outputs = pix2face.test.test(model, [img,])
+        pncc = outputs[0][0]
+        offsets = outputs[0][1]
+        print('..Done')
+
+        basename = os.path.basename(os.path.splitext(img_fname)[0])
+        output_basename = os.path.join(output_dir, basename)
+
+        # Estimate Coefficients from PNCC and Offsets
+        print('Estimating Coefficients..')
+        img_ids = [basename,]
+        with instrumentation.timer('fit_coefficients'):
+            coeffs, result = coeff_estimator.estimate_coefficients_perspective(img_ids, [pncc,], [offsets,])
+        if not result.success:
+            print('ERROR estimating coefficients for ' + img_fname)
+            manifest.mark_failed(img_fname, time.time() - t0, 'Coefficient Estimation Failed')
+            continue
+        print('..Done.')
+
+        coeffs.save(output_basename + '_coeffs.txt')
+        pending_writes[basename] = (img_fname, t0)
+        writer.write(basename, pncc, offsets)
+    except Exception as e:
+        # record the failure, so that the image is only retried with --retry_failed
+        print('ERROR processing %s: %s' % (img_fname, e))
+        manifest.mark_failed(img_fname, time.time() - t0, '%s: %s' % (type(e).__name__, e))
+    record_writes(writer.pop_completed())
+
+writer.close()
+record_writes(writer.pop_completed())
+print('Manifest status: ' + str(manifest.counts()))
+manifest.close()
+if args.profile is not None:
+    print(instrumentation.format_summary())
+    instrumentation.write_metrics(args.profile)
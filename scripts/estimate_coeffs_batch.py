@@ -2,10 +2,15 @@
 """
 import sys
 import os
+import time
 import numpy as np
 from PIL import Image, ImageFile
 import pix2face.test
 import pix2face_estimation.coefficient_estimation
+from pix2face_estimation import batch_runner
+from pix2face_estimation.job_manifest import JobManifest
+from pix2face_estimation import coefficient_archive
+from pix2face_estimation.output_index import OutputIndex
 from torch.multiprocessing import Pool
 
 # set cuda_device to an integer value to run on a GPU, set to None to run on CPU
@@ -24,36 +29,64 @@ num_expression_coeffs=20
 num_dirs_in_id = 1  # /a/b/c.jpg -> c_coeffs.txt
 
 num_threads = 4
+chunk_size = 128
+
+# job manifest, written to the output directory
+manifest_fname = 'coeffs_manifest.sqlite'
+
+# 'text' writes one <id>_coeffs.txt file per image
+# 'archive' appends all coefficients to a single packed archive at <output_dir>/<archive_dirname>
+output_format = 'text'
+archive_dirname = 'coeffs_archive'
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 this_dir = os.path.dirname(__file__)
 pvr_data_dir = os.path.join(this_dir,'../face3d/data_3DMM')
 
-# load the 3DMM data
-mm_data = pix2face_estimation.coefficient_estimation.load_pix2face_data(pvr_data_dir, num_subject_coeffs, num_expression_coeffs)
-
 
-def process_chunk(fnames):
-    # load the pix2face network
+def init_worker(output_dir):
+    """ load the pix2face network and 3DMM data once per worker """
     pix2face_net = pix2face.test.load_pretrained_model(cuda_device=cuda_device)
+    mm_data = pix2face_estimation.coefficient_estimation.load_pix2face_data(pvr_data_dir, num_subject_coeffs, num_expression_coeffs)
+    return pix2face_net, mm_data, output_dir
+
+
+def output_basename(img_fname):
+    splitpath = os.path.normpath(img_fname).split(os.sep)
+    return os.path.splitext('_'.join(splitpath[-num_dirs_in_id:]))[0]
+
+
+def process_chunk(worker_state, fnames):
+    pix2face_net, mm_data, output_dir = worker_state
+    t0 = time.time()
     images = [np.array(Image.open(f)) for f in fnames]
 
     coeffs_list = pix2face_estimation.coefficient_estimation.estimate_coefficients_batch(images, pix2face_net, mm_data, cuda_device=cuda_device, img_labels=fnames)
     assert len(coeffs_list) == len(fnames)
+    # the network runs on the whole chunk at once, so report the mean time per image
+    elapsed = (time.time() - t0) / len(fnames)
+    item_results = []
     for coeffs, img_fname in zip(coeffs_list, fnames):
         print(img_fname)
         if coeffs is None:
             print('Failed to estimate coefficients for ' + img_fname)
+            item_results.append(batch_runner.ItemResult(img_fname, False, elapsed, 'Coefficient Estimation Failed', None))
             continue
-        splitpath = os.path.normpath(img_fname).split(os.sep)
-        basename = os.path.splitext('_'.join(splitpath[-num_dirs_in_id:]))[0]
-        output_fname = os.path.join(output_dir, basename + '_coeffs.txt')
-        coeffs.save(output_fname)
-    return
+        basename = output_basename(img_fname)
+        if output_format == 'archive':
+            # the parent process appends to the archive, so hand back the packed arrays
+            columns = coefficient_archive.coefficients_to_arrays(coeffs)
+            image_ids = columns.pop('image_ids')
+            item_results.append(batch_runner.ItemResult(img_fname, True, elapsed, None, (basename + '_coeffs', image_ids, columns)))
+        else:
+            output_fname = os.path.join(output_dir, basename + '_coeffs.txt')
+            coeffs.save(output_fname)
+            item_results.append(batch_runner.ItemResult(img_fname, True, elapsed, None, None))
+    return item_results
 
 
-def main(input_fname, output_dir):
+def main(input_fname, output_dir, retry_failed=False):
     # open input file, read one filename per line
     img_fnames = []
     with open(input_fname, 'r') as ifd:
@@ -65,22 +98,49 @@ def main(input_fname, output_dir):
             img_fnames.append(img_fname)
     print('Read %d image filenames' % len(img_fnames))
 
-    chunk_size = 128
-    chunks = [img_fnames[i:i+chunk_size] for i in range(0,len(img_fnames),chunk_size)]
-    if num_threads > 1:
-        pool = Pool(num_threads)
-        _ = pool.map(process_chunk, chunks)
-    else:
-        for chunk in chunks:
-            process_chunk(chunk)
+    # the manifest records which images have been processed, so that an interrupted run can be resumed
+    with JobManifest(os.path.join(output_dir, manifest_fname)) as manifest:
+        img_fnames = manifest.remaining(img_fnames, retry_failed=retry_failed)
+        if output_format == 'text':
+            # skip images with existing coefficient files (e.g. from runs without a manifest),
+            # listing the output directory once rather than checking each file.
+            # They are recorded as done, so that later runs skip them without scanning again.
+            existing = OutputIndex()
+            existing.scan_dir(output_dir)
+            has_output = [os.path.join(output_dir, output_basename(f) + '_coeffs.txt') in existing for f in img_fnames]
+            manifest.record((f, True, None, None) for f, done in zip(img_fnames, has_output) if done)
+            img_fnames = [f for f, done in zip(img_fnames, has_output) if not done]
+        print('%d images remaining to process' % len(img_fnames))
+
+        archive = None
+        if output_format == 'archive':
+            archive = coefficient_archive.CoefficientArchive(os.path.join(output_dir, archive_dirname), 'a',
+                                                             num_subject_coeffs, num_expression_coeffs)
+
+        def record_chunk(stats):
+            if archive is not None:
+                archive.append_many([r.output for r in stats.item_results if r.success])
+            manifest.record(stats.item_results)
+
+        summary = batch_runner.run_chunked(img_fnames, init_worker, process_chunk, init_args=(output_dir,),
+                                           chunk_size=chunk_size, num_workers=num_threads, pool_factory=Pool,
+                                           chunk_callback=record_chunk)
+        print(summary.report())
+        if archive is not None:
+            print('Archive contains %d sightings' % len(archive))
+            archive.close()
+        print('Manifest status: ' + str(manifest.counts()))
     print('done.')
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('Usage: ' + sys.argv[0] + ' <input_file> <output_dir>')
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] != '--retry_failed'):
+        print('Usage: ' + sys.argv[0] + ' <input_file> <output_dir> [--retry_failed]')
         print('  <input_file> should contain a list of image filenames')
         print('  One coefficients file per image will be written to <output_dir>.')
+        print('  Progress is recorded in <output_dir>/' + manifest_fname + ', and images already processed are skipped.')
+        print('  Images that previously failed are only retried if --retry_failed is given.')
         sys.exit(-1)
     input_fname = sys.argv[1]
     output_dir = sys.argv[2]
-    main(input_fname, output_dir)
+    retry_failed = len(sys.argv) == 4
+    main(input_fname, output_dir, retry_failed)
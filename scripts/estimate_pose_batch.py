@@ -1,8 +1,7 @@
 """ This Script Demonstrates the basic image -> PNCC + offsets --> camera estimation pipeline
 """
 import sys
-import numpy as np
-from PIL import Image, ImageFile
+from PIL import ImageFile
 import pix2face.test
 import pix2face_estimation.camera_estimation
 import os
@@ -15,24 +14,41 @@ else:
     print("Running on cuda device %s" % cuda_device)
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# number of images passed through the network at once
+batch_size = 8
+# number of image decoding threads
+num_load_threads = 4
+# number of camera fitting processes, None for one per core
+num_fit_workers = None
+
+
+def read_filenames(input_fname):
+    with open(input_fname, 'r') as ifd:
+        for line in ifd:
+            img_fname = line.strip()
+            if img_fname:
+                yield img_fname
+
 
 def main(input_fname, output_fname):
     # load the pix2face network
     pix2face_net = pix2face.test.load_pretrained_model(cuda_device=cuda_device)
-    # open input and output files, process one file per line
-    with open(output_fname, 'w') as ofd, open(input_fname, 'r') as ifd:
+    results = pix2face_estimation.camera_estimation.estimate_head_pose_stream(read_filenames(input_fname), pix2face_net,
+                                                                               cuda_device=cuda_device,
+                                                                               batch_size=batch_size,
+                                                                               num_load_threads=num_load_threads,
+                                                                               num_fit_workers=num_fit_workers)
+    # open output file, results arrive in the same order as the input file
+    with open(output_fname, 'w') as ofd:
         # write header for output
         ofd.write('FILENAME, HEAD_YAW, HEAD_PITCH, HEAD_ROLL\n')
-        # for each line in the input file
-        for line in ifd:
-            img_fname = line.strip()
-            print(img_fname)
-            # load the image
-            img = np.array(Image.open(img_fname))
-            # estimate yaw,pitch,roll
-            pose = pix2face_estimation.camera_estimation.estimate_head_pose(img, pix2face_net, cuda_device=cuda_device)
+        for result in results:
+            print(result.label)
+            if result.error is not None:
+                print('Failed to estimate pose for %s: %s' % (result.label, result.error))
+                continue
             # write out the pose values to the output CSV file
-            ofd.write(img_fname + ', %0.1f, %0.1f, %0.1f\n' % pose)
+            ofd.write(result.label + ', %0.1f, %0.1f, %0.1f\n' % tuple(result.value))
 
 
 if __name__ == '__main__':
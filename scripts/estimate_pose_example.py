@@ -5,6 +5,7 @@ import os
 from PIL import Image, ImageFile
 import pix2face.test
 import pix2face_estimation.camera_estimation
+from pix2face_estimation import instrumentation
 
 # Set this to an integer value to run on a CUDA device, None for CPU.
 cpu_only = int(os.environ.get("CPU_ONLY")) != 0
@@ -17,6 +18,9 @@ else:
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# record the time spent in the network and in camera fitting
+instrumentation.enable()
+
 this_dir = os.path.dirname(__file__)
 img_fname = os.path.join(this_dir, '../pix2face_net/data', 'CASIA_0000107_004.jpg')
 img = np.array(Image.open(img_fname))
@@ -40,3 +44,4 @@ total_elapsed = t1 - t0
 
 print('yaw, pitch, roll = %0.1f, %0.1f, %0.1f' % pose)
 print('Total Elapsed = %0.1f s : Average %0.2f s / image' % (total_elapsed, total_elapsed / num_test_images))
+print(instrumentation.format_summary())
@@ -1,34 +1,76 @@
 import os
 import sys
+import numpy as np
 import face3d
 import pix2face_estimation.camera_estimation as camera_estimation
+from pix2face_estimation import coefficient_archive
 
 
-def main(coeffs_dir, output_csv_fname):
+def read_rotations_from_text_files(coeffs_dir):
     """
-    Read all coeffs files from coeffs_dir, and save all poses in a single csv file.
+    Read all coeffs files from coeffs_dir.
+    Returns the list of image filenames and an (N,3,3) array of camera rotations, one per sighting.
     """
-    assert os.path.isdir(coeffs_dir), "coeffs_dir not a directory"
     coeff_fnames = sorted(os.listdir(coeffs_dir))
+    chip_fnames = []
+    rotations = []
+    for coeff_fname in coeff_fnames:
+        coeff_path = os.path.join(coeffs_dir, coeff_fname)
+        coeffs = face3d.subject_perspective_sighting_coefficients(coeff_path)
+        for i in range(coeffs.num_sightings):
+            rotations.append(coeffs.camera(i).rotation.as_matrix())
+            chip_fnames.append(coeffs.image_filename(i))
+    print("read {} sightings from {} files".format(len(chip_fnames), len(coeff_fnames)))
+    return chip_fnames, np.array(rotations).reshape(-1,3,3)
 
-    num_images = 0
-    with open(output_csv_fname, 'w') as fd:
-        fd.write("FILENAME,YAW,PITCH,ROLL\n")
-        for coeff_fname in coeff_fnames:
-            coeff_path = os.path.join(coeffs_dir, coeff_fname)
-            coeffs = face3d.subject_perspective_sighting_coefficients(coeff_path)
-            for i in range(coeffs.num_sightings):
-                yaw, pitch, roll = camera_estimation.extract_head_pose(coeffs.camera(i))
-                chip_fname = coeffs.image_filename(i)
-                fd.write("{}, {:0.3f}, {:0.3f}, {:0.3f}\n".format(chip_fname, yaw, pitch, roll))
-                num_images += 1
 
-    print("wrote {} poses from {} files".format(num_images, len(coeff_fnames)))
+def write_poses(output_fname, chip_fnames, poses):
+    """
+    Write poses in bulk.  The format is chosen by the extension of output_fname:
+    .npz (numpy arrays 'filenames' and 'poses'), .parquet (requires pandas and pyarrow), or CSV otherwise.
+    """
+    ext = os.path.splitext(output_fname)[1].lower()
+    if ext == '.npz':
+        np.savez(output_fname, filenames=np.array(chip_fnames), poses=poses)
+    elif ext == '.parquet':
+        try:
+            import pandas
+        except ImportError:
+            raise RuntimeError("Writing parquet files requires pandas and pyarrow")
+        df = pandas.DataFrame({'FILENAME': chip_fnames, 'YAW': poses[:,0], 'PITCH': poses[:,1], 'ROLL': poses[:,2]})
+        df.to_parquet(output_fname, index=False)
+    else:
+        with open(output_fname, 'w') as fd:
+            fd.write("FILENAME,YAW,PITCH,ROLL\n")
+            fd.writelines("{}, {:0.3f}, {:0.3f}, {:0.3f}\n".format(chip_fname, *pose)
+                          for chip_fname, pose in zip(chip_fnames, poses.tolist()))
+
+
+def main(coeffs_path, output_fname):
+    """
+    Read all coeffs from coeffs_path (a directory of coeffs files, or a coefficient archive),
+    and save all poses in a single file.
+    """
+    assert os.path.isdir(coeffs_path), "coeffs_path not a directory"
+
+    if coefficient_archive.is_archive(coeffs_path):
+        with coefficient_archive.CoefficientArchive(coeffs_path, 'r') as archive:
+            chip_fnames = archive.image_ids
+            rotations = np.asarray(archive.rotations)
+    else:
+        chip_fnames, rotations = read_rotations_from_text_files(coeffs_path)
+
+    # yaw, pitch, and roll of all sightings in a single call
+    poses = camera_estimation.extract_head_pose_from_rotations(rotations)
+    write_poses(output_fname, chip_fnames, poses)
+
+    print("wrote {} poses".format(len(chip_fnames)))
 
 if __name__ == '__main__':
     if len(sys.argv) != 3:
-        print("USAGE: {} <coeffs_dir> <output_csv_fname>".format(sys.argv[0]))
+        print("USAGE: {} <coeffs_dir_or_archive> <output_fname>".format(sys.argv[0]))
+        print("  <output_fname> may have extension .csv, .npz, or .parquet")
         sys.exit(-1)
-    coeffs_dir = sys.argv[1]
-    output_csv_fname = sys.argv[2]
-    main(coeffs_dir, output_csv_fname)
+    coeffs_path = sys.argv[1]
+    output_fname = sys.argv[2]
+    main(coeffs_path, output_fname)
@@ -1,84 +1,53 @@
+""" Render 3D pose jitters of MS-Celeb-1M chips using previously estimated coefficients
+"""
 import os
-import face3d
-import time
-import numpy as np
-from PIL import Image
-from multiprocessing import Pool
 import sys
+import argparse
+from pix2face_estimation import jitter
+from pix2face_estimation import instrumentation
 
 this_dir = os.path.dirname(__file__)
-pvr_data_path = os.path.join(this_dir,'../face3d/data_3DMM')
 
-if not os.path.isdir(pvr_data_path):
-    print("%s does not exist!" % pvr_data_path)
-    sys.exit()
 
-msceleb1m_coeffs_path = '/data3/data/msceleb1m/msceleb1m_filtered_plus_vggface2_coeffs.csv'
-msceleb1m_jitter_dir = '/data3/data/msceleb1m/msceleb1m_jitters'
+def main():
+    parser = argparse.ArgumentParser(description='Render 3D pose jitters of face chips')
+    parser.add_argument('coeffs_csv', help='file with lines of the form <chip path>,<coefficients path>')
+    parser.add_argument('output_dir', help='jitters are written to <output_dir>/<subject id>/<chip id>_jitter_<i>.jpg')
+    parser.add_argument('--pvr_data_dir', default=os.path.join(this_dir, '../face3d/data_3DMM'))
+    parser.add_argument('--min_yaw', type=float, default=30)
+    parser.add_argument('--max_yaw', type=float, default=90)
+    parser.add_argument('--num_jitters', type=int, default=1)
+    parser.add_argument('--force_rewrite', action='store_true', help='re-render chips whose jitters already exist')
+    parser.add_argument('--egl_devices', default='0', help='comma-separated list of EGL devices, assigned to workers in turn')
+    parser.add_argument('--jobs', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--chunk_size', type=int, default=32, help='number of chips handed to a worker at a time')
+    parser.add_argument('--output_index', default=None,
+                        help='file listing existing outputs, read instead of listing output_dir, and updated after the run')
+    parser.add_argument('--print_rate', type=int, default=1000, help='report throughput every this many chips')
+    parser.add_argument('--profile', default=None,
+                        help='write per-stage timings to this file (.json, or .prom for Prometheus text format)')
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrumentation.enable()
+
+    if not os.path.isdir(args.pvr_data_dir):
+        print("%s does not exist!" % args.pvr_data_dir)
+        sys.exit(-1)
+
+    settings = jitter.make_settings(args.pvr_data_dir, args.output_dir, min_yaw=args.min_yaw, max_yaw=args.max_yaw,
+                                    num_jitters=args.num_jitters, force_rewrite=args.force_rewrite,
+                                    egl_devices=[int(d) for d in args.egl_devices.split(',')])
+    with open(args.coeffs_csv, 'r') as fd:
+        lines = fd.readlines()
+
+    summary = jitter.run_jitter(lines, settings, num_workers=args.jobs, chunk_size=args.chunk_size,
+                                report_every=args.print_rate, output_index_fname=args.output_index,
+                                progress_fn=print)
+    print(summary.report())
+    if args.profile is not None:
+        print(instrumentation.format_summary())
+        instrumentation.write_metrics(args.profile)
 
-min_yaw = 30
-max_yaw = 90
-egl_device = 5
-force_rewrite = False
-N_jitters = 1
-jobs = 4
-print_rate = 1000
-
-
-def category_index(path):
-    return os.path.basename(os.path.dirname(path))
-
-
-def chip_id(path):
-    return os.path.splitext(os.path.basename(path))[0]
-
-
-def process_line(line, jitterer):
-    parts = line.split(',')  # expects the chip path and the corresponding coefficient file path separated by comma
-    chip_path = parts[0]
-    coeff_path = parts[1]
-    if not os.path.isfile(coeff_path):
-        # print('coeff for  %s does not exist' % chip_path)
-        return
-    id = category_index(coeff_path)
-    # print("ID found %s" % id)
-    output_dir = os.path.join(msceleb1m_jitter_dir, id)
-    if not os.path.isdir(output_dir):
-        os.makdir(output_dir)
-    chipID = chip_id(chip_path)
-    output_f = os.path.join(output_dir, "%s_jitter_0.jpg" % chipID)
-    if os.path.isfile(output_f) and not force_rewrite:
-        # print("%s already exists !" % output_f)
-        return
-    else:
-        image = np.array(Image.open(chip_path))
-        coeffs = face3d.subject_perspective_sighting_coefficients(coeff_path)
-        ims = jitterer.multiple_random_jitters([image], coeffs, N_jitters)
-        for i, im in enumerate(ims):
-            output_f = os.path.join(output_dir, "%s_jitter_%s.jpg" % (chipID, i))
-            Image.fromarray(im).save(output_f)
-            # print("%s written! " % output_f)
-
-
-def process_chunck(chunck):
-    profile_jitterer = face3d.pose_jitterer_profile(pvr_data_path, 199, 29, "", min_yaw, max_yaw, egl_device)
-    t_start = time.time()
-    pid = os.getpid()
-    for i, line in enumerate(chunck):
-        process_line(line, profile_jitterer)
-        if i % print_rate ==0 and i != 0:
-            t_end = time.time()
-            duration = t_end - t_start
-            speed = float(print_rate) / duration
-            print("[PID_%s]: [%s/%s] - jittering with speed %.3f im/s" % (pid, i, len(chunck), speed))
-            t_start =time.time()
 
 if __name__ == '__main__':
-    lines = open(msceleb1m_coeffs_path, 'r').readlines()
-    L = len(lines)
-    chunksize = int(np.ceil(L / jobs))
-    chunks = [lines[i: i + chunksize] for i in xrange(0, L, chunksize)]
-    workers = Pool(processes=8)
-    workers.map(process_chunck, chunks)
-    workers.close()
-    # process_chunck(chunks[0])
+    main()
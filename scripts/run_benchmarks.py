@@ -0,0 +1,444 @@
+"""
+CPU benchmarks of the geometry, blending, PCA and estimation code paths, e.g.
+    python run_benchmarks.py --output results.json
+    python run_benchmarks.py --baseline results.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import collections
+
+
+# name -> (group, setup function).  setup(quick) returns (function to time, number of items it processes)
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, group):
+    def register(setup_fn):
+        BENCHMARKS[name] = (group, setup_fn)
+        return setup_fn
+    return register
+
+
+def _random_rotations(rng, num):
+    from pix2face_estimation import geometry_utils
+    angles = rng.uniform(-1.0, 1.0, size=(num, 3))
+    return geometry_utils.Euler_angles_to_matrix_batch(angles, 'XYZ')
+
+
+@benchmark('geometry.euler_to_matrix.scalar', 'geometry')
+def setup_euler_to_matrix_scalar(quick):
+    import numpy as np
+    from pix2face_estimation import geometry_utils
+    angles = np.random.RandomState(0).uniform(-1.0, 1.0, size=(200 if quick else 2000, 3))
+
+    def run():
+        for a in angles:
+            geometry_utils.Euler_angles_to_matrix(a[0], a[1], a[2], 'XYZ')
+    return run, len(angles)
+
+
+@benchmark('geometry.euler_to_matrix.batch', 'geometry')
+def setup_euler_to_matrix_batch(quick):
+    import numpy as np
+    from pix2face_estimation import geometry_utils
+    angles = np.random.RandomState(0).uniform(-1.0, 1.0, size=(10000 if quick else 100000, 3))
+    return (lambda: geometry_utils.Euler_angles_to_matrix_batch(angles, 'XYZ')), len(angles)
+
+
+@benchmark('geometry.matrix_to_euler.scalar', 'geometry')
+def setup_matrix_to_euler_scalar(quick):
+    import numpy as np
+    from pix2face_estimation import geometry_utils
+    rotations = _random_rotations(np.random.RandomState(0), 200 if quick else 2000)
+
+    def run():
+        for R in rotations:
+            geometry_utils.matrix_to_Euler_angles(R, 'XYZ')
+    return run, len(rotations)
+
+
+@benchmark('geometry.matrix_to_euler.batch', 'geometry')
+def setup_matrix_to_euler_batch(quick):
+    import numpy as np
+    from pix2face_estimation import geometry_utils
+    rotations = _random_rotations(np.random.RandomState(0), 10000 if quick else 100000)
+    return (lambda: geometry_utils.matrix_to_Euler_angles_batch(rotations, 'XYZ')), len(rotations)
+
+
+@benchmark('geometry.head_pose.batch', 'geometry')
+def setup_head_pose_batch(quick):
+    import numpy as np
+    from pix2face_estimation import camera_decomposition
+    rotations = _random_rotations(np.random.RandomState(0), 10000 if quick else 100000)
+    return (lambda: camera_decomposition.decompose_camera_rotation_batch(rotations, pitch_offset=-7)), len(rotations)
+
+
+def _random_affine_cameras(rng, num):
+    import numpy as np
+    rotations = _random_rotations(rng, num)
+    cameras = np.zeros((num, 3, 4))
+    scales = rng.uniform(0.5, 2.0, size=(num, 2))
+    cameras[:, 0, 0:3] = rotations[:, 0, :] * scales[:, 0:1]
+    cameras[:, 1, 0:3] = rotations[:, 1, :] * scales[:, 1:2]
+    cameras[:, 0:2, 3] = rng.uniform(-100, 100, size=(num, 2))
+    cameras[:, 2, 3] = 1
+    return cameras
+
+
+@benchmark('camera.decompose_affine', 'camera')
+def setup_decompose_affine(quick):
+    import numpy as np
+    from pix2face_estimation import camera_decomposition
+    cameras = _random_affine_cameras(np.random.RandomState(0), 100 if quick else 1000)
+
+    def run():
+        for P in cameras:
+            camera_decomposition.decompose_affine(P)
+    return run, len(cameras)
+
+
+@benchmark('camera.affine_to_orthographic', 'camera')
+def setup_affine_to_orthographic(quick):
+    import numpy as np
+    from pix2face_estimation import camera_decomposition
+    cameras = _random_affine_cameras(np.random.RandomState(0), 100 if quick else 1000)
+    decompositions = [camera_decomposition.decompose_affine(P) for P in cameras]
+
+    def run():
+        for K, _, R, T in decompositions:
+            camera_decomposition.affine_to_orthographic(K, R, T)
+    return run, len(decompositions)
+
+
+@benchmark('camera.decompose_affine.batch', 'camera')
+def setup_decompose_affine_batch(quick):
+    import numpy as np
+    from pix2face_estimation import camera_decomposition
+    cameras = _random_affine_cameras(np.random.RandomState(0), 10000 if quick else 100000)
+    return (lambda: camera_decomposition.decompose_affine_batch(cameras)), len(cameras)
+
+
+@benchmark('camera.affine_to_orthographic.batch', 'camera')
+def setup_affine_to_orthographic_batch(quick):
+    import numpy as np
+    from pix2face_estimation import camera_decomposition
+    cameras = _random_affine_cameras(np.random.RandomState(0), 10000 if quick else 100000)
+    K, R, T, _ = camera_decomposition.decompose_affine_batch(cameras)
+    return (lambda: camera_decomposition.affine_to_orthographic_batch(K, R, T)), len(cameras)
+
+
+@benchmark('camera.projection_errors.batch', 'camera')
+def setup_projection_errors_batch(quick):
+    import numpy as np
+    from pix2face_estimation import camera_decomposition
+    rng = np.random.RandomState(0)
+    num_cameras = 1000 if quick else 10000
+    num_points = 68
+    rotations = _random_rotations(rng, num_cameras)
+    translations = np.column_stack((rng.uniform(-10, 10, size=(num_cameras, 2)), rng.uniform(400, 600, num_cameras)))
+    focal_lengths = rng.uniform(500, 800, num_cameras)
+    principal_points = rng.uniform(100, 150, size=(num_cameras, 2))
+    points_3d = rng.uniform(-80, 80, size=(num_points, 3))
+    points_2d = rng.uniform(0, 250, size=(num_cameras, num_points, 2))
+    return (lambda: camera_decomposition.projection_errors_batch(focal_lengths, principal_points, rotations,
+                                                                 translations, points_3d, points_2d)), num_cameras
+
+
+@benchmark('blend.texture_accumulator', 'blend')
+def setup_texture_accumulator(quick):
+    import numpy as np
+    from pix2face_estimation import subject_blend
+    texture_res = 256 if quick else 512
+    rng = np.random.RandomState(0)
+    textures = []
+    for _ in range(8):
+        tex = np.empty((texture_res, texture_res, 4), np.float32)
+        tex[:, :, 0:3] = rng.uniform(0, 255, size=(texture_res, texture_res, 3))
+        tex[:, :, 3] = rng.uniform(0, 1, size=(texture_res, texture_res))
+        textures.append(tex)
+
+    def run():
+        accumulator = subject_blend.TextureAccumulator(texture_res)
+        for tex in textures:
+            accumulator.add(tex, 0.5)
+        accumulator.result()
+    return run, len(textures)
+
+
+@benchmark('pca.reconstruct', 'pca')
+def setup_pca_reconstruct(quick):
+    import numpy as np
+    from pix2face_estimation import pca_reconstruction
+    # synthetic bases of roughly the size of the head mesh
+    num_vertices = 10000 if quick else 50000
+    rng = np.random.RandomState(0)
+    reconstructor = pca_reconstruction.ShapeReconstructor(rng.standard_normal((num_vertices, 3)),
+                                                          rng.standard_normal((199, 3 * num_vertices)),
+                                                          rng.standard_normal((29, 3 * num_vertices)))
+    batch_size = 16 if quick else 64
+    subject_coeffs = rng.standard_normal((batch_size, 199))
+    expression_coeffs = rng.standard_normal((batch_size, 29))
+    return (lambda: reconstructor.reconstruct(subject_coeffs, expression_coeffs)), batch_size
+
+
+@benchmark('subject_model.add_sighting', 'pca')
+def setup_subject_model_add_sighting(quick):
+    import numpy as np
+    from pix2face_estimation.pca_reconstruction import ShapeReconstructor
+    from pix2face_estimation.subject_model import IncrementalSubjectModel
+    rng = np.random.RandomState(0)
+    num_vertices = 5000 if quick else 50000
+    mean = rng.standard_normal((num_vertices, 3))
+    reconstructor = ShapeReconstructor(mean, 0.05 * rng.standard_normal((30, 3 * num_vertices)),
+                                       0.05 * rng.standard_normal((20, 3 * num_vertices)), dtype=np.float64)
+    model = IncrementalSubjectModel(reconstructor)
+    # a sighting with every pixel on the face, so that max_samples_per_sighting samples are used
+    vertex_indices = rng.randint(0, num_vertices, size=(128, 128))
+    PNCC = mean[vertex_indices]
+    offsets = 0.01 * rng.standard_normal(PNCC.shape)
+    num_sightings = 4 if quick else 16
+
+    def run():
+        model.clear()
+        for i in range(num_sightings):
+            model.add_sighting(i, PNCC, offsets)
+            model.subject_coeffs()
+    return run, num_sightings
+
+
+def _synthetic_stream_inputs(quick):
+    import numpy as np
+    from pix2face_estimation import backends
+    num_images = 8 if quick else 32
+    images = [np.random.RandomState(i).randint(0, 255, size=(256, 256, 3), dtype=np.uint8) for i in range(num_images)]
+    labels = list(range(num_images))
+    # dense outputs are computed once, so that only the fitting and pipeline overhead are timed
+    dense = backends.SyntheticDenseEstimator().estimate(images)
+    return labels, (lambda label: label), (lambda indices: [dense[i] for i in indices])
+
+
+@benchmark('end_to_end.pose.synthetic', 'end_to_end')
+def setup_synthetic_pose_stream(quick):
+    from pix2face_estimation import backends
+    labels, load_fn, dense_fn = _synthetic_stream_inputs(quick)
+    fitter = backends.SyntheticFitter()
+
+    def run():
+        _consume(backends.estimate_head_pose_stream(labels, dense_fn, fitter, num_fit_workers=0, load_fn=load_fn))
+    return run, len(labels)
+
+
+@benchmark('end_to_end.coefficients.synthetic', 'end_to_end')
+def setup_synthetic_coefficient_stream(quick):
+    from pix2face_estimation import backends
+    labels, load_fn, dense_fn = _synthetic_stream_inputs(quick)
+    fitter = backends.SyntheticFitter()
+
+    def run():
+        _consume(backends.estimate_coefficients_stream(labels, dense_fn, fitter, num_fit_workers=0, load_fn=load_fn))
+    return run, len(labels)
+
+
+def _synthetic_video(quick):
+    import numpy as np
+    num_frames = 24 if quick else 96
+    return [np.random.RandomState(i).randint(0, 255, size=(128, 128, 3), dtype=np.uint8) for i in range(num_frames)]
+
+
+def _setup_synthetic_tracking(quick, keyframe_interval):
+    from pix2face_estimation import backends, pose_tracking
+    frames = _synthetic_video(quick)
+    # the network and fitting costs are simulated, so that the savings of keyframes and warm starts are measured
+    dense_estimator = backends.SyntheticDenseEstimator(seconds_per_image=0.002)
+    fitter = backends.SyntheticFitter(seconds_per_fit=0.004, seconds_per_warm_fit=0.001)
+
+    def run():
+        tracker = pose_tracking.PoseTracker(dense_estimator, fitter, keyframe_interval=keyframe_interval,
+                                            track_subject=True)
+        for frame_pose in tracker.track(frames):
+            if frame_pose.error is not None:
+                raise RuntimeError('frame %d failed: %s' % (frame_pose.index, frame_pose.error))
+    return run, len(frames)
+
+
+@benchmark('tracking.every_frame.synthetic', 'tracking')
+def setup_synthetic_tracking_every_frame(quick):
+    return _setup_synthetic_tracking(quick, keyframe_interval=1)
+
+
+@benchmark('tracking.keyframes.synthetic', 'tracking')
+def setup_synthetic_tracking_keyframes(quick):
+    return _setup_synthetic_tracking(quick, keyframe_interval=4)
+
+
+def _consume(results):
+    """ exhaust a stream of pipeline results, raising if any item failed (so that failures are not timed) """
+    for result in results:
+        if result.error is not None:
+            raise RuntimeError('%s failed at the %s stage: %s' % (result.label, result.stage, result.error))
+
+
+@benchmark('end_to_end.pose', 'end_to_end')
+def setup_pose_stream(quick):
+    from pix2face_estimation import camera_estimation
+    labels, load_fn, dense_fn = _synthetic_stream_inputs(quick)
+
+    def run():
+        _consume(camera_estimation.estimate_head_pose_stream(labels, None, cuda_device=None, num_fit_workers=0,
+                                                             load_fn=load_fn, dense_fn=dense_fn))
+    return run, len(labels)
+
+
+@benchmark('end_to_end.coefficients', 'end_to_end')
+def setup_coefficient_stream(quick):
+    from pix2face_estimation import coefficient_estimation
+    labels, load_fn, dense_fn = _synthetic_stream_inputs(quick)
+    pix2face_data = coefficient_estimation.load_pix2face_data(num_subject_coeffs=30, num_expression_coeffs=20)
+
+    def run():
+        _consume(coefficient_estimation.estimate_coefficients_stream(labels, None, pix2face_data, cuda_device=None,
+                                                                     num_fit_workers=0, load_fn=load_fn,
+                                                                     dense_fn=dense_fn))
+    return run, len(labels)
+
+
+def time_benchmark(run, num_items, repeat):
+    """ run once to warm up, then time repeat runs.  Returns a dictionary of statistics """
+    import numpy as np
+    run()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    times = np.array(times)
+    return dict(num_items=num_items, repeat=repeat,
+                min=float(times.min()), median=float(np.median(times)), mean=float(times.mean()),
+                std=float(times.std()), median_per_item=float(np.median(times)) / num_items)
+
+
+def run_benchmarks(names, quick, repeat):
+    results = collections.OrderedDict()
+    for name in names:
+        group, setup_fn = BENCHMARKS[name]
+        try:
+            run, num_items = setup_fn(quick)
+            stats = time_benchmark(run, num_items, repeat)
+            stats['group'] = group
+            print('%-36s %12.3f us / item' % (name, 1e6 * stats['median_per_item']))
+        except ImportError as e:
+            # face3d, vxl or pix2face is not available
+            stats = dict(group=group, skipped=str(e))
+            print('%-36s skipped: %s' % (name, e))
+        except Exception as e:
+            stats = dict(group=group, failed='%s: %s' % (type(e).__name__, e))
+            print('%-36s FAILED: %s' % (name, stats['failed']))
+        results[name] = stats
+    return results
+
+
+def machine_info():
+    import numpy as np
+    info = dict(python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+                processor=platform.processor(), cpu_count=os.cpu_count(),
+                threads=os.environ.get('OMP_NUM_THREADS'), date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    try:
+        this_dir = os.path.dirname(os.path.abspath(__file__))
+        info['git_commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=this_dir,
+                                                     stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        info['git_commit'] = None
+    return info
+
+
+def _timed(stats):
+    return stats is not None and 'skipped' not in stats and 'failed' not in stats
+
+
+def compare(results, baseline, tolerance, selected=None):
+    """
+    print the change in median time per item against baseline.  Returns the names of regressed benchmarks,
+    including those timed in the baseline that are now missing or failed.
+    selected(name, group) tells whether a baseline benchmark was meant to run (default: all).
+    """
+    regressions = []
+    print('\n%-36s %12s %12s %8s' % ('benchmark', 'baseline us', 'current us', 'ratio'))
+    for name, base in baseline['results'].items():
+        if name in results or not _timed(base) or (selected is not None and not selected(name, base.get('group', ''))):
+            continue
+        print('%-36s %12.3f %12s %8s  MISSING' % (name, 1e6 * base['median_per_item'], '-', '-'))
+        regressions.append(name)
+    for name, stats in results.items():
+        base = baseline['results'].get(name)
+        if not _timed(base) or 'skipped' in stats:
+            continue
+        if 'failed' in stats:
+            print('%-36s %12.3f %12s %8s  FAILED' % (name, 1e6 * base['median_per_item'], '-', '-'))
+            regressions.append(name)
+            continue
+        ratio = stats['median_per_item'] / base['median_per_item']
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-36s %12.3f %12.3f %8.2f%s' % (name, 1e6 * base['median_per_item'],
+                                                1e6 * stats['median_per_item'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the CPU benchmark suite')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare against results previously written with --output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before failing')
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose name or group starts with this prefix')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs of each benchmark')
+    parser.add_argument('--quick', action='store_true', help='use smaller problem sizes')
+    parser.add_argument('--threads', type=int, default=1, help='number of BLAS/OpenMP threads (0: library default)')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (group, _) in BENCHMARKS.items():
+            print('%-36s %s' % (name, group))
+        return 0
+
+    # must be set before numpy is imported for consistent timings
+    if args.threads > 0:
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ[var] = str(args.threads)
+
+    def selected(name, group):
+        return args.filter is None or name.startswith(args.filter) or group.startswith(args.filter)
+
+    names = [name for name, (group, _) in BENCHMARKS.items() if selected(name, group)]
+    results = run_benchmarks(names, args.quick, args.repeat)
+    failures = [name for name, stats in results.items() if 'failed' in stats]
+    output = dict(machine=machine_info(), quick=args.quick, results=results)
+    if args.output is not None:
+        with open(args.output, 'w') as fd:
+            json.dump(output, fd, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fd:
+            baseline = json.load(fd)
+        if baseline.get('quick') != args.quick:
+            print('Warning: baseline was run with quick=%s' % baseline.get('quick'))
+        regressions = compare(results, baseline, args.tolerance, selected)
+        if len(regressions) > 0:
+            print('%d benchmarks regressed by more than %d%%, failed or are missing' %
+                  (len(regressions), 100 * args.tolerance))
+            return 1
+    if len(failures) > 0:
+        print('%d benchmarks failed' % len(failures))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+""" Run the pix2face HTTP inference service (see pix2face_estimation.service) """
+import os
+import argparse
+from pix2face_estimation import service
+from pix2face_estimation import instrumentation
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve pose, coefficient, render and blend requests over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--synthetic', action='store_true',
+                        help='use the synthetic backend (no model, face3d or GPU needed), e.g. for load testing')
+    parser.add_argument('--synthetic_seconds_per_image', type=float, default=0.005,
+                        help='simulated network time per image of the synthetic backend')
+    parser.add_argument('--synthetic_seconds_per_batch', type=float, default=0.02,
+                        help='simulated network time per batch of the synthetic backend')
+    parser.add_argument('--synthetic_seconds_per_fit', type=float, default=0.01,
+                        help='simulated fitting time of the synthetic backend')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='maximum number of images per network call')
+    parser.add_argument('--max_batch_wait_ms', type=float, default=5.0,
+                        help='time to wait for more requests after the first of a batch arrives')
+    parser.add_argument('--max_pending', type=int, default=64,
+                        help='maximum number of requests in progress; further requests are rejected with 503')
+    parser.add_argument('--num_threads', type=int, default=4,
+                        help='threads for decoding and encoding (and fitting and rendering, with --synthetic)')
+    parser.add_argument('--num_fit_workers', type=int, default=0, help='if > 0, fit in this many worker processes')
+    parser.add_argument('--profile', action='store_true', help='include per-stage timings in /metrics')
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable()
+
+    if args.synthetic:
+        backend = service.SyntheticServiceBackend(args.synthetic_seconds_per_image, args.synthetic_seconds_per_batch,
+                                                  args.synthetic_seconds_per_fit)
+    else:
+        # set CPU_ONLY=1 to run on the CPU
+        cpu_only = int(os.environ.get('CPU_ONLY', '0')) != 0
+        backend = service.Face3dServiceBackend(cuda_device=None if cpu_only else 0)
+
+    inference_service = service.InferenceService(backend, max_batch_size=args.max_batch_size,
+                                                 max_batch_wait=args.max_batch_wait_ms / 1000.0,
+                                                 max_pending=args.max_pending, num_threads=args.num_threads,
+                                                 num_fit_workers=args.num_fit_workers)
+    inference_service.serve_forever(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
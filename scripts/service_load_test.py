@@ -0,0 +1,61 @@
+""" Send concurrent requests to a running pix2face service and report latencies and throughput """
+import io
+import time
+import argparse
+import urllib.request
+import urllib.error
+import concurrent.futures
+import numpy as np
+from PIL import Image
+
+
+def random_image(seed, size=256):
+    img = np.random.RandomState(seed).randint(0, 255, size=(size, size, 3), dtype=np.uint8)
+    fd = io.BytesIO()
+    Image.fromarray(img).save(fd, format='PNG')
+    return fd.getvalue()
+
+
+def send(url, data):
+    """ return (HTTP status, seconds) """
+    t0 = time.perf_counter()
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'image/png'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--endpoint', default='pose', choices=('pose', 'coefficients', 'render'))
+    parser.add_argument('--num_requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--num_images', type=int, default=16, help='number of distinct images sent')
+    args = parser.parse_args()
+
+    images = [random_image(i) for i in range(args.num_images)]
+    url = '%s/%s' % (args.url.rstrip('/'), args.endpoint)
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda i: send(url, images[i % len(images)]), range(args.num_requests)))
+    elapsed = time.perf_counter() - t0
+
+    latencies = np.array([seconds for status, seconds in results if status == 200])
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print('%d requests in %.2f s (%.1f / s), status counts: %s' % (len(results), elapsed, len(results) / elapsed, statuses))
+    if len(latencies) > 0:
+        print('latency ms: p50 %.1f  p95 %.1f  p99 %.1f  max %.1f' %
+              tuple(1e3 * np.percentile(latencies, (50, 95, 99, 100))))
+    with urllib.request.urlopen(args.url.rstrip('/') + '/metrics') as response:
+        print(response.read().decode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
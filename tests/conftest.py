@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the package is used from the source tree (see pix2face_env.bsh); only pure python modules are tested here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
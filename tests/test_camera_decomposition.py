@@ -0,0 +1,76 @@
+import numpy as np
+from pix2face_estimation import camera_decomposition
+
+
+def test_decompose_affine_batch_empty():
+    K, R, T, valid = camera_decomposition.decompose_affine_batch(np.zeros((0,3,4)))
+    assert K.shape == (0,3,3) and R.shape == (0,3,3) and T.shape == (0,3) and valid.shape == (0,)
+    Kortho, Rortho, Tortho, H, valid = camera_decomposition.affine_to_orthographic_batch(K, R, T)
+    assert Kortho.shape == (0,3,3) and Rortho.shape == (0,3,3) and Tortho.shape == (0,3)
+    assert H.shape == (0,4,4) and valid.shape == (0,)
+
+
+def random_affine_cameras(N, seed=0):
+    rng = np.random.RandomState(seed)
+    Ps = np.zeros((N,3,4))
+    Ps[:,0:2,:] = rng.uniform(-2.0, 2.0, size=(N,2,4))
+    Ps[:,2,3] = 1
+    return Ps
+
+
+def test_decompose_affine_batch_matches_scalar():
+    Ps = random_affine_cameras(10)
+    K, R, T, valid = camera_decomposition.decompose_affine_batch(Ps)
+    assert np.all(valid)
+    for i in range(len(Ps)):
+        K1, _, R1, T1 = camera_decomposition.decompose_affine(Ps[i])
+        assert np.allclose(K[i], K1) and np.allclose(R[i], R1) and np.allclose(T[i], T1)
+
+
+def test_decompose_affine_batch_flags_degenerate():
+    Ps = random_affine_cameras(3)
+    Ps[1,0:2,0:3] = 0
+    with np.errstate(all='raise'):
+        _, _, _, valid = camera_decomposition.decompose_affine_batch(Ps)
+    assert list(valid) == [True, False, True]
+
+
+def test_affine_to_orthographic_batch_matches_scalar():
+    K, R, T, _ = camera_decomposition.decompose_affine_batch(random_affine_cameras(10))
+    for limit_H_diagonal in (True, False):
+        Kortho, Rortho, Tortho, H, valid = camera_decomposition.affine_to_orthographic_batch(
+            K, R, T, limit_H_diagonal=limit_H_diagonal)
+        assert np.all(valid)
+        for i in range(len(K)):
+            K1, R1, T1, H1 = camera_decomposition.affine_to_orthographic(K[i], R[i], T[i],
+                                                                          limit_H_diagonal=limit_H_diagonal)
+            assert np.allclose(Kortho[i], K1) and np.allclose(Rortho[i], R1)
+            assert np.allclose(Tortho[i], T1) and np.allclose(H[i], H1)
+
+
+def test_camera_rotation_batch_matches_scalar():
+    rng = np.random.RandomState(0)
+    ypr = rng.uniform(-60.0, 60.0, size=(10,3))
+    camRs = camera_decomposition.compose_camera_rotation_batch(ypr, pitch_offset=5)
+    ypr2 = camera_decomposition.decompose_camera_rotation_batch(camRs, pitch_offset=5)
+    assert np.allclose(ypr2, ypr)
+    for i in range(len(ypr)):
+        assert np.allclose(camRs[i], camera_decomposition.compose_camera_rotation(*ypr[i], pitch_offset=5))
+        assert np.allclose(ypr2[i], camera_decomposition.decompose_camera_rotation(camRs[i], pitch_offset=5))
+
+
+def test_project_points_batch():
+    points_3d = np.array(((0.0, 0.0, 0.0), (1.0, 2.0, 0.0), (0.0, 0.0, -20.0)))
+    f = np.array((100.0, 200.0))
+    pp = np.array(((50.0, 60.0), (0.0, 0.0)))
+    R = np.stack((np.eye(3), np.eye(3)))
+    T = np.array(((0.0, 0.0, 10.0), (0.0, 0.0, 10.0)))
+    projected = camera_decomposition.project_points_batch(f, pp, R, T, points_3d)
+    assert projected.shape == (2,3,2)
+    assert np.allclose(projected[0,0:2], ((50.0, 60.0), (60.0, 80.0)))
+    assert np.allclose(projected[1,0:2], ((0.0, 0.0), (20.0, 40.0)))
+    # points behind the camera do not project
+    assert np.all(np.isnan(projected[:,2]))
+
+    errors = camera_decomposition.projection_errors_batch(f, pp, R, T, points_3d, projected + (3.0, 4.0))
+    assert np.allclose(errors.mean, 5.0) and np.allclose(errors.max, 5.0)
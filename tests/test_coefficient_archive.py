@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from pix2face_estimation import coefficient_archive
+
+
+def random_columns(num_sightings, num_subject_coeffs=4, num_expression_coeffs=3, seed=0):
+    rng = np.random.RandomState(seed)
+    return dict(subject_coeffs=np.tile(rng.normal(size=num_subject_coeffs), (num_sightings, 1)),
+                expression_coeffs=rng.normal(size=(num_sightings, num_expression_coeffs)),
+                rotation=rng.normal(size=(num_sightings,3,3)),
+                translation=rng.normal(size=(num_sightings,3)),
+                focal_length=rng.uniform(100.0, 1000.0, size=num_sightings),
+                principal_point=rng.uniform(0.0, 256.0, size=(num_sightings,2)),
+                image_size=rng.randint(1, 1024, size=(num_sightings,2)).astype(np.int32))
+
+
+def test_archive_round_trip(tmpdir):
+    archive_dir = os.path.join(str(tmpdir), 'archive')
+    records = [('subj%d' % r, ['subj%d/img%d.jpg' % (r, i) for i in range(r + 1)], random_columns(r + 1, seed=r))
+               for r in range(3)]
+    with coefficient_archive.CoefficientArchive(archive_dir, 'w', 4, 3) as archive:
+        record_id, image_ids, columns = records[0]
+        archive.append_arrays(record_id, image_ids, **columns)
+        archive.append_many(records[1:])
+        assert len(archive) == 6
+    assert coefficient_archive.is_archive(archive_dir)
+
+    with coefficient_archive.CoefficientArchive(archive_dir, 'r') as archive:
+        assert len(archive) == 6
+        assert (archive.num_subject_coeffs, archive.num_expression_coeffs) == (4, 3)
+        assert archive.record_ids_unique() == ['subj0', 'subj1', 'subj2']
+        for record_id, image_ids, columns in records:
+            rows = archive.rows_of_record(record_id)
+            assert [archive.image_ids[row] for row in rows] == image_ids
+            for name, values in columns.items():
+                assert np.array_equal(archive.column(name)[rows], values)
+            values = archive.get(image_ids[-1])
+            assert values['record_id'] == record_id
+            assert np.array_equal(values['translation'], columns['translation'][-1])
+        assert archive.row_of('subj2/img0.jpg') == 3
+        with pytest.raises(IOError):
+            archive.append_arrays('subj3', ['img'], **random_columns(1))
+
+
+def test_archive_append_and_truncate(tmpdir):
+    archive_dir = os.path.join(str(tmpdir), 'archive')
+    with coefficient_archive.CoefficientArchive(archive_dir, 'a') as archive:
+        # the number of coefficients is taken from the first record
+        archive.append_arrays('subj0', ['img0', 'img1'], **random_columns(2))
+    # simulate an append interrupted after writing some column data, but before committing the header
+    with open(os.path.join(archive_dir, 'rotation.bin'), 'ab') as fd:
+        fd.write(b'\0' * 72)
+    with open(os.path.join(archive_dir, 'index.tsv'), 'a') as fd:
+        fd.write('subj1\timg2\n')
+
+    with coefficient_archive.CoefficientArchive(archive_dir, 'a') as archive:
+        assert len(archive) == 2 and archive.image_ids == ['img0', 'img1']
+        columns = random_columns(1, seed=1)
+        archive.append_arrays('subj1', ['img2'], **columns)
+        assert np.array_equal(archive.rotations[2], columns['rotation'][0])
+    with coefficient_archive.CoefficientArchive(archive_dir, 'r') as archive:
+        assert archive.image_ids == ['img0', 'img1', 'img2']
+        assert archive.rows_of_record('subj1') == [2]
+
+    with pytest.raises(ValueError):
+        coefficient_archive.CoefficientArchive(archive_dir, 'a', num_subject_coeffs=5)
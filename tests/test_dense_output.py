@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pytest
+from pix2face_estimation import dense_output
+
+
+@pytest.mark.parametrize('dtype', dense_output.DTYPES)
+@pytest.mark.parametrize('max_abs_value', [1.0, 0.25])
+def test_encode_decode_error_bound(dtype, max_abs_value):
+    rng = np.random.RandomState(0)
+    values = rng.uniform(-max_abs_value, max_abs_value, size=(64,64,3)).astype(np.float32)
+    encoded = dense_output.encode(values, dtype, max_abs_value)
+    assert encoded.dtype == np.dtype(dtype)
+    decoded = dense_output.decode(encoded, dtype, max_abs_value)
+    assert decoded.dtype == np.float32
+    assert np.max(np.abs(decoded - values)) <= dense_output.max_error(dtype, max_abs_value)
+
+
+def test_encode_int16_clips():
+    values = np.array((-3.0, -1.0, 0.0, 1.0, 3.0))
+    decoded = dense_output.decode(dense_output.encode(values, 'int16', 1.0), 'int16', 1.0)
+    assert np.allclose(decoded, (-1.0, -1.0, 0.0, 1.0, 1.0))
+
+
+def test_unknown_dtype():
+    with pytest.raises(ValueError):
+        dense_output.encode(np.zeros(3), 'uint8')
+    with pytest.raises(ValueError):
+        dense_output.max_error('uint8')
+
+
+def test_npz_shard_round_trip(tmpdir):
+    rng = np.random.RandomState(0)
+    max_abs_value = dict(PNCC=1.0, offsets=0.1)
+    outputs = dict(('img%d' % i, dict(PNCC=rng.uniform(-1.0, 1.0, size=(8,8,3)).astype(np.float32),
+                                      offsets=rng.uniform(-0.1, 0.1, size=(8,8,3)).astype(np.float32)))
+                   for i in range(5))
+    writer = dense_output.NpzShardWriter(str(tmpdir), dtype='int16', max_abs_value=max_abs_value, shard_size=2)
+    for basename, channels in sorted(outputs.items()):
+        writer.write(basename, channels['PNCC'], channels['offsets'])
+    writer.close()
+    completed = writer.pop_completed()
+    assert sorted(completed) == sorted((basename, None) for basename in outputs)
+
+    shard_fnames = sorted(os.listdir(str(tmpdir)))
+    assert shard_fnames == ['dense_00000.npz', 'dense_00001.npz', 'dense_00002.npz']
+    decoded = {}
+    for fname in shard_fnames:
+        decoded.update(dense_output.read_npz_shard(os.path.join(str(tmpdir), fname)))
+    assert sorted(decoded.keys()) == sorted(outputs.keys())
+    for basename, channels in outputs.items():
+        for channel, values in channels.items():
+            bound = dense_output.max_error('int16', max_abs_value[channel])
+            assert np.max(np.abs(decoded[basename][channel] - values)) <= bound
@@ -0,0 +1,71 @@
+import numpy as np
+from pix2face_estimation import geometry_utils
+
+
+def random_angles(N, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(-1.2, 1.2, size=(N,3))
+
+
+def same_rotation(q0, q1):
+    """ q and -q represent the same rotation """
+    return np.allclose(q0, q1) or np.allclose(q0, -q1)
+
+
+def test_Euler_angles_to_quaternion_batch_matches_scalar():
+    angles = random_angles(20)
+    for order in ('XYZ', 'YXZ', 'ZYX'):
+        q = geometry_utils.Euler_angles_to_quaternion_batch(angles, order=order)
+        for i in range(len(angles)):
+            assert np.allclose(q[i], geometry_utils.Euler_angles_to_quaternion(*angles[i], order=order))
+
+
+def test_quaternion_to_Euler_angles_batch_matches_scalar():
+    q = geometry_utils.Euler_angles_to_quaternion_batch(random_angles(20), order='YXZ')
+    angles = geometry_utils.quaternion_to_Euler_angles_batch(q, order='YXZ')
+    for i in range(len(q)):
+        assert np.allclose(angles[i], geometry_utils.quaternion_to_Euler_angles(q[i], order='YXZ'))
+
+
+def test_quaternion_matrix_batch_matches_scalar():
+    q = geometry_utils.Euler_angles_to_quaternion_batch(random_angles(20), order='XYZ')
+    R = geometry_utils.quaternion_to_matrix_batch(q)
+    q2 = geometry_utils.matrix_to_quaternion_batch(R)
+    for i in range(len(q)):
+        assert np.allclose(R[i], geometry_utils.quaternion_to_matrix(q[i].copy()))
+        assert np.allclose(q2[i], geometry_utils.matrix_to_quaternion(R[i]))
+        assert same_rotation(q2[i], q[i])
+
+
+def test_matrix_to_Euler_angles_batch_round_trip():
+    angles = random_angles(20)
+    R = geometry_utils.Euler_angles_to_matrix_batch(angles, order='ZYX')
+    assert np.allclose(geometry_utils.matrix_to_Euler_angles_batch(R, order='ZYX'), angles)
+    for i in range(len(angles)):
+        assert np.allclose(R[i], geometry_utils.Euler_angles_to_matrix(*angles[i], order='ZYX'))
+
+
+def test_compose_quaternions_batch_matches_scalar():
+    qs = [geometry_utils.Euler_angles_to_quaternion_batch(random_angles(10, seed)) for seed in range(3)]
+    q = geometry_utils.compose_quaternions_batch(qs)
+    for i in range(10):
+        assert np.allclose(q[i], geometry_utils.compose_quaternions([qs[0][i], qs[1][i], qs[2][i]]))
+
+
+def test_compose_quaternions_batch_empty():
+    q = geometry_utils.compose_quaternions_batch([])
+    assert q.shape == (1,4)
+    assert np.allclose(q, geometry_utils.compose_quaternions([]))
+
+
+def test_slerp_quaternions_batch():
+    q0 = geometry_utils.Euler_angles_to_quaternion(0.1, 0.2, 0.3)
+    q1 = geometry_utils.Euler_angles_to_quaternion(-0.4, 0.5, 0.1)
+    q = geometry_utils.slerp_quaternions_batch(q0, q1, np.array((0.0, 0.5, 1.0)))
+    assert same_rotation(q[0], q0 / np.linalg.norm(q0))
+    assert same_rotation(q[2], q1 / np.linalg.norm(q1))
+    # the midpoint is equidistant from both ends
+    assert np.isclose(abs(np.dot(q[1], q0)), abs(np.dot(q[1], q1)))
+    # identical rotations fall back to linear interpolation
+    q = geometry_utils.slerp_quaternions_batch(q0, -q0, np.array((0.25,)))
+    assert same_rotation(q[0], q0 / np.linalg.norm(q0))
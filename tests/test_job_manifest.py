@@ -0,0 +1,26 @@
+import os
+from pix2face_estimation import job_manifest
+
+
+def test_job_manifest_resume(tmpdir):
+    db_fname = os.path.join(str(tmpdir), 'manifest.db')
+    labels = ['img%d' % i for i in range(6)]
+    with job_manifest.JobManifest(db_fname) as manifest:
+        assert manifest.remaining(labels) == labels
+        manifest.mark_done('img0', elapsed=1.0)
+        manifest.mark_failed('img2', error=ValueError('no face'))
+        manifest.record([('img3', True, 0.5, None), ('img4', False, None, 'timeout')])
+        assert manifest.counts() == {job_manifest.PENDING: 2, job_manifest.DONE: 2, job_manifest.FAILED: 2}
+
+    # an interrupted job resumes from the recorded status
+    with job_manifest.JobManifest(db_fname) as manifest:
+        assert manifest.remaining(labels) == ['img1', 'img5']
+        assert manifest.remaining(labels, retry_failed=True) == ['img1', 'img2', 'img4', 'img5']
+        assert manifest.failures() == [('img2', 'no face'), ('img4', 'timeout')]
+        # retried items move from failed to done
+        manifest.mark_done('img2')
+        assert manifest.labels_with_status(job_manifest.FAILED) == {'img4'}
+        # new labels are added as pending, and labels not previously added are tracked when recorded
+        assert manifest.remaining(labels + ['img6']) == ['img1', 'img5', 'img6']
+        manifest.mark_done('img7')
+        assert manifest.counts() == {job_manifest.PENDING: 3, job_manifest.DONE: 4, job_manifest.FAILED: 1}
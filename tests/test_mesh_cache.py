@@ -0,0 +1,63 @@
+from collections import namedtuple
+import numpy as np
+from pix2face_estimation import mesh_cache
+
+
+FakePix2FaceData = namedtuple('FakePix2FaceData', ['pvr_data_dir', 'subject_components_array',
+                                                   'expression_components_array'])
+
+
+class FakeWarp(object):
+    """ stands in for the face3d mesh warp, counting calls """
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self, pix2face_data, subject_coeffs, expression_coeffs):
+        self.num_calls += 1
+        return (tuple(subject_coeffs), tuple(expression_coeffs))
+
+
+def fake_data(num_vertex_values=30):
+    return FakePix2FaceData('pvr', np.zeros((4, num_vertex_values)), np.zeros((3, num_vertex_values)))
+
+
+def test_cache_hits_and_misses():
+    data = fake_data()
+    warp = FakeWarp()
+    cache = mesh_cache.WarpedMeshCache(warp_fn=warp)
+    mesh = cache.get(data, np.ones(4), np.zeros(3))
+    assert cache.get(data, np.ones(4), np.zeros(3)) is mesh
+    cache.get(data, np.ones(4), np.ones(3))
+    # different PCA bases do not share meshes
+    cache.get(fake_data(60), np.ones(4), np.zeros(3))
+    assert (cache.hits, cache.misses, warp.num_calls, len(cache)) == (1, 3, 3, 3)
+    cache.clear()
+    assert len(cache) == 0 and cache.num_bytes == 0
+
+
+def test_cache_eviction_by_entries():
+    data = fake_data()
+    warp = FakeWarp()
+    cache = mesh_cache.WarpedMeshCache(max_entries=2, warp_fn=warp)
+    for i in range(3):
+        cache.get(data, np.full(4, i), np.zeros(3))
+    assert len(cache) == 2
+    # the least recently used entry (0) was evicted
+    cache.get(data, np.full(4, 2), np.zeros(3))
+    cache.get(data, np.full(4, 1), np.zeros(3))
+    assert warp.num_calls == 3
+    cache.get(data, np.full(4, 0), np.zeros(3))
+    assert warp.num_calls == 4
+
+
+def test_cache_eviction_by_bytes():
+    data = fake_data()
+    mesh_bytes = mesh_cache.estimate_mesh_bytes(data)
+    cache = mesh_cache.WarpedMeshCache(max_bytes=2.5 * mesh_bytes, warp_fn=FakeWarp())
+    for i in range(4):
+        cache.get(data, np.full(4, i), np.zeros(3))
+    assert len(cache) == 2 and cache.num_bytes == 2 * mesh_bytes
+    # the most recently added mesh is kept even if it exceeds the bound on its own
+    cache = mesh_cache.WarpedMeshCache(max_bytes=mesh_bytes // 2, warp_fn=FakeWarp())
+    cache.get(data, np.ones(4), np.zeros(3))
+    assert len(cache) == 1
@@ -0,0 +1,65 @@
+import time
+import concurrent.futures
+import pytest
+from pix2face_estimation import pipeline
+
+
+def load_fn(label):
+    if label == 'bad_load':
+        raise IOError('cannot load ' + label)
+    # finish out of order
+    time.sleep(0.001 * (hash(label) % 5))
+    return label
+
+
+def infer_fn(inputs):
+    if 'bad_infer' in inputs:
+        raise RuntimeError('inference failed')
+    return [x + '_inferred' for x in inputs]
+
+
+def fit_fn(output):
+    if output.startswith('bad_fit'):
+        raise ValueError('fit failed')
+    return output + '_fit'
+
+
+@pytest.mark.parametrize('use_executor', [False, True])
+def test_run_pipeline_order(use_executor):
+    labels = ['img%03d' % i for i in range(50)]
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(pipeline.run_pipeline(labels, infer_fn, fit_fn, load_fn=load_fn, batch_size=4,
+                                             num_load_threads=3, fit_executor=executor if use_executor else None,
+                                             max_in_flight=8))
+    assert [r.label for r in results] == labels
+    assert [r.value for r in results] == [label + '_inferred_fit' for label in labels]
+    assert all(r.error is None and r.stage is None for r in results)
+
+
+def test_run_pipeline_errors():
+    # batch_size 2 puts bad_infer in a batch with img2, which fails with it
+    labels = ['img0', 'bad_load', 'img2', 'bad_infer', 'bad_fit', 'img5']
+    results = list(pipeline.run_pipeline(labels, infer_fn, fit_fn, load_fn=load_fn, batch_size=2,
+                                         num_load_threads=2))
+    assert [r.label for r in results] == labels
+    assert [r.stage for r in results] == [None, 'load', 'infer', 'infer', 'fit', None]
+    assert isinstance(results[1].error, IOError)
+    assert isinstance(results[2].error, RuntimeError) and isinstance(results[3].error, RuntimeError)
+    assert isinstance(results[4].error, ValueError)
+    assert results[1].value is None and results[5].value == 'img5_inferred_fit'
+
+
+def test_run_pipeline_aborts_on_label_error():
+    def labels():
+        yield 'img0'
+        raise KeyError('bad label list')
+    with pytest.raises(KeyError):
+        list(pipeline.run_pipeline(labels(), infer_fn, fit_fn, load_fn=load_fn, batch_size=1))
+
+
+def test_run_pipeline_early_exit():
+    labels = ['img%03d' % i for i in range(100)]
+    results = pipeline.run_pipeline(labels, infer_fn, fit_fn, load_fn=load_fn, batch_size=2, max_in_flight=2)
+    assert next(results).label == 'img000'
+    # closing the generator stops the producer rather than blocking on the full queue
+    results.close()
@@ -0,0 +1,88 @@
+import numpy as np
+from pix2face_estimation.pca_reconstruction import ShapeReconstructor
+from pix2face_estimation.subject_model import IncrementalSubjectModel
+
+
+NUM_VERTICES = 40
+NUM_SUBJECT = 3
+NUM_EXPRESSION = 2
+
+
+def random_reconstructor(rng):
+    mean = rng.uniform(-1.0, 1.0, size=(NUM_VERTICES, 3))
+    return ShapeReconstructor(mean, rng.normal(size=(NUM_SUBJECT, 3*NUM_VERTICES)),
+                              rng.normal(size=(NUM_EXPRESSION, 3*NUM_VERTICES)), dtype=np.float64)
+
+
+def random_sighting(rng, reconstructor, subject_coeffs):
+    """ network outputs seeing a random subset of the vertices, with random expression and noise """
+    vertex_indices = rng.choice(NUM_VERTICES, size=NUM_VERTICES // 2, replace=False)
+    expression_coeffs = rng.normal(size=NUM_EXPRESSION)
+    offsets = np.dot(subject_coeffs, reconstructor.subject_components) + \
+        np.dot(expression_coeffs, reconstructor.expression_components)
+    offsets = offsets.reshape(-1, 3)[vertex_indices] + rng.normal(scale=0.01, size=(len(vertex_indices), 3))
+    PNCC = reconstructor.mean_vertices()[vertex_indices]
+    return vertex_indices, PNCC, offsets
+
+
+def batch_solve(reconstructor, sightings, subject_regularization, expression_regularization):
+    """ jointly solve for the subject and all expression coefficients with one stacked least squares problem """
+    n = len(sightings)
+    num_unknowns = NUM_SUBJECT + n * NUM_EXPRESSION
+    rows = []
+    rhs = []
+    for i, (vertex_indices, _, offsets) in enumerate(sightings):
+        columns = (3 * vertex_indices[:, np.newaxis] + np.arange(3)).reshape(-1)
+        A = np.zeros((len(columns), num_unknowns))
+        A[:, 0:NUM_SUBJECT] = reconstructor.subject_components[:, columns].T
+        start = NUM_SUBJECT + i * NUM_EXPRESSION
+        A[:, start:start + NUM_EXPRESSION] = reconstructor.expression_components[:, columns].T
+        rows.append(A)
+        rhs.append(offsets.reshape(-1))
+    weights = np.array([subject_regularization] * NUM_SUBJECT + [expression_regularization] * (n * NUM_EXPRESSION))
+    rows.append(np.diag(np.sqrt(weights)))
+    rhs.append(np.zeros(num_unknowns))
+    x = np.linalg.lstsq(np.vstack(rows), np.concatenate(rhs), rcond=None)[0]
+    return x[0:NUM_SUBJECT], x[NUM_SUBJECT:].reshape(n, NUM_EXPRESSION)
+
+
+def check_model(model, reconstructor, sightings):
+    subject_coeffs, expression_coeffs = batch_solve(reconstructor, sightings, model.subject_regularization,
+                                                    model.expression_regularization)
+    assert np.allclose(model.subject_coeffs(), subject_coeffs)
+    for i in range(len(sightings)):
+        assert np.allclose(model.expression_coeffs(i), expression_coeffs[i])
+
+
+def test_incremental_matches_batch_solve():
+    rng = np.random.RandomState(0)
+    reconstructor = random_reconstructor(rng)
+    subject_coeffs = rng.normal(size=NUM_SUBJECT)
+    sightings = [random_sighting(rng, reconstructor, subject_coeffs) for _ in range(5)]
+    model = IncrementalSubjectModel(reconstructor, subject_regularization=0.5, expression_regularization=2.0)
+    for i, (_, PNCC, offsets) in enumerate(sightings):
+        assert model.add_sighting('img%d' % i, PNCC, offsets) == i
+        check_model(model, reconstructor, sightings[0:i + 1])
+    assert np.allclose(model.subject_coeffs(), subject_coeffs, atol=0.1)
+
+    # removing a sighting gives the same result as never having added it
+    assert model.remove_sighting(1).label == 'img1'
+    assert model.labels == ['img0', 'img2', 'img3', 'img4']
+    check_model(model, reconstructor, sightings[0:1] + sightings[2:])
+
+
+def test_save_load(tmpdir):
+    rng = np.random.RandomState(1)
+    reconstructor = random_reconstructor(rng)
+    subject_coeffs = rng.normal(size=NUM_SUBJECT)
+    model = IncrementalSubjectModel(reconstructor)
+    for i in range(3):
+        _, PNCC, offsets = random_sighting(rng, reconstructor, subject_coeffs)
+        model.add_sighting('img%d' % i, PNCC, offsets)
+    fname = str(tmpdir.join('subject.npz'))
+    model.save(fname)
+    model2 = IncrementalSubjectModel(reconstructor)
+    model2.load(fname)
+    assert model2.labels == model.labels
+    assert np.allclose(model2.subject_coeffs(), model.subject_coeffs())
+    assert np.allclose(model2.expression_coeffs(2), model.expression_coeffs(2))